@@ -0,0 +1,138 @@
+""" asyncio front end for the BookStore, for programs that use the reading list from inside an event loop. """
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from bookstore import BookStore
+
+
+class AsyncBookStore:
+
+    """ Wraps the BookStore so every operation can be awaited without blocking the event loop.
+    Reads run on a pool of worker threads. The BookStore gives each thread its own connection, so reads run at the same time
+    as each other instead of queueing for one connection.
+    Writes run on a single writer thread, so they happen in the order they were started. A read started after a write
+    has been awaited will see the write.
+    Use as an async context manager, or call close() when finished. """
+
+    def __init__(self, max_workers=4):
+        """ :param max_workers how many reads can run at the same time """
+        self.store = BookStore()
+        self._readers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bookstore-reader')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bookstore-writer')
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    async def close(self):
+        """ Waits for queued operations to finish, then stops the worker threads """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+
+    def _shutdown(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+    async def _read(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(method, *args))
+
+
+    async def _write(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(method, *args))
+
+
+    async def add(self, book):
+        """ Adds a new book to the store, the same as book.save() for a book without an id.
+        Raises BookError if the book is already in the store.
+        :returns the book, with its id set """
+        await self._write(self.store._add_book, book)
+        return book
+
+
+    async def update(self, book):
+        """ Saves changes to a book that's already in the store. Raises BookError if it is not found. """
+        await self._write(self.store._update_book, book)
+
+
+    async def delete(self, book):
+        """ Deletes a book from the store. Raises BookError if it is not found. """
+        await self._write(self.store._delete_book, book)
+
+
+    async def add_books(self, books, batch_size=None):
+        """ See BookStore.add_books. books is read on the writer thread, so it should not be a generator that
+        uses the event loop. """
+        return await self._write(self.store.add_books, books, batch_size)
+
+
+    async def delete_all_books(self):
+        await self._write(self.store.delete_all_books)
+
+
+    async def exact_match(self, search_book):
+        return await self._read(self.store.exact_match, search_book)
+
+
+    async def get_book_by_id(self, id):
+        return await self._read(self.store.get_book_by_id, id)
+
+
+    async def book_search(self, term, mode='substring', limit=None):
+        return await self._read(self.store.book_search, term, mode, limit)
+
+
+    async def autocomplete(self, prefix, field='title', limit=10):
+        return await self._read(self.store.autocomplete, prefix, field, limit)
+
+
+    async def get_books_by_read_value(self, read):
+        return await self._read(self.store.get_books_by_read_value, read)
+
+
+    async def get_all_books(self):
+        return await self._read(self.store.get_all_books)
+
+
+    async def book_count(self):
+        return await self._read(self.store.book_count)
+
+
+    async def stats(self, top_authors=10):
+        return await self._read(self.store.stats, top_authors)
+
+
+    async def iter_all_books(self, page_size=None):
+        """ Async generator of every book in the store, for use with async for.
+        Books are fetched a page at a time, so a large store is never all in memory, and the event loop can run other
+        tasks between pages.
+        :param page_size how many books to fetch from the database at a time """
+        async for book in self._iter_pages(None, page_size):
+            yield book
+
+
+    async def iter_books_by_read_value(self, read, page_size=None):
+        """ Async generator of the books that have, or have not, been read. See iter_all_books. """
+        async for book in self._iter_pages(read, page_size):
+            yield book
+
+
+    async def _iter_pages(self, read, page_size):
+        after_id = 0
+        while True:
+            books = await self._read(self.store.page, after_id, page_size, read)
+            if not books:
+                return
+            for book in books:
+                yield book
+            after_id = books[-1].id
@@ -0,0 +1,214 @@
+""" Runs reading list commands from a script, without the interactive menu, for maintenance jobs and other programs.
+
+Each line of the script is one command, either as text
+
+    add "The Hobbit" "J.R.R. Tolkien" read
+    search hobbit
+    read 1-5, 8
+    unread 3
+    delete 10 12
+    list unread
+
+or as a JSON object, which can also give the search mode and limit, and mark or delete books matching a search term
+
+    {"command": "add", "title": "The Hobbit", "author": "J.R.R. Tolkien", "read": true}
+    {"command": "search", "term": "tolkein", "mode": "fuzzy", "limit": 5}
+    {"command": "read", "term": "tolkien"}
+
+Blank lines and lines starting with # are skipped.
+The result of each command is written as one line of JSON, with the script's line number, the command, and ok, which is
+false if the command failed, with the error. Commands are run in transactions of group_size commands, so a long script
+runs at the speed of the database, not one commit per command. A command that fails doesn't stop the script or undo
+the other commands in its group. Each group is read before its transaction starts, so a script written slowly to a pipe
+doesn't keep other programs from writing to the database while it waits for more commands. """
+
+import json
+import select
+import shlex
+import sqlite3
+
+from bookstore import Book, BookStore, BookError
+import ui
+
+
+def run_batch(lines, out, group_size=1000):
+    """ Runs every command in lines, and writes the results to out
+    :param lines iterable of lines of the script, for example an open file
+    :param out text file to write results to
+    :param group_size how many commands to run in each transaction, at least 1
+    :returns (number of commands run, number that failed) """
+
+    if group_size < 1:
+        raise ValueError('group_size must be at least 1')
+
+    store = BookStore()
+    commands = 0
+    errors = 0
+    numbered_lines = iter(enumerate(lines, start=1))
+
+    while True:
+        group, more = read_group(numbered_lines, lines, group_size)
+        if group:
+            with store.transaction():
+                for line_number, line in group:
+                    commands += 1
+                    if not run_line(store, line_number, line, out):
+                        errors += 1
+
+        if not more:
+            return commands, errors
+
+
+def read_group(numbered_lines, lines, group_size):
+    """ Reads the next group of commands, skipping blank lines and comments. Stops before group_size commands if lines 
+    is a pipe or terminal with nothing more to read yet, so the commands already read aren't kept waiting. 
+    :returns (list of (line number, line), False if the end of the script was reached) """
+    group = []
+    while len(group) < group_size:
+        if group and not input_waiting(lines):
+            return group, True
+        numbered_line = next(numbered_lines, None)
+        if numbered_line is None:
+            return group, False
+        line_number, line = numbered_line
+        line = line.strip()
+        if line and not line.startswith('#'):
+            group.append( (line_number, line) )
+    return group, True
+
+
+def input_waiting(lines):
+    """ :returns False if lines is a pipe or terminal with nothing to read yet, otherwise True. 
+    Lines already buffered by Python but not by the operating system aren't seen, which only makes a group smaller. """
+    try:
+        readable, writable, errors = select.select([lines.fileno()], [], [], 0)
+    except (AttributeError, OSError, ValueError):
+        return True   # Not a file, like a list or StringIO, or a file select can't check, like any file on Windows 
+    return bool(readable)
+
+
+def run_line(store, line_number, line, out):
+    """ Runs one command from the script and writes its result
+    :returns True if the command succeeded """
+
+    result = { 'line': line_number }
+    try:
+        command = parse_command(line)
+        result['command'] = name = command['command']
+        if name not in COMMANDS:
+            raise ValueError(f'Unknown command {name}')
+        result['ok'] = True
+        COMMANDS[name](store, command, out, result)
+        return True
+    except (BookError, ValueError, IndexError, TypeError, OverflowError, sqlite3.Error) as error:
+        message = str(error)
+    except KeyError as error:
+        message = f'Missing {error}'
+
+    result['ok'] = False
+    result['error'] = message
+    out.write(json.dumps(result) + '\n')
+    return False
+
+
+def parse_command(line):
+    """ Turns one line of a script, as text or JSON, into a dictionary with a command key and the command's arguments """
+
+    if line.startswith('{'):
+        command = json.loads(line)
+        if not isinstance(command, dict):
+            raise ValueError('JSON commands must be objects')
+        command['command'] = str(command.get('command', '')).lower()
+        check_json_arguments(command)
+        return command
+
+    words = shlex.split(line)
+    name = words[0].lower()
+    args = words[1:]
+
+    if name == 'add':
+        if len(args) < 2:
+            raise ValueError('add needs a title and an author')
+        return { 'command': name, 'title': args[0], 'author': args[1], 'read': ui.parse_read(args[2]) if len(args) > 2 else False }
+    if name == 'search':
+        return { 'command': name, 'term': ' '.join(args) }
+    if name in ['read', 'unread', 'delete']:
+        return { 'command': name, 'ids': ui.parse_book_ids(' '.join(args)) }
+    if name == 'list':
+        read = args[0].lower() if args else 'all'
+        if read not in ['all', 'read', 'unread']:
+            raise ValueError(f'List all, read or unread books, not {args[0]}')
+        return { 'command': name, 'read': None if read == 'all' else read == 'read' }
+    return { 'command': name }
+
+
+def check_json_arguments(command):
+    """ Raises ValueError if a JSON command has an argument of the wrong type, 
+    before it gets to the database, which would reject it with a less helpful error """
+    for key in ['title', 'author', 'term', 'mode']:
+        if key in command and not isinstance(command[key], str):
+            raise ValueError(f'{key} must be text')
+    ids = command.get('ids')
+    if ids is not None and not (isinstance(ids, list) and all(type(id) is int for id in ids)):
+        raise ValueError('ids must be a list of whole numbers')
+    limit = command.get('limit')
+    if limit is not None and type(limit) is not int:
+        raise ValueError('limit must be a whole number')
+
+
+def add(store, command, out, result):
+    book = Book(command['title'], command['author'], ui.parse_read(command.get('read')))
+    book.save()
+    result['id'] = book.id
+    out.write(json.dumps(result) + '\n')
+
+
+def search(store, command, out, result):
+    books = store.iter_book_search(command['term'], command.get('mode', 'substring'), command.get('limit'))
+    write_books(out, result, books)
+
+
+def set_read(store, command, out, result):
+    read = command['command'] == 'read'
+    write_batch_result(out, result, store.set_read(read, command.get('ids'), command.get('term')))
+
+
+def delete(store, command, out, result):
+    write_batch_result(out, result, store.delete_books(command.get('ids'), command.get('term')))
+
+
+def list_books(store, command, out, result):
+    read = command.get('read')
+    books = store.iter_all_books() if read is None else store.iter_books_by_read_value(read)
+    write_books(out, result, books)
+
+
+def write_batch_result(out, result, batch_result):
+    result['affected'] = batch_result.affected
+    result['missing'] = batch_result.missing
+    out.write(json.dumps(result) + '\n')
+
+
+def write_books(out, result, books):
+    """ Writes the result with a list of books. The list is written as the books are read, so a long list
+    doesn't have to be in memory all at once. The first book is read before anything is written, so if the query fails, 
+    the error is reported instead of a half written result. """
+    books = iter(books)
+    book = next(books, None)
+    out.write(json.dumps(result)[:-1] + ', "books": [')
+    separator = ''
+    while book is not None:
+        out.write(separator + json.dumps({ 'id': book.id, 'title': book.title, 'author': book.author, 'read': bool(book.read) }))
+        separator = ', '
+        book = next(books, None)
+    out.write(']}\n')
+
+
+COMMANDS = {
+    'add': add,
+    'search': search,
+    'read': set_read,
+    'unread': set_read,
+    'delete': delete,
+    'list': list_books,
+}
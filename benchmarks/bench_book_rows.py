@@ -0,0 +1,58 @@
+""" Measures the time and memory needed to read a large store into Book objects.
+
+    python benchmarks/bench_book_rows.py --rows 1000000
+
+Seeds a temporary database with the requested number of books, then times get_all_books, which builds a list of 
+every Book, and iter_all_books, which builds one Book at a time. Peak memory is measured with tracemalloc,
+in a second run. """
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bookstore
+from bookstore import BookStore
+
+
+def seed(store, rows):
+    store.add_books( (f'Title {n}', f'Author {n % 5000}', n % 3 == 0) for n in range(rows) )
+
+
+def measure(label, rows, fn):
+    """ Runs fn twice, once for time and once under tracemalloc for memory, as tracing slows everything down """
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'{label:16} {elapsed:8.2f} s  {rows / elapsed:12,.0f} rows/s  peak {peak / 2**20:8.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help='how many books to materialize')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bookstore.db = os.path.join(tmp, 'bench_books.db')
+        BookStore.instance = None
+        store = BookStore()
+        seed(store, args.rows)
+
+        measure('get_all_books', args.rows, store.get_all_books)
+        measure('iter_all_books', args.rows, lambda: sum(1 for book in store.iter_all_books()))
+
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
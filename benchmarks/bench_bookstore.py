@@ -0,0 +1,213 @@
+""" Benchmarks every public BookStore operation on synthetic catalogues of different sizes.
+
+    python benchmarks/bench_bookstore.py --sizes 10000 100000 1000000 --json results.json
+    python benchmarks/bench_bookstore.py --sizes 10000 --compare results.json
+
+For each size, a temporary database is seeded with that many generated books, then each operation is run repeatedly.
+The report gives p50, p95 and p99 latency, throughput, and the peak memory used by one call of the operation.
+--json writes the results, with the git commit and library versions, so runs from different commits can be compared.
+--compare prints how much slower or faster each operation is than in an earlier results file. """
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bookstore
+from bookstore import Book, BookStore
+
+
+WORDS = ['river', 'night', 'garden', 'winter', 'stone', 'silver', 'house', 'shadow', 'city', 'glass', 'fire', 'road',
+         'island', 'clock', 'forest', 'letter', 'storm', 'queen', 'mirror', 'harbour', 'song', 'empire', 'bird', 'light']
+
+NAMES = ['Ann', 'Ben', 'Chidi', 'Dana', 'Elif', 'Femi', 'Grace', 'Hiro', 'Ines', 'Jon', 'Kai', 'Lena', 'Mo', 'Nia']
+
+
+def generate_books(size, rng):
+    """ Generator of (title, author, read) tuples. Titles are unique, there are about size / 10 authors. """
+    for n in range(size):
+        title = f'The {rng.choice(WORDS).title()} of {rng.choice(WORDS).title()} {n}'
+        author = f'{rng.choice(NAMES)} {rng.choice(WORDS).title()}son {n % max(size // 10, 1)}'
+        yield title, author, rng.random() < 0.3
+
+
+def misspell(text, rng):
+    """ :returns text with one letter left out, like a typing mistake """
+    n = rng.randrange(len(text))
+    return text[:n] + text[n + 1:]
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def time_operation(operation, iterations):
+    """ Calls operation(n) for n in range(iterations), timing each call, then once more under tracemalloc.
+    :returns dictionary of statistics """
+    latencies = []
+    start = time.perf_counter()
+    for n in range(iterations):
+        call_start = time.perf_counter()
+        operation(n)
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    operation(iterations)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': total / iterations * 1000,
+        'ops_per_sec': iterations / total,
+        'peak_memory_kib': peak_memory / 1024,
+    }
+
+
+def operations(store, size, rng):
+    """ :returns list of (name, function of the iteration number, is it a full scan of the store) """
+
+    ids = [ rng.randint(1, size) for n in range(1000) ]
+    existing = [ store.get_book_by_id(id) for id in ids[:100] ]
+    existing = [ book for book in existing if book ]
+    missing = Book('Not A Title', 'Not An Author')
+    # Books for delete are added first, so deleting doesn't shrink the seeded catalogue
+    to_delete = []
+
+    def save_insert(n):
+        Book(f'Benchmark Insert {n} {rng.random()}', 'Benchmark Author').save()
+
+    def save_update(n):
+        book = existing[n % len(existing)]
+        book.read = not book.read
+        book.save()
+
+    def delete(n):
+        if not to_delete:
+            batch = [ Book(f'Benchmark Delete {n} {m} {rng.random()}', 'Benchmark Author') for m in range(500) ]
+            store.add_books(batch)
+            to_delete.extend(batch)
+        to_delete.pop().delete()
+
+    return [
+        ('save (insert)', save_insert, False),
+        ('save (update)', save_update, False),
+        ('delete', delete, False),
+        ('exact_match (found)', lambda n: store.exact_match(existing[n % len(existing)]), False),
+        ('exact_match (missing)', lambda n: store.exact_match(missing), False),
+        ('get_book_by_id', lambda n: store.get_book_by_id(ids[n % len(ids)]), False),
+        ('book_search (substring)', lambda n: store.book_search(rng.choice(WORDS)), True),
+        ('book_search (words)', lambda n: store.book_search(f'{rng.choice(WORDS)} {rng.choice(NAMES)}', mode='words', limit=50), False),
+        ('book_search (prefix)', lambda n: store.book_search(rng.choice(WORDS)[:3], mode='prefix', limit=50), False),
+        ('book_search (fuzzy)', lambda n: store.book_search(misspell(rng.choice(NAMES) + ' ' + rng.choice(WORDS), rng), mode='fuzzy', limit=10), False),
+        ('autocomplete (title)', lambda n: store.autocomplete(f'The {rng.choice(WORDS).title()[:n % 4 + 1]}'), False),
+        ('autocomplete (author)', lambda n: store.autocomplete(rng.choice(NAMES)[:n % 3 + 1], 'author'), False),
+        ('get_books_by_read_value', lambda n: store.get_books_by_read_value(n % 2 == 0), True),
+        ('get_all_books', lambda n: store.get_all_books(), True),
+        ('book_count', lambda n: store.book_count(), False),
+        ('stats', lambda n: store.stats(), False),
+    ]
+
+
+def run_size(size, iterations, scan_iterations, seed, memory=False):
+    rng = random.Random(seed)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bookstore.db = os.path.join(tmp, f'bench_{size}.db')
+        BookStore.instance = None
+        store = BookStore()
+
+        start = time.perf_counter()
+        store.add_books(generate_books(size, rng))
+        print(f'\n{size:,} books, seeded in {time.perf_counter() - start:.1f} s')
+        if memory:
+            start = time.perf_counter()
+            store.enable_memory_mode()
+            print(f'Loaded into memory in {time.perf_counter() - start:.2f} s')
+        print(f'{"operation":26} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"ops/s":>12} {"peak KiB":>10}')
+
+        for name, operation, full_scan in operations(store, size, rng):
+            stats = time_operation(operation, scan_iterations if full_scan else iterations)
+            stats.update(size=size, operation=name)
+            results.append(stats)
+            print(f'{name:26} {stats["p50_ms"]:10.3f} {stats["p95_ms"]:10.3f} {stats["p99_ms"]:10.3f} '
+                  f'{stats["ops_per_sec"]:12,.1f} {stats["peak_memory_kib"]:10,.1f}')
+
+        store.disable_memory_mode()
+        store.close()
+        BookStore.instance = None
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """ Prints each operation's p50 latency against the same size and operation in an earlier results file """
+    with open(baseline_path) as f:
+        baseline = { (r['size'], r['operation']): r for r in json.load(f)['results'] }
+
+    print(f'\nCompared to {baseline_path}, p50 latency (ratio above 1 is slower)')
+    for result in results:
+        before = baseline.get( (result['size'], result['operation']) )
+        if before and before['p50_ms'] > 0:
+            ratio = result['p50_ms'] / before['p50_ms']
+            print(f'{result["size"]:>9,} {result["operation"]:26} {before["p50_ms"]:10.3f} -> {result["p50_ms"]:10.3f}  x{ratio:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='catalogue sizes to test')
+    parser.add_argument('--iterations', type=int, default=500, help='calls per operation')
+    parser.add_argument('--scan-iterations', type=int, default=10, help='calls per operation for operations that read the whole store')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, so runs use the same data')
+    parser.add_argument('--memory', action='store_true', help='time the store in memory mode, see BookStore.enable_memory_mode')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(size, args.iterations, args.scan_iterations, args.seed, args.memory))
+
+    if args.json:
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'arguments': vars(args),
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
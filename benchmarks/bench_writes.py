@@ -0,0 +1,82 @@
+""" Compares how many Book.save() calls per second the store commits with and without the write queue.
+
+    python benchmarks/bench_writes.py --threads 1 4 16 --writes 2000 --synchronous full
+
+Each run starts with an empty temporary database. Writer threads each save --writes / threads new books, then update
+each of them once. Without the queue, every save is its own transaction. With it, see BookStore.enable_write_queue,
+saves are committed in batches of up to --max-batch, and the threads wait for every Future before the run ends.
+--synchronous full makes each commit wait for the disk, like the write bursts the queue is for. """
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bookstore
+from bookstore import Book, BookStore, StorageProfile
+
+
+def run(threads, writes, queued, max_batch, max_delay):
+    """ :returns writes committed per second """
+    with tempfile.TemporaryDirectory() as tmp:
+        bookstore.db = os.path.join(tmp, 'bench_writes.db')
+        BookStore.instance = None
+        store = BookStore()
+        if queued:
+            store.enable_write_queue(max_batch, max_delay)
+
+        def write(thread):
+            books = [ Book(f'Benchmark {thread} {n}', f'Author {n % 50}') for n in range(writes // threads) ]
+            futures = []
+            for book in books:
+                futures.append(book.save())
+            if queued:
+                for future in futures:
+                    future.result()   # An update needs the book's id
+            for book in books:
+                book.read = True
+                futures.append(book.save())
+            if queued:
+                for future in futures:
+                    future.result()
+
+        workers = [ threading.Thread(target=write, args=(thread, )) for thread in range(threads) ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        count = store.book_count()
+        store.disable_write_queue()
+        store.close()
+        BookStore.instance = None
+
+    return count * 2 / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16], help='numbers of writer threads to test')
+    parser.add_argument('--writes', type=int, default=2000, help='books saved in each run, shared between the threads')
+    parser.add_argument('--max-batch', type=int, default=500, help='write queue batch size')
+    parser.add_argument('--max-delay', type=float, default=0.005, help='seconds the write queue waits to fill a batch')
+    parser.add_argument('--synchronous', default='normal', choices=['off', 'normal', 'full', 'extra'], help='SQLite synchronous setting')
+    args = parser.parse_args()
+
+    bookstore.storage_profile = StorageProfile(synchronous=args.synchronous)
+
+    print(f'{"threads":>8} {"direct writes/s":>16} {"queued writes/s":>16} {"speedup":>8}')
+    for threads in args.threads:
+        direct = run(threads, args.writes, False, args.max_batch, args.max_delay)
+        queued = run(threads, args.writes, True, args.max_batch, args.max_delay)
+        print(f'{threads:>8} {direct:16,.0f} {queued:16,.0f} {queued / direct:7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+""" Load test for the HTTP/JSON API in server.py, over the loopback interface only.
+
+    python benchmarks/load_test_server.py --books 100000 --clients 16 --seconds 10
+    python benchmarks/load_test_server.py --port 8000 --clients 32   # a server already started with main.py serve
+
+Without --port, a server with --workers workers is started in this process on a temporary database seeded with --books
+generated books. Each client thread keeps one connection open and sends a mix of requests: get by id, word search,
+a page of the list, a conditional GET of a page with the ETag it got last time, count, and adds and updates.
+The report gives requests per second, and p50, p95 and p99 latency and errors for each kind of request.
+Clients run in this process too, so on one machine the numbers are a lower bound on what the server can do. """
+
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bookstore
+from bookstore import BookStore
+import server
+from bench_bookstore import WORDS, generate_books, percentile
+
+
+def requests(rng, max_id, client, etags):
+    """ Generator of (kind, method, path, body, headers), the mix of requests each client sends """
+    n = 0
+    while True:
+        n += 1
+        choice = rng.random()
+        if choice < 0.4:
+            yield 'get', 'GET', f'/books/{rng.randint(1, max_id)}', None, {}
+        elif choice < 0.6:
+            yield 'search', 'GET', f'/books/search?q={rng.choice(WORDS)}&mode=words&limit=20', None, {}
+        elif choice < 0.7:
+            yield 'page', 'GET', f'/books?after_id={rng.randint(0, max_id)}&limit=50', None, {}
+        elif choice < 0.8:
+            yield 'conditional', 'GET', '/books?limit=50', None, { 'If-None-Match': etags.get('/books?limit=50', '') }
+        elif choice < 0.9:
+            yield 'count', 'GET', '/books/count?read=false', None, {}
+        elif choice < 0.95:
+            yield 'add', 'POST', '/books', { 'title': f'Load Test {client} {n} {rng.random()}', 'author': 'Load Tester' }, {}
+        else:
+            yield 'update', 'PATCH', f'/books/{rng.randint(1, max_id)}', { 'read': rng.random() < 0.5 }, {}
+
+
+def client(port, seconds, max_id, seed, number, timings, errors):
+    rng = random.Random(seed + number)
+    con = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    etags = {}
+    deadline = time.perf_counter() + seconds
+
+    for kind, method, path, body, headers in requests(rng, max_id, number, etags):
+        if time.perf_counter() > deadline:
+            break
+        start = time.perf_counter()
+        try:
+            con.request(method, path, json.dumps(body) if body else None, headers)
+            response = con.getresponse()
+            response.read()
+            if response.getheader('ETag'):
+                etags[path] = response.getheader('ETag')
+            ok = response.status < 500
+        except (OSError, http.client.HTTPException):
+            con.close()
+            con = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            ok = False
+        timings.setdefault(kind, []).append(time.perf_counter() - start)
+        if not ok:
+            errors[kind] = errors.get(kind, 0) + 1
+
+    con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, help='port of a server already running on 127.0.0.1, instead of starting one')
+    parser.add_argument('--books', type=int, default=100000, help='books to seed the temporary database with')
+    parser.add_argument('--workers', type=int, default=8, help='server worker threads')
+    parser.add_argument('--clients', type=int, default=16, help='client threads, each with one kept-alive connection')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to run for')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        http_server = None
+        if args.port:
+            port = args.port
+            con = http.client.HTTPConnection('127.0.0.1', port)
+            con.request('GET', '/books/count')
+            max_id = max(json.loads(con.getresponse().read())['count'], 1)
+            con.close()
+        else:
+            bookstore.db = os.path.join(tmp, 'load_test.db')
+            BookStore.instance = None
+            BookStore().add_books(generate_books(args.books, random.Random(args.seed)))
+            max_id = args.books
+            http_server = server.BookServer(('127.0.0.1', 0), args.workers)
+            port = http_server.server_port
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+        timings = [ {} for n in range(args.clients) ]
+        errors = [ {} for n in range(args.clients) ]
+        threads = [ threading.Thread(target=client, args=(port, args.seconds, max_id, args.seed, n, timings[n], errors[n]))
+                    for n in range(args.clients) ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if http_server:
+            http_server.shutdown()
+            http_server.server_close()
+            BookStore().close()
+
+    total = sum(len(latencies) for client_timings in timings for latencies in client_timings.values())
+    print(f'\n{args.clients} clients, {total:,} requests in {elapsed:.1f} s, {total / elapsed:,.0f} requests/s')
+    print(f'{"request":12} {"count":>8} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"errors":>8}')
+    for kind in ['get', 'search', 'page', 'conditional', 'count', 'add', 'update']:
+        latencies = sorted( latency for client_timings in timings for latency in client_timings.get(kind, []) )
+        if latencies:
+            failed = sum(client_errors.get(kind, 0) for client_errors in errors)
+            print(f'{kind:12} {len(latencies):8,} {percentile(latencies, 0.5) * 1000:10.2f} '
+                  f'{percentile(latencies, 0.95) * 1000:10.2f} {percentile(latencies, 0.99) * 1000:10.2f} {failed:8,}')
+
+
+if __name__ == '__main__':
+    main()
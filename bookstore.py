@@ -1,34 +1,143 @@
 import sqlite3
+import bisect
+import contextlib
+import copy
+import csv
+import gzip
+import json
+import logging
 import os 
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
 
 db = os.path.join('database', 'books.db')
 
+# How many prepared statements each connection keeps compiled. The store only runs a few dozen distinct queries.
+statement_cache_size = 128
+
+# How many books BookStore.add_books sends to the database in each executemany call
+bulk_batch_size = 5000
+
+# How many rows the iter_ methods fetch from SQLite at a time 
+fetch_batch_size = 500
+
+# Default number of books returned by BookStore.page 
+page_size = 20
+
+# Fuzzy search settings. A word in a search term matches a word in the store if at least this fraction of the trigrams in 
+# either word are in both. Up to fuzzy_word_matches words in the store are tried for each word in the term, and at most 
+# fuzzy_max_candidates books are scored, which keeps searches for very common words quick on large stores. 
+fuzzy_min_similarity = 0.3
+fuzzy_word_matches = 10
+fuzzy_max_candidates = 2000
+
+# Words ignored at the start of titles when checking for duplicate books, for example ('the', 'a', 'an') makes 
+# 'The Hobbit' a duplicate of 'Hobbit'. Call BookStore.rebuild_keys() after changing it, so stored keys match. 
+dedupe_articles = ()
+
+
+class StorageProfile:
+
+    """ SQLite settings applied to every connection the BookStore opens. 
+    The defaults let several processes share one database file: in WAL mode readers don't block writers and writers don't block 
+    readers, and a write that finds the database locked waits, then retries, instead of failing straight away.
+    To change them, set bookstore.storage_profile to a new StorageProfile before the store connects, 
+    or call BookStore().close() after changing it so connections are reopened with the new settings. """
+
+    def __init__(self, journal_mode='wal', synchronous='normal', cache_size=-16000, mmap_size=64 * 2**20, 
+                 busy_timeout=5.0, busy_retries=5, busy_backoff=0.05):
+        """ :param journal_mode SQLite journal mode, 'wal' or 'delete' (SQLite's default), or None to leave the file's mode as it is
+        :param synchronous 'off', 'normal', 'full' or 'extra'. 'normal' is safe in WAL mode, a power cut can lose the 
+        last few commits but can't corrupt the database 
+        :param cache_size page cache size. Positive numbers are pages, negative numbers are KiB 
+        :param mmap_size bytes of the database file to memory map, 0 to not use memory mapped I/O 
+        :param busy_timeout seconds SQLite waits for a lock before giving up with 'database is locked' 
+        :param busy_retries how many times the store retries a write that failed because the database was locked 
+        :param busy_backoff seconds to wait before the first retry. Each retry waits twice as long as the one before """
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+
+
+    def apply(self, con):
+        """ Sets this profile's pragmas on a connection. Call before starting any transaction. """
+        if self.journal_mode:
+            con.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+        con.execute(f'PRAGMA synchronous = {self.synchronous}')
+        con.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        con.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        con.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+
+
+    def __repr__(self):
+        return f'StorageProfile {vars(self)}'
+
+
+
+# Settings for every connection, see StorageProfile
+storage_profile = StorageProfile()
+
+
+
 class Book:
 
     """ Represents one book in the program. 
     Before books are saved, create without ID then call save() method to save to DB and create an ID. 
     Future calls to save() will update the database record for the book with this id. """
 
+    # Books have no __dict__, just these four attributes. Queries can create a very large number of Books, 
+    # and this makes each one smaller and faster to create. 
+    __slots__ = ('title', 'author', 'read', 'id')
+
     def __init__(self, title, author, read=False, id=None):
         self.title = title 
         self.author = author
         self.read = read 
         self.id = id
 
-        self.bookstore = BookStore()
+
+    @property
+    def bookstore(self):
+        """ The BookStore is only needed to save or delete a book, so it's looked up then, not stored in every Book """
+        return BookStore()
 
 
     def save(self):
         '''Saves a new book to the database if the Book object does not have an Book.id property. If the Book object
-        does have a Book.id property then calling save() will update the database entry for the Book.id'''
+        does have a Book.id property then calling save() will update the database entry for the Book.id
+        If the store's write queue is on, see BookStore.enable_write_queue, the save is queued and a Future is returned, 
+        which gives the book's id when the save is committed, or raises BookError.'''
+        store = self.bookstore
+        if store._write_queue_active():
+            return store._write_queue.submit(Book.save, self)
+
         if self.id:
-            self.bookstore._update_book(self)
+            store._update_book(self)
         else:
-            self.bookstore._add_book(self)
+            store._add_book(self)
 
 
     def delete(self):
-        self.bookstore._delete_book(self)
+        '''Deletes the book from the database. If the store's write queue is on, returns a Future like save()'''
+        store = self.bookstore
+        if store._write_queue_active():
+            return store._write_queue.submit(Book.delete, self)
+
+        store._delete_book(self)
 
 
     def __str__(self):
@@ -71,16 +180,592 @@ class BookStore:
     class __BookStore:
 
         def __init__(self):
-            create_table_sql = 'CREATE TABLE IF NOT EXISTS books (title TEXT, author TEXT, read BOOLEAN, UNIQUE( title COLLATE NOCASE, author COLLATE NOCASE))'
-        
-            con = sqlite3.connect(db)
-        
-            with con:
-                con.execute(create_table_sql)
-
+            self._local = threading.local()   # Each thread gets its own connection, stored here 
+            self._lock = threading.Lock()
+            self._connections = {}   # thread ident -> connection, so close() can reach every thread's connection 
+            self._initialized_paths = set()   # database files that have had their schema created 
+            self._generation = 0   # Incremented by close() and restore(), so threads know to discard their old connection 
+            self._cache = None   # A _QueryCache when enable_cache has been called 
+            self._instrumentation = None   # An _Instrumentation when enable_instrumentation has been called 
+            self._instrumentation_version = 0   # Incremented when instrumentation settings change, so connections update their callbacks 
+            self._memory = None   # A _MemoryMode when enable_memory_mode has been called 
+            self._write_queue = None   # A _WriteQueue when enable_write_queue has been called 
+            
+            self._connection()   # Connect now so the schema is created when the store is created 
+
+
+        def _connection(self):
+            """ Returns this thread's connection to the database, opening it if needed. 
+            Connections are kept open and reused for every call made by the thread, so the file is opened, the 
+            schema parsed and each statement compiled once rather than on every call.
+            If bookstore.db has been changed since the connection was opened, for example by the tests, the old 
+            connection is closed and a new one opened to the new database file. In memory mode, the connection is to 
+            the in-memory copy of the database. 
+            :returns a sqlite3 Connection for the current thread """
+
+            local = self._local
+            con = getattr(local, 'con', None)
+            memory = self._memory
+            path = memory.uri if memory else db
+
+            if con is not None and local.path == path and local.generation == self._generation:
+                return con 
+
+            if con is not None:
+                self._release(con)
+
+            con = sqlite3.connect(path, timeout=storage_profile.busy_timeout, cached_statements=statement_cache_size, 
+                                  check_same_thread=False, uri=memory is not None)
+            storage_profile.apply(con)
+
+            with self._lock:
+                if path not in self._initialized_paths:
+                    self._create_schema(con)
+                    self._initialized_paths.add(path)
+                self._prune_dead_threads()
+                self._connections[threading.get_ident()] = con
+
+            local.con = con
+            local.path = path 
+            local.generation = self._generation
+            local.data_version = None   # Not checked yet on this connection, see _check_data_version 
+            local.instrumentation_version = 0   # No trace or progress callbacks set yet 
+            return con 
+
+
+        def _create_schema(self, con):
+            """ Brings the database schema up to date by running any migrations the database hasn't had yet. 
+            The schema version is stored in the database file's user_version, so existing databases, 
+            including ones made before versioning was added, are upgraded in place. """
+
+            _migrate(con)
+            self.full_text_search = con.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts'").fetchone() is not None
+
+
+        def _release(self, con):
+            """ Close a connection that is no longer the current one for this thread """
+            with self._lock:
+                if self._connections.get(threading.get_ident()) is con:
+                    del self._connections[threading.get_ident()]
             con.close()
+            self._local.con = None
+
+
+        def _prune_dead_threads(self):
+            """ Close connections belonging to threads that have finished. Call with self._lock held. """
+            alive = {thread.ident for thread in threading.enumerate()}
+            for ident in list(self._connections):
+                if ident not in alive:
+                    self._connections.pop(ident).close()
+
+
+        def close(self):
+            """ Closes every connection the store has open, in all threads. 
+            The store can still be used afterwards, new connections are opened when they are next needed. 
+            Writes in the write queue are committed first, and the queue stays on. 
+            In memory mode, writes that haven't been saved yet are written to the database file first, 
+            and the store stays in memory mode. """
+            write_queue = self._write_queue
+            if write_queue is not None:
+                write_queue.wait()
+            self.flush()
+            with self._lock:
+                self._generation += 1
+                connections = list(self._connections.values())
+                self._connections.clear()
+
+            for con in connections:
+                con.close()
+
+            self._local.con = None
             
 
+        def backup(self, destination, pages_per_step=256, progress=None, step_pause=0):
+            """ Copies the database to another file while the store is in use. The copy is made with SQLite's backup API, 
+            a few pages at a time, so other threads and programs can read and write between steps. If the database is 
+            changed by another connection during the backup, the copy starts again, so it always matches one committed state. 
+            The copy is written to destination.partial and renamed when it's complete, so an interrupted backup never 
+            replaces a good one. 
+            :param destination path of the file to write. An existing file is replaced 
+            :param pages_per_step how many pages to copy in each step, or -1 to copy everything in one step 
+            :param progress if given, called after each step with the number of pages copied and the total 
+            :param step_pause seconds to wait between steps, to leave more time for other connections 
+            :returns destination """
+
+            if os.path.abspath(destination) == os.path.abspath(db):
+                raise BookError('Can\'t back up the database to itself')
+
+            self.flush()   # In memory mode, back up the file with every write made so far 
+
+            partial = destination + '.partial'
+            source = sqlite3.connect(db, timeout=storage_profile.busy_timeout)
+            try:
+                target = sqlite3.connect(partial)
+                try:
+                    report = (lambda status, remaining, total: progress(total - remaining, total)) if progress else None
+                    source.backup(target, pages=pages_per_step, progress=report, sleep=step_pause)
+                finally:
+                    target.close()
+                os.replace(partial, destination)
+            except:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            finally:
+                source.close()
+
+            return destination
+
+
+        def snapshot(self, directory, keep=None, **backup_options):
+            """ Backs up the database to a new file in directory, named after the database and the time, 
+            like books-20240131-235959-123456.db, and deletes the oldest snapshots if there are more than keep. 
+            Run it from cron with python main.py snapshot, or in the background with schedule_snapshots. 
+            :param keep how many snapshots to keep, including the new one, or None to keep them all 
+            :param backup_options pages_per_step, progress and step_pause, as for backup 
+            :returns the path of the new snapshot """
+
+            os.makedirs(directory, exist_ok=True)
+            name, extension = os.path.splitext(os.path.basename(db))
+            path = os.path.join(directory, f'{name}-{datetime.now():%Y%m%d-%H%M%S-%f}{extension}')
+            self.backup(path, **backup_options)
+
+            if keep is not None:
+                snapshots = self.snapshots(directory)
+                for old in snapshots[:max(len(snapshots) - keep, 0)]:
+                    os.remove(old)
+            return path
+
+
+        def snapshots(self, directory):
+            """ :returns paths of the snapshots of this database in directory, oldest first """
+            name, extension = os.path.splitext(os.path.basename(db))
+            pattern = re.compile(re.escape(name) + r'-\d{8}-\d{6}-\d{6}' + re.escape(extension) + '$')
+            if not os.path.isdir(directory):
+                return []
+            return [ os.path.join(directory, file) for file in sorted(os.listdir(directory)) if pattern.match(file) ]
+
+
+        def schedule_snapshots(self, directory, interval, keep=None, **backup_options):
+            """ Takes a snapshot every interval seconds in a background thread, until the returned SnapshotSchedule's 
+            stop method is called. Snapshots that fail are logged, and the next one is still taken. 
+            :returns the running SnapshotSchedule """
+            schedule = SnapshotSchedule(lambda: self.snapshot(directory, keep, **backup_options), interval)
+            schedule.start()
+            return schedule
+
+
+        def _reconnect(self):
+            """ Makes every thread open a new connection the next time it uses the store, for example after switching to or 
+            from memory mode. Unlike close(), the old connections aren't closed here, so a thread part way through reading 
+            books can finish. Each thread closes its own old connection in _connection. """
+            with self._lock:
+                self._generation += 1
+
+
+        def restore(self, source):
+            """ Replaces every book in the store with the books in a backup or snapshot. The backup is checked first, 
+            then copied into the database in one step, so other connections see either the old books or the restored ones, 
+            never a mix. Writes in the write queue are committed before the copy. Each thread reopens its connection the next 
+            time it uses the store, so a thread part way through reading books finishes reading the old ones. The restored 
+            database's schema is brought up to date if the backup is from an older version. 
+            Anyone syncing with changes_since must reload, since their copy may have changes the backup doesn't. 
+            Raises BookError if source isn't a reading list database, or if called inside a transaction() block. 
+            :param source path of the backup to restore """
+
+            if getattr(self._local, 'transaction_depth', 0):
+                raise BookError('Can\'t restore inside a transaction')
+            if self._memory is not None:
+                raise BookError('Can\'t restore in memory mode, call disable_memory_mode first')
+            if not os.path.isfile(source):
+                raise BookError(f'No backup at {source}')
+
+            backup = sqlite3.connect(f'file:{_file_uri_path(source)}?mode=ro', uri=True)
+            try:
+                try:
+                    ok = backup.execute('PRAGMA quick_check').fetchone()[0] == 'ok'
+                    ok = ok and backup.execute("SELECT 1 FROM sqlite_master WHERE name = 'books'").fetchone() is not None
+                except sqlite3.DatabaseError:
+                    ok = False
+                if not ok:
+                    raise BookError(f'{source} is not a reading list database')
+
+                write_queue = self._write_queue
+                if write_queue is not None:
+                    write_queue.wait()
+                last_seq = self.change_seq()
+                target = sqlite3.connect(db, timeout=storage_profile.busy_timeout)
+                try:
+                    backup.backup(target)
+                finally:
+                    target.close()
+            finally:
+                backup.close()
+
+            with self._lock:
+                self._initialized_paths.discard(db)   # The backup may need migrating 
+            self._reconnect()
+            self._write(lambda con: _restart_change_journal(con, last_seq))
+            self._data_changed()
+
+
+        def enable_write_queue(self, max_batch=500, max_delay=0.005):
+            """ Turns on group commit. From now on Book.save() and Book.delete() put the write in a queue and return a Future 
+            straight away. One writer thread takes writes from the queue and commits them in batches, so a burst of writes 
+            from many threads shares one transaction, and one sync to disk, instead of each paying for its own. 
+            Writes are committed in the order they were queued. Each write runs in its own savepoint, so one that fails, 
+            like saving a duplicate book, only fails its own Future. A Future's result is set once its batch is committed.
+            Saves and deletes inside a transaction() block aren't queued, they're part of the block's transaction. 
+            :param max_batch the most writes committed in one transaction 
+            :param max_delay seconds the writer waits for more writes after the first write in a batch, before committing """
+            self.disable_write_queue()
+            self._write_queue = _WriteQueue(self, max_batch, max_delay)
+
+
+        def disable_write_queue(self):
+            """ Waits for every queued write to be committed, then goes back to saving each write as it's made """
+            write_queue = self._write_queue
+            if write_queue is not None:
+                self._write_queue = None
+                write_queue.stop()
+
+
+        def _write_queue_active(self):
+            """ :returns True if this thread's saves and deletes should go in the write queue """
+            return self._write_queue is not None and not getattr(self._local, 'transaction_depth', 0)
+
+
+        def enable_cache(self, max_size=1000, ttl=None):
+            """ Turns on caching of get_book_by_id, book_count and book_search results. 
+            The cache is cleared whenever the store changes, including changes made by other processes using the same database file.
+            :param max_size the most results to keep. The least recently used result is dropped when the cache is full.
+            :param ttl if given, results are only used for this many seconds after they were cached """
+            self._cache = _QueryCache(max_size, ttl)
+
+
+        def disable_cache(self):
+            self._cache = None
+
+
+        def cache_stats(self):
+            """ :returns a dictionary with the cache's hits, misses, current size and max_size, or None if caching is off """
+            cache = self._cache
+            if cache is None:
+                return None
+            return { 'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries), 'max_size': cache.max_size }
+
+
+        def _cached(self, key, query):
+            """ Returns the cached result for key. If not cached, calls query() and caches what it returns. 
+            Results should be plain data like row tuples, not Books, so callers can't change the cached copy. 
+            :param key a hashable key identifying the query and its parameters 
+            :param query function that runs the query and returns its result """
+
+            cache = self._cache
+            if cache is None or getattr(self._local, 'transaction_depth', 0):
+                return query()   # Results inside a transaction() block might not be committed, so other threads mustn't see them 
+
+            self._check_data_version(cache)
+
+            found, result = cache.get(key)
+            if found:
+                return result 
+
+            generation = cache.generation
+            result = query()
+            cache.put(key, result, generation)
+            return result 
+
+
+        def _check_data_version(self, cache):
+            """ Clears the cache if another connection, in this process or another one, has changed the database since this thread last looked.
+            SQLite's data_version goes up when any other connection commits a change. It is per connection, so a thread's first 
+            check can't know what happened before, and clears the cache to be safe. """
+            
+            data_version = self._connection().execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._local.data_version:
+                cache.clear()
+                self._local.data_version = data_version
+
+
+        def _data_changed(self):
+            """ Call after committing any change to the books table """
+            if self._cache is not None:
+                self._cache.clear()
+
+            memory = self._memory
+            if memory is not None and memory.durability == 'immediate' and not getattr(self._local, 'transaction_depth', 0):
+                self.flush()
+
+
+        def enable_memory_mode(self, flush_interval=5.0, durability='buffered'):
+            """ Copies the database into memory, and serves every query from the copy from now on, so reads never wait for 
+            the disk. Writes are made to the copy, then saved to the database file by flush, which replays the change journal. 
+            The file stays the real store: it's saved to when memory mode is turned off or the store is closed, and 
+            backups are made from it. 
+            Memory mode assumes this store is the only thing writing to the database file while it's on. 
+            Threads share the copy, but unlike the file, a thread writing to it waits for other threads' reads to finish, 
+            and reads wait for writes, so don't keep an iter_ generator open in one thread while another thread writes. 
+            Needs SQLite 3.36 or later. 
+            :param flush_interval with durability 'buffered', writes are saved to the file every flush_interval seconds 
+            in a background thread. None to only save when flush is called, the store is closed, or memory mode is turned off 
+            :param durability 'buffered' to return from writes before they are saved to the file, so a crash can lose up to 
+            flush_interval seconds of writes, or 'immediate' to save each write, or each transaction() block, to the file 
+            before returning """
+
+            if durability not in ['buffered', 'immediate']:
+                raise ValueError(f'Unknown durability {durability}')
+            if sqlite3.sqlite_version_info < (3, 36, 0):
+                raise BookError(f'Memory mode needs SQLite 3.36 or later, this is SQLite {sqlite3.sqlite_version}')
+            if getattr(self._local, 'transaction_depth', 0):
+                raise BookError('Can\'t change to memory mode inside a transaction')
+
+            self.disable_memory_mode()
+            if self._write_queue is not None:
+                self._write_queue.wait()   # Queued writes go to the file before it's copied 
+            self._connection()   # Make sure the file's schema is up to date before copying it 
+
+            memory = _MemoryMode(durability)
+            memory.disk = sqlite3.connect(db, timeout=storage_profile.busy_timeout, check_same_thread=False)
+            storage_profile.apply(memory.disk)
+            memory.disk.execute(f"VACUUM INTO '{memory.uri}'")   # Not the backup API, which would copy the file's WAL mode, which memdb can't use 
+            memory.flushed_seq = _change_seq(memory.con)
+
+            with self._lock:
+                self._initialized_paths.add(memory.uri)
+            self._memory = memory
+            self._reconnect()   # Every thread reconnects, to the copy 
+
+            if durability == 'buffered' and flush_interval:
+                memory.flusher = _RepeatingTask(self.flush, flush_interval, 'bookstore-flush')
+                memory.flusher.start()
+
+
+        def disable_memory_mode(self):
+            """ Saves any writes not yet in the database file, then goes back to reading and writing the file. """
+            memory = self._memory
+            if memory is None:
+                return
+            if memory.flusher is not None:
+                memory.flusher.stop()
+            if self._write_queue is not None:
+                self._write_queue.wait()
+
+            self.flush()   # If saving fails, the store stays in memory mode, so the writes aren't lost 
+            self._memory = None
+            self._reconnect()   # Every thread reconnects, to the file 
+            self._flush(memory)   # Writes made while switching 
+            memory.close()
+
+
+        def flush(self):
+            """ In memory mode, saves the writes made since the last flush to the database file, in one transaction. 
+            If saving fails, the writes stay in memory and are tried again by the next flush. 
+            :returns the number of changes saved, 0 if not in memory mode """
+
+            memory = self._memory
+            if memory is None:
+                return 0
+            return self._flush(memory)
+
+
+        def _flush(self, memory):
+            with memory.lock:
+                # Read through memory.con, which only sees committed changes, not a transaction() block in progress 
+                changes = memory.con.execute('SELECT seq, operation, book, title, author, read FROM book_changes WHERE seq > ? ORDER BY seq', 
+                                             (memory.flushed_seq, ) ).fetchall()
+                if not changes:
+                    return 0
+
+                disk = memory.disk
+                disk.execute('BEGIN IMMEDIATE')
+                try:
+                    _apply_changes(disk, changes)
+                    disk.commit()
+                except:
+                    disk.rollback()
+                    raise
+
+                memory.flushed_seq = changes[-1][0]
+                logger.debug('Saved %d changes to %s', len(changes), db)
+                return len(changes)
+
+
+        def enable_instrumentation(self, slow_query_seconds=None, trace=False, progress=None, progress_steps=1000):
+            """ Starts recording every SQL statement the store runs: how long it took, how many rows it returned or changed,
+            and which method ran it. See query_stats and add_query_hook.
+            A query's rows are counted and timed as they are fetched, so results still stream, and the query is recorded 
+            once they have all been read, or when its cursor is closed or thrown away. 
+            :param slow_query_seconds if given, statements that take at least this long are logged as warnings 
+            with their EXPLAIN QUERY PLAN output
+            :param trace if True, SQLite's trace callback logs the text of every statement SQLite runs, including those 
+            run by triggers, at debug level
+            :param progress if given, SQLite calls this function every progress_steps virtual machine instructions 
+            while a statement runs. If it returns a true value the statement is interrupted. """
+
+            hooks = self._instrumentation.hooks if self._instrumentation else []
+            self._instrumentation = _Instrumentation(slow_query_seconds, trace, progress, progress_steps)
+            self._instrumentation.hooks = hooks
+            self._instrumentation_version += 1
+
+
+        def disable_instrumentation(self):
+            """ Stops recording statements, and removes all query hooks """
+            self._instrumentation = None
+            self._instrumentation_version += 1
+
+            with self._lock:
+                for con in self._connections.values():
+                    con.set_trace_callback(None)
+                    con.set_progress_handler(None, 0)
+
+
+        def add_query_hook(self, hook):
+            """ Calls hook with a QueryEvent after every SQL statement the store runs. Turns instrumentation on if it isn't already. 
+            Hooks are called on the thread that ran the statement, and should be quick. """
+            if self._instrumentation is None:
+                self.enable_instrumentation()
+            self._instrumentation.hooks.append(hook)
+
+
+        def remove_query_hook(self, hook):
+            if self._instrumentation is not None and hook in self._instrumentation.hooks:
+                self._instrumentation.hooks.remove(hook)
+
+
+        def query_stats(self):
+            """ :returns a dictionary of the statements run by each method since instrumentation was turned on. For each method, 
+            the number of statements, rows, total and slowest time in seconds, and a histogram of statement times. 
+            Returns None if instrumentation is off. """
+            if self._instrumentation is None:
+                return None
+            return self._instrumentation.report()
+
+
+        def _execute(self, con, sql, params=(), many=False, method=None):
+            """ Runs a statement on con, the same as con.execute, or con.executemany if many is True. 
+            All of the store's queries go through here so they can be instrumented. 
+            Statements are recorded under the outermost public method in this module that led to them, like get_all_books or save. 
+            :param method the name to record the statement under if there's no public method in the call stack, for example when a 
+            generator from iter_all_books is used by another module. Defaults to the name of the method that called _execute. 
+            :returns the cursor """
+
+            instrumentation = self._instrumentation
+            if instrumentation is None:
+                if many:
+                    return con.executemany(sql, params)
+                return con.execute(sql, params)
+
+            if self._local.instrumentation_version != self._instrumentation_version:
+                instrumentation.apply_callbacks(con)
+                self._local.instrumentation_version = self._instrumentation_version
+
+            return instrumentation.execute(con, sql, params, many, _calling_method(method))
+
+
+        def _write(self, operation, retry=True):
+            """ Runs operation(con) in a write transaction on this thread's connection and commits it. 
+            The transaction starts with BEGIN IMMEDIATE, so the write lock is taken before anything is changed. If another 
+            connection holds the lock for longer than the busy timeout, the transaction is rolled back and tried again after 
+            a pause, doubling the pause each time, up to storage_profile.busy_retries times. 
+            Inside a transaction() block, operation runs in a savepoint in that block's transaction instead, and is committed 
+            with the rest of the block. If it fails, only its own changes are rolled back. 
+            :param operation function that takes the connection and makes the changes
+            :param retry False if operation can't be run twice, for example because it reads from a generator. Then only 
+            starting the transaction is retried.
+            :returns what operation returns """
+
+            profile = storage_profile
+            con = self._connection()
+
+            if getattr(self._local, 'transaction_depth', 0):
+                self._execute(con, 'SAVEPOINT write')
+                try:
+                    result = operation(con)
+                except:
+                    self._execute(con, 'ROLLBACK TO write')
+                    self._execute(con, 'RELEASE write')
+                    raise
+                self._execute(con, 'RELEASE write')
+                return result 
+
+            for attempt in range(profile.busy_retries + 1):
+                started = False
+                try:
+                    self._execute(con, 'BEGIN IMMEDIATE')
+                    started = True
+                    result = operation(con)
+                    con.commit()
+                    return result 
+                except sqlite3.OperationalError as e:
+                    if con.in_transaction:
+                        con.rollback()
+                    if not _is_busy_error(e) or attempt == profile.busy_retries or (started and not retry):
+                        raise
+                    _pause_before_retry(attempt, e)
+                except:
+                    if con.in_transaction:
+                        con.rollback()
+                    raise
+
+
+        @contextlib.contextmanager
+        def transaction(self):
+            """ Groups writes into one transaction, for example 
+                with store.transaction():
+                    for book in books:
+                        book.save()
+            Everything saved or deleted in the block, on this thread, is committed together when the block ends, which is much 
+            faster than committing each one. If the block raises an exception, all of its changes are rolled back. A write that 
+            raises an error inside the block, like saving a duplicate book, only undoes its own changes, so the block can carry on. 
+            Reads on this thread inside the block see its changes before they are committed. 
+            Blocks can be nested. An inner block is part of the outer block's transaction, in a savepoint, so if it raises an 
+            exception only the inner block's changes are rolled back. """
+
+            local = self._local
+            if getattr(local, 'transaction_depth', 0):
+                con = self._connection()
+                savepoint = f'transaction_{local.transaction_depth}'
+                self._execute(con, f'SAVEPOINT {savepoint}')
+                local.transaction_depth += 1
+                try:
+                    yield self
+                except:
+                    self._execute(con, f'ROLLBACK TO {savepoint}')
+                    self._execute(con, f'RELEASE {savepoint}')
+                    raise
+                else:
+                    self._execute(con, f'RELEASE {savepoint}')
+                finally:
+                    local.transaction_depth -= 1
+                return
+
+            con = self._connection()
+            for attempt in range(storage_profile.busy_retries + 1):
+                try:
+                    self._execute(con, 'BEGIN IMMEDIATE')
+                    break
+                except sqlite3.OperationalError as e:
+                    if not _is_busy_error(e) or attempt == storage_profile.busy_retries:
+                        raise
+                    _pause_before_retry(attempt, e)
+
+            local.transaction_depth = 1
+            try:
+                yield self
+            except:
+                con.rollback()
+                local.transaction_depth = 0
+                self._data_changed()
+                raise
+            else:
+                con.commit()
+                local.transaction_depth = 0
+                self._data_changed()
+            finally:
+                local.transaction_depth = 0
+
+
         # method names prefaced by _ indicate that they are only to be used internally. There's nothing stopping anything else
         # calling _add_book and _update_book but it would go against the intentions of the program to do so. 
         # _add_book and _update book are called by the Book class's save method, and are used to create or update a book's info in the database.
@@ -95,20 +780,23 @@ class BookStore:
 
         def _add_book(self, book):
             """ Adds book to store. 
-            Raises BookError if a book with exact author and title (not case sensitive) is already in the store.
+            Raises BookError if a book with the same author and title is already in the store, ignoring case, accents 
+            written different ways, and extra spaces, see _book_keys.
             :param book the Book to add """
             
-            insert_sql = 'INSERT INTO books (title, author, read) VALUES (?, ?, ?)'
+            insert_sql = 'INSERT INTO books (title, author, read, title_key, author_key) VALUES (?, ?, ?, ?, ?)'
+
+            def insert(con):
+                res = self._execute(con, insert_sql, (book.title, book.author, book.read, *_book_keys(book.title, book.author)) )
+                self._index_words(con, [book])
+                return res.lastrowid  # Get the ID of the new row in the table 
 
             try: 
-                with sqlite3.connect(db) as con:
-                    res = con.execute(insert_sql, (book.title, book.author, book.read) )
-                    new_id = res.lastrowid  # Get the ID of the new row in the table 
-                    book.id = new_id  # Set this book's ID
+                book.id = self._write(insert)  # Set this book's ID
             except sqlite3.IntegrityError as e:
                 raise BookError(f'Error - this book is already in the database. {book}') from e
-            finally:
-                con.close()
+
+            self._data_changed()
 
 
         def _update_book(self, book):
@@ -120,13 +808,19 @@ class BookStore:
             if not book.id:
                 raise BookError('Book does not have ID, can\'t update')
 
-            update_read_sql = 'UPDATE books SET title = ?, author = ?, read = ? WHERE rowid = ?'
+            def update(con):
+                keys = _book_keys(book.title, book.author)
+                rowcount = self._execute(con, _update_book_sql, (book.title, book.author, book.read, *keys, book.id) ).rowcount
+                if rowcount:
+                    self._index_words(con, [book])
+                return rowcount 
 
-            with sqlite3.connect(db) as con:
-                updated = con.execute(update_read_sql, (book.title, book.author, book.read, book.id) )
-                rows_modfied = updated.rowcount
-                
-            con.close()
+            try:
+                rows_modfied = self._write(update)
+            except sqlite3.IntegrityError as e:
+                raise BookError(f'Error - another book with this title and author is already in the database. {book}') from e
+
+            self._data_changed()
             
             if rows_modfied == 0:
                 raise BookError(f'Book with id {book.id} not found')
@@ -141,13 +835,13 @@ class BookStore:
 
             delete_sql = 'DELETE FROM books WHERE rowid = ?'
 
-            with sqlite3.connect(db) as con:
-                deleted = con.execute(delete_sql, (book.id, ) )
-                deleted_count = deleted.rowcount  # rowcount = how many rows affected by the query
-            con.close()
+            # rowcount = how many rows affected by the query
+            deleted_count = self._write(lambda con: self._execute(con, delete_sql, (book.id, ) ).rowcount)
+
+            self._data_changed()
 
             if deleted_count == 0:
-                raise BookError(f'Book with id {id} not found in store.')
+                raise BookError(f'Book with id {book.id} not found in store.')
 
 
         def delete_all_books(self):
@@ -155,27 +849,82 @@ class BookStore:
 
             delete_all_sql = "DELETE FROM books"
 
-            with sqlite3.connect(db) as con:
-                deleted = con.execute(delete_all_sql)
+            self._write(lambda con: self._execute(con, delete_all_sql))
 
-            con.close()
+            self._data_changed()
            
 
+        def set_read(self, read, ids=None, term=None):
+            """ Marks many books as read, or not read, with one UPDATE statement in one transaction. 
+            Give either ids, or term to change every book that book_search(term) would find.
+            :param read True to mark the books as read, False for not read
+            :param ids any iterable of book ids, for example a list or a range 
+            :param term a search term, matches part of a title or author, not case sensitive. Raises ValueError if it's blank
+            :returns a BatchResult with the ids of the books that were changed, and any ids that were not found """
+
+            update_sql = 'UPDATE books SET read = ? WHERE rowid IN (SELECT id FROM batch_ids)'
+            result = self._write(lambda con: self._batch(con, ids, term, update_sql, (bool(read), ) ))
+            self._data_changed()
+            return result 
+
+
+        def delete_books(self, ids=None, term=None):
+            """ Deletes many books with one DELETE statement in one transaction. 
+            Give either ids, or term to delete every book that book_search(term) would find. 
+            :param ids any iterable of book ids, for example a list or a range 
+            :param term a search term, matches part of a title or author, not case sensitive. Raises ValueError if it's blank
+            :returns a BatchResult with the ids of the books that were deleted, and any ids that were not found """
+
+            delete_sql = 'DELETE FROM books WHERE rowid IN (SELECT id FROM batch_ids)'
+            result = self._write(lambda con: self._batch(con, ids, term, delete_sql))
+            self._data_changed()
+            return result 
+
+
+        def _batch(self, con, ids, term, sql, params=()):
+            """ Collects the ids of the books to change in the temporary table batch_ids, then runs sql, which should use 
+            batch_ids to choose its rows. Call inside a write transaction. 
+            :returns a BatchResult """
+
+            if (ids is None) == (term is None):
+                raise ValueError('Give either ids or term')
+            if term is not None and not term.strip():
+                raise ValueError('term can\'t be blank, it would match every book')
+
+            self._execute(con, 'CREATE TEMP TABLE IF NOT EXISTS batch_ids (id INTEGER PRIMARY KEY)')
+            self._execute(con, 'DELETE FROM batch_ids')
+
+            if ids is not None:
+                self._execute(con, 'INSERT OR IGNORE INTO batch_ids (id) VALUES (?)', ( (id, ) for id in ids ), many=True)
+                # Each id is looked up by rowid, so this takes time proportional to the number of ids, not the size of the store 
+                missing_sql = 'SELECT id FROM batch_ids WHERE NOT EXISTS (SELECT 1 FROM books WHERE rowid = batch_ids.id) ORDER BY id'
+                missing = [ id for id, in self._execute(con, missing_sql) ]
+                self._execute(con, 'DELETE FROM batch_ids WHERE NOT EXISTS (SELECT 1 FROM books WHERE rowid = batch_ids.id)')
+            else:
+                search = f'%{term}%'
+                self._execute(con, 'INSERT INTO batch_ids (id) SELECT rowid FROM books WHERE title LIKE ? OR author LIKE ?', (search, search) )
+                missing = []
+
+            affected = [ id for id, in self._execute(con, 'SELECT id FROM batch_ids ORDER BY id') ]
+            self._execute(con, sql, params)
+
+            return BatchResult(affected, missing)
+
 
         def exact_match(self, search_book):
-            """ Searches bookstore for a book with exact same title and author. Not case sensitive.
+            """ Searches bookstore for a book with exact same title and author. Not case sensitive, and accents and spaces 
+            are compared the same way as when checking for duplicates, see _book_keys.
              :param search_book: the book to search for
              :returns: True if a book with same author and title are found in the store, False otherwise. """
             
-            find_exact_match_sql = 'SELECT * FROM books WHERE UPPER(title) = UPPER(?) AND UPPER(author) = UPPER(?)'
+            # One lookup in the books_key index 
+            find_exact_match_sql = 'SELECT 1 FROM books WHERE title_key = ? AND author_key = ?'
             
-            con = sqlite3.connect(db)
-            rows = con.execute(find_exact_match_sql, (search_book.title, search_book.author) )
+            con = self._connection()
+            rows = self._execute(con, find_exact_match_sql, _book_keys(search_book.title, search_book.author) )
             first_book = rows.fetchone()
             found = first_book is not None
 
-            con.close() 
-
             return found
 
 
@@ -185,46 +934,179 @@ class BookStore:
             :returns the book, if found, or None if book not found.
             """
          
-            get_book_by_id_sql = 'SELECT rowid, * FROM books WHERE rowid = ?'
+            get_book_by_id_sql = 'SELECT rowid, title, author, read FROM books WHERE rowid = ?'
 
-            con = sqlite3.connect(db) 
-            con.row_factory = sqlite3.Row  # This row_factory allows access to data by row name 
-            rows = con.execute(get_book_by_id_sql, (id,) )
-            book_data = rows.fetchone()  # Get first result 
+            book_data = self._cached( ('get_book_by_id', id), 
+                lambda: self._execute(self._connection(), get_book_by_id_sql, (id,) ).fetchone() )  # Get first result 
             
             if book_data:
-                book = Book(book_data['title'], book_data['author'], book_data['read'], book_data['rowid'])
-
+                return Book(book_data[1], book_data[2], book_data[3], book_data[0])
 
+            return None 
 
-                    
-            con.close()            
-            
-            return book 
 
-
-        def book_search(self, term):
+        def book_search(self, term, mode='substring', limit=None):
             """ Searches the store for books whose author or title contain a search term. Case insensitive.
-            Makes partial matches, so a search for 'row' will match a book with author='JK Rowling' and a book with title='Rowing For Dummies'
+            In the default 'substring' mode, makes partial matches, so a search for 'row' will match a book with author='JK Rowling' 
+            and a book with title='Rowing For Dummies'. This has to check every book in the store. 
+            The 'words' and 'prefix' modes use the full text index, so they are fast on large stores, and return the best matches first.
+            'words' matches books containing all of the words in the term, so 'rowling' matches 'JK Rowling' but 'row' does not.
+            'prefix' matches books with words starting with each word in the term, so 'row' matches 'JK Rowling' and 'Rowing For Dummies'.
+            If SQLite was built without full text search, 'words' and 'prefix' searches are done the same way as 'substring'.
+            'fuzzy' allows for typing mistakes, so 'rowlng' finds 'JK Rowling' and 'tolkein' finds 'J.R.R. Tolkien'. It uses a 
+            trigram index of the words in the store and the full text index, and returns the closest matches first. 
+            If SQLite was built without full text search, 'fuzzy' searches are also done the same way as 'substring'. 
             :param term the search term
+            :param mode 'substring', 'words', 'prefix' or 'fuzzy'
+            :param limit the maximum number of books to return, or None for all matches 
             :returns a list of books with author or title that match the search term. The list will be empty if there are no matches.
             """
- 
-            search_sql = 'SELECT rowid, * FROM books WHERE UPPER(title) like UPPER(?) OR UPPER(author) like UPPER(?)'
-
-            search = f'%{term}%'   # Example - if searching for text with 'bOb' in then use '%bOb%' in SQL
-
-            con = sqlite3.connect(db) 
-            con.row_factory = sqlite3.Row
-            rows = con.execute(search_sql, (search, search) )
-            books = []
-            for r in rows:
-                book = Book(r['title'], r['author'], r['read'], r['rowid'])
-                books.append(book)
-
-            con.close()            
-            
-            return books
+            if self._cache is None:
+                return list(self.iter_book_search(term, mode, limit))
+
+            rows = self._cached( ('book_search', term, mode, limit), 
+                lambda: [ (book.id, book.title, book.author, book.read) for book in self.iter_book_search(term, mode, limit) ] )
+            return [ Book(title, author, read, rowid) for rowid, title, author, read in rows ]
+
+
+        def iter_book_search(self, term, mode='substring', limit=None):
+            """ Same as book_search, but returns a generator that reads matching books from the database as they are needed. 
+            :returns a generator of books with author or title that match the search term """
+
+            if mode not in ['substring', 'words', 'prefix', 'fuzzy']:
+                raise ValueError(f'Unknown search mode {mode}')
+
+            if mode == 'fuzzy' and self.full_text_search:
+                return iter(self._fuzzy_search(term, limit))
+
+            if limit is None:
+                limit = -1   # In SQLite, a negative LIMIT means no limit 
+
+            if mode == 'substring' or not self.full_text_search:
+                # LIKE is already case insensitive, so there's no need to convert title and author to upper case 
+                search_sql = 'SELECT rowid, title, author, read FROM books WHERE title LIKE ? OR author LIKE ? LIMIT ?'
+                search = f'%{term}%'   # Example - if searching for text with 'bOb' in then use '%bOb%' in SQL
+                return self._iter_books(search_sql, (search, search, limit), 'iter_book_search')
+
+            match = _fts_query(term, prefix=(mode == 'prefix'))
+            if not match:
+                return iter([])
+
+            # bm25 ranks books by how well they match. Smaller numbers are better matches. 
+            search_sql = ('SELECT books.rowid, books.title, books.author, books.read FROM books_fts '
+                          'JOIN books ON books.rowid = books_fts.rowid '
+                          'WHERE books_fts MATCH ? ORDER BY bm25(books_fts) LIMIT ?')
+            return self._iter_books(search_sql, (match, limit), 'iter_book_search')
+
+
+        def _fuzzy_search(self, term, limit):
+            """ Finds the books with words most like the words in the search term. 
+            Each word in the term is matched to the most similar words in the store's vocabulary with the trigram index, 
+            then the full text index finds books with those words. Books with a word like each word in the term are found first. 
+            If there aren't enough, books with a word like the term's rarest word are added, so a search doesn't read every 
+            book with a common word like 'the'. Books are ranked by how many of the term's words they match, then by the 
+            average similarity of their closest words. 
+            :returns a list of books, closest match first """
+
+            con = self._connection()
+            term_words = sorted(set(_words(term)))
+
+            # The trigrams are passed as a JSON array, so the statement text is the same for every search and stays cached 
+            similar_words_sql = ('SELECT word, shared * 1.0 / (? + trigram_count - shared) AS similarity FROM '
+                                 '(SELECT word, COUNT(*) AS shared FROM fuzzy_trigrams WHERE trigram IN (SELECT value FROM json_each(?)) GROUP BY word) '
+                                 'JOIN fuzzy_words USING (word) WHERE similarity >= ? ORDER BY similarity DESC, word LIMIT ?')
+            # Counts the books matching, but stops counting at fuzzy_max_candidates
+            count_sql = 'SELECT COUNT(*) FROM (SELECT 1 FROM books_fts WHERE books_fts MATCH ? LIMIT ?)'
+
+            matches = []   # For each word in the term with similar words in books, (number of books, FTS5 query, similar words)
+            for word in term_words:
+                if word.isdigit():
+                    similar = { word: 1.0 }   # Numbers aren't in the vocabulary, they have to match exactly 
+                else:
+                    trigrams = _trigrams(word)
+                    similar = dict(self._execute(con, similar_words_sql, 
+                        (len(trigrams), json.dumps(sorted(trigrams)), fuzzy_min_similarity, fuzzy_word_matches) ))
+                if similar:
+                    match = ' OR '.join( f'"{similar_word}"' for similar_word in similar )
+                    book_count = self._execute(con, count_sql, (match, fuzzy_max_candidates) ).fetchone()[0]
+                    if book_count:
+                        matches.append( (book_count, match, similar) )
+
+            if not matches:
+                return []
+
+            every_word = ' AND '.join( f'({match})' for book_count, match, similar in matches )
+            rarest_word = min(matches, key=lambda match: match[0])[1]
+
+            candidates_sql = ('SELECT books.rowid, books.title, books.author, books.read FROM books_fts '
+                              'JOIN books ON books.rowid = books_fts.rowid WHERE books_fts MATCH ? LIMIT ?')
+            rows = {}
+            for match in [every_word, rarest_word] if len(matches) > 1 else [rarest_word]:
+                if limit is not None and len(rows) >= limit:
+                    break
+                for row in self._execute(con, candidates_sql, (match, fuzzy_max_candidates) ):
+                    rows.setdefault(row[0], row)
+
+            def closeness(row):
+                rowid, title, author, read = row 
+                words = set(_words(f'{title} {author}'))
+                closest = [ max( (similarity for word, similarity in similar.items() if word in words), default=0 ) 
+                            for book_count, match, similar in matches ]
+                return (-sum(1 for similarity in closest if similarity), -sum(closest), rowid)
+
+            ranked = sorted(rows.values(), key=closeness)
+            if limit is not None:
+                ranked = ranked[:limit]
+
+            return [ Book(title, author, read, rowid) for rowid, title, author, read in ranked ]
+
+
+        def autocomplete(self, prefix, field='title', limit=10):
+            """ Suggests titles or authors that start with what the user has typed so far. Not case sensitive.
+            Uses the indexes on title and author, so each suggestion is found by jumping to the next entry in the index 
+            instead of reading every book. An author of many books is only suggested once, and only one index lookup is 
+            needed to skip past all of their books. 
+            :param prefix the start of a title or author 
+            :param field 'title' or 'author' 
+            :param limit the most suggestions to return 
+            :returns a list of up to limit titles or authors, in alphabetical order """
+
+            if field not in ['title', 'author']:
+                raise ValueError(f'Can\'t autocomplete {field}')
+
+            prefix = prefix.lstrip()
+            if not prefix:
+                return []
+
+            # Everything starting with the prefix sorts after the prefix, and before the prefix followed by the 
+            # largest Unicode character. COLLATE NOCASE lets SQLite use the index, which has the same collation. 
+            next_sql = (f'SELECT {field} FROM books WHERE {field} > ? COLLATE NOCASE AND {field} < ? COLLATE NOCASE '
+                        f'ORDER BY {field} COLLATE NOCASE LIMIT 1')
+            end = prefix + '\U0010ffff'
+
+            con = self._connection()
+            suggestions = []
+            row = self._execute(con, f'SELECT {field} FROM books WHERE {field} = ? COLLATE NOCASE LIMIT 1', (prefix, ) ).fetchone()
+            if row:
+                suggestions.append(row[0])
+
+            after = prefix
+            while len(suggestions) < limit:
+                row = self._execute(con, next_sql, (after, end) ).fetchone()
+                if row is None:
+                    break
+                suggestions.append(row[0])
+                after = row[0]
+
+            return suggestions
+
+
+        def query(self):
+            """ Starts a BookQuery, for combining a search with filters on title, author, read and id, ordering and paging 
+            in one SQL statement, for example 
+                store.query().read(False).author('tolkien').order_by('title').limit(20).all()
+            :returns a BookQuery that matches every book """
+            return BookQuery(self)
 
 
         def get_books_by_read_value(self, read):
@@ -232,57 +1114,401 @@ class BookStore:
             :param read True to find all books that have been read, False to find all books that have not been read
             :returns all books with the read value.
             """
+            return list(self.iter_books_by_read_value(read))
 
-            get_book_by_id_sql = 'SELECT rowid, * FROM books WHERE read = ?'
 
-            con = sqlite3.connect(db) 
-            con.row_factory = sqlite3.Row
-            rows = con.execute(get_book_by_id_sql, (read, ) )
-        
-            books = []
-
-            for r in rows:
-                book = Book(r['title'], r['author'], r['read'], r['rowid'])
-                books.append(book)
+        def iter_books_by_read_value(self, read):
+            """ Same as get_books_by_read_value, but returns a generator that reads books from the database as they are needed.
+            :param read True to find all books that have been read, False to find all books that have not been read
+            :returns a generator of books with the read value """
 
-            con.close()            
-            
-            return books
+            get_books_by_read_sql = 'SELECT rowid, title, author, read FROM books WHERE read = ?'
+            return self._iter_books(get_books_by_read_sql, (bool(read), ), 'iter_books_by_read_value')   # Uses the books_read index 
 
 
         def get_all_books(self):
             """ :returns entire book list """
-    
-            get_all_books_sql = 'SELECT rowid, * FROM books'
-
-            con = sqlite3.connect(db)
-            con.row_factory = sqlite3.Row
-            rows = con.execute(get_all_books_sql)
-            books = []
-
-            for r in rows:
-                book = Book(r['title'], r['author'], r['read'], r['rowid'])
-                books.append(book)
-
-            con.close()            
-            
-            return books
+            return list(self.iter_all_books())
+
+
+        def iter_all_books(self):
+            """ Generator of every book in the store, read from the database as they are needed. 
+            Unlike get_all_books, the first book is available straight away and the whole store is never in memory at once.
+            :returns a generator of all the books, in id order """
+
+            get_all_books_sql = 'SELECT rowid, title, author, read FROM books ORDER BY rowid'
+            return self._iter_books(get_all_books_sql, method='iter_all_books')
+
+
+        def page(self, after_id=0, limit=None, read=None):
+            """ Gets one page of books, in id order, for showing a long list a page at a time.
+            Pages start from an id rather than an offset, so every page is found with an index lookup and takes 
+            the same time to get, however far through the list it is. 
+            To get the next page, call again with after_id set to the id of the last book on this page. 
+            :param after_id only books with an id greater than this are returned. 0 for the first page. 
+            :param limit the maximum number of books on the page, defaults to page_size
+            :param read True for only books that have been read, False for only unread books, None for all books 
+            :returns a list of up to limit books. An empty list means there are no more books. """
+
+            limit = limit or page_size
+
+            if read is None:
+                page_sql = 'SELECT rowid, title, author, read FROM books WHERE rowid > ? ORDER BY rowid LIMIT ?'
+                params = (after_id, limit)
+            else:
+                page_sql = 'SELECT rowid, title, author, read FROM books WHERE read = ? AND rowid > ? ORDER BY rowid LIMIT ?'
+                params = (bool(read), after_id, limit)
+
+            return list(self._iter_books(page_sql, params))
+
+
+        def export(self, destination, format='csv', compress=False, read=None, term=None, progress=None, progress_every=10000):
+            """ Writes books to a file as CSV, JSON lines or SQL INSERT statements. 
+            Rows are written as they are read from the database, so memory use stays the same however many books there are.
+            CSV and JSON lines files can be read back with main.py import. The SQL dump recreates the books table, 
+            and can be loaded with the sqlite3 command line tool. 
+            :param destination a file name, or a file object. File objects should be opened in text mode, 
+            or binary mode if compress is True 
+            :param format 'csv', 'jsonl' or 'sql'
+            :param compress if True, gzip the output 
+            :param read True to export only books that have been read, False for only unread books, None for all 
+            :param term if given, only export books that book_search(term) would find 
+            :param progress function called with the number of books written so far, every progress_every books and at the end
+            :returns the number of books written """
+
+            if format not in ['csv', 'jsonl', 'sql']:
+                raise ValueError(f'Unknown export format {format}')
+
+            conditions = []
+            params = []
+            if read is not None:
+                conditions.append('read = ?')
+                params.append(bool(read))
+            if term is not None:
+                conditions.append('(title LIKE ? OR author LIKE ?)')
+                params.extend([f'%{term}%'] * 2)
+            where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+            if format == 'sql':
+                # quote() makes each value into an SQL literal, with any quotes in it escaped 
+                export_sql = f'SELECT rowid, quote(title), quote(author), quote(read) FROM books {where} ORDER BY rowid'
+            else:
+                export_sql = f'SELECT rowid, title, author, read FROM books {where} ORDER BY rowid'
+
+            if isinstance(destination, (str, os.PathLike)):
+                opener = gzip.open if compress else open
+                out = opener(destination, 'wt', encoding='utf-8', newline='')
+            elif compress:
+                out = gzip.open(destination, 'wt', encoding='utf-8', newline='')
+            else:
+                out = destination
+
+            cursor = self._execute(self._connection(), export_sql, params)
+            count = 0
+            try:
+                if format == 'csv':
+                    writer = csv.writer(out)
+                    writer.writerow(['id', 'title', 'author', 'read'])
+                    write_rows = lambda rows: writer.writerows( (id, title, author, 'true' if read else 'false') for id, title, author, read in rows )
+                elif format == 'jsonl':
+                    write_rows = lambda rows: out.writelines( 
+                        json.dumps({ 'id': id, 'title': title, 'author': author, 'read': bool(read) }) + '\n' for id, title, author, read in rows )
+                else:
+                    out.write('BEGIN TRANSACTION;\n')
+                    out.write('CREATE TABLE IF NOT EXISTS books (title TEXT, author TEXT, read BOOLEAN, UNIQUE( title COLLATE NOCASE, author COLLATE NOCASE));\n')
+                    write_rows = lambda rows: out.writelines( 
+                        f'INSERT INTO books (rowid, title, author, read) VALUES ({id}, {title}, {author}, {read});\n' for id, title, author, read in rows )
+
+                while True:
+                    rows = cursor.fetchmany(fetch_batch_size)
+                    if not rows:
+                        break
+                    write_rows(rows)
+                    next_report = (count // progress_every + 1) * progress_every
+                    count += len(rows)
+                    if progress and count >= next_report:
+                        progress(count)
+
+                if format == 'sql':
+                    out.write('COMMIT;\n')
+            finally:
+                cursor.close()
+                if out is not destination:
+                    out.close()
+
+            if progress:
+                progress(count)
+
+            return count
+
+
+        def _iter_books(self, sql, params=(), method=None):
+            """ Runs a query that selects rowid, title, author and read, and yields a Book for each row. 
+            Rows are fetched from SQLite fetch_batch_size at a time. The cursor is closed when the generator 
+            finishes, or is closed or garbage collected part way through. 
+            :param method the public method that returned this generator, for instrumentation """
+
+            cursor = self._execute(self._connection(), sql, params, method=method)
+            try:
+                while True:
+                    rows = cursor.fetchmany(fetch_batch_size)
+                    if not rows:
+                        break
+                    for rowid, title, author, read in rows:
+                        yield Book(title, author, read, rowid)
+            finally:
+                cursor.close()
 
 
         def book_count(self):
             """ :returns the number of books in the store """
             
-            count_books_sql = 'SELECT COUNT(*) FROM books'
+            # book_totals is kept up to date by triggers, so this doesn't have to count the rows in books 
+            count_books_sql = 'SELECT books FROM book_totals'
 
-            con = sqlite3.connect(db)
-            count = con.execute(count_books_sql)
-            total = count.fetchone()[0]    # fetchone() returns the first row of the results. This is a tuple with one element - the count 
-            
-            con.close()            
+            # fetchone() returns the first row of the results. This is a tuple with one element - the count 
+            total = self._cached( ('book_count', ), lambda: self._execute(self._connection(), count_books_sql).fetchone()[0] )
                 
             return total
 
 
+        def stats(self, top_authors=10):
+            """ Reading statistics, read from the summary tables that triggers keep up to date, so this takes the same 
+            time however many books there are. Authors are counted without case, so 'jane austen' and 'Jane Austen' 
+            are the same author. 
+            :param top_authors how many of the authors with the most books to include 
+            :returns a dictionary with the number of books, read books, unread books and authors, and top_authors, 
+            a list of dictionaries with the author, their number of books and number read, most books first """
+
+            totals_sql = 'SELECT books, read, authors FROM book_totals'
+            top_authors_sql = 'SELECT author, books, read FROM author_stats ORDER BY books DESC, author LIMIT ?'
+
+            def query():
+                con = self._connection()
+                return self._execute(con, totals_sql).fetchone(), self._execute(con, top_authors_sql, (top_authors, ) ).fetchall()
+
+            (books, read, authors), top = self._cached( ('stats', top_authors), query )
+
+            return { 
+                'books': books, 'read': read, 'unread': books - read, 'authors': authors, 
+                'top_authors': [ { 'author': author, 'books': author_books, 'read': author_read } for author, author_books, author_read in top ] 
+            }
+
+
+        def check_stats(self):
+            """ Counts the books again from the books table, and compares the counts with the summary tables used by stats. 
+            They should always match, unless the triggers were dropped or the tables were changed by hand. 
+            This reads every book, so it's slow on a large store. 
+            :returns a list of descriptions of the counts that don't match, empty if everything is right """
+
+            con = self._connection()
+            problems = []
+
+            totals_sql = "SELECT COUNT(*), IFNULL(SUM(read IS 1), 0), (SELECT COUNT(DISTINCT author COLLATE NOCASE) FROM books) FROM books"
+            actual = self._execute(con, totals_sql).fetchone()
+            stored = self._execute(con, 'SELECT books, read, authors FROM book_totals').fetchone()
+            for name, actual_count, stored_count in zip(['books', 'read', 'authors'], actual, stored):
+                if actual_count != stored_count:
+                    problems.append(f'Total {name} is {stored_count}, should be {actual_count}')
+
+            # Every author whose counts are wrong, or who is only in one of books and author_stats 
+            authors_sql = ('SELECT author, SUM(actual_books), SUM(actual_read), SUM(stored_books), SUM(stored_read) FROM ('
+                           '  SELECT author COLLATE NOCASE AS author, 1 AS actual_books, read IS 1 AS actual_read, 0 AS stored_books, 0 AS stored_read FROM books '
+                           '  UNION ALL SELECT author, 0, 0, books, read FROM author_stats'
+                           ') GROUP BY author HAVING SUM(actual_books) != SUM(stored_books) OR SUM(actual_read) != SUM(stored_read) ORDER BY author')
+            for author, actual_books, actual_read, stored_books, stored_read in self._execute(con, authors_sql):
+                problems.append(f'{author} has {stored_books} books, {stored_read} read, should be {actual_books} books, {actual_read} read')
+
+            return problems
+
+
+        def rebuild_keys(self):
+            """ Works out every book's duplicate checking keys again, for example after changing dedupe_articles. 
+            If books that were different are now duplicates, the newest ones are left without keys, so they aren't 
+            found by exact_match. They can still be saved, and their keys are only worked out and checked for duplicates 
+            again when their title or author is changed. 
+            :returns the ids of those books """
+            duplicates = self._write_maintenance(_backfill_keys)
+            self._data_changed()
+            return duplicates
+
+
+        def rebuild_stats(self):
+            """ Recounts everything in the summary tables used by stats from the books table """
+            self._write_maintenance(_rebuild_stats)
+            self._data_changed()
+
+
+        def changes_since(self, seq=0, limit=None):
+            """ The changes made to the store after a point in the change journal, for keeping a copy of the reading list 
+            up to date without reading every book. Every book added, updated or deleted, by any method or program, is 
+            recorded by triggers with a sequence number that is larger than every number before it. 
+            To sync, apply each change in order and remember the last seq, then next time ask for the changes since that seq. 
+            changes_since(0) gives every book in the store, unless compact_changes has dropped any changes. 
+            Raises ChangesCompactedError if changes after seq have been dropped, then the copy should be reloaded. 
+            :param seq the seq of the last change already applied, 0 for all changes 
+            :param limit the most changes to return, or None for all of them 
+            :returns a generator of BookChanges, in seq order, read from the database as they are needed """
+
+            con = self._connection()
+            compacted_seq = self._execute(con, 'SELECT seq FROM book_changes_compacted').fetchone()[0]
+            if seq < compacted_seq:
+                raise ChangesCompactedError(f'Changes up to {compacted_seq} are no longer in the journal, reload instead of getting changes since {seq}')
+
+            changes_sql = ('SELECT seq, operation, book, title, author, read, time FROM book_changes '
+                           'WHERE seq > ? ORDER BY seq LIMIT ?')
+            return self._iter_changes(changes_sql, (seq, -1 if limit is None else limit) )
+
+
+        def _iter_changes(self, sql, params):
+            cursor = self._execute(self._connection(), sql, params, method='changes_since')
+            try:
+                while True:
+                    rows = cursor.fetchmany(fetch_batch_size)
+                    if not rows:
+                        break
+                    for seq, operation, id, title, author, read, time in rows:
+                        yield BookChange(seq, operation, Book(title, author, read, id), time)
+            finally:
+                cursor.close()
+
+
+        def change_seq(self):
+            """ :returns the seq of the latest change to the store, or 0 if there haven't been any. 
+            To start syncing a copy, get this in the same thread, before copying the books with get_all_books. """
+            row = self._execute(self._connection(), "SELECT seq FROM sqlite_sequence WHERE name = 'book_changes'").fetchone()
+            return row[0] if row else 0
+
+
+        def compact_changes(self, before_seq=None):
+            """ Makes the change journal smaller. Changes to a book that have been followed by a later change to the same book 
+            are dropped. A copy that is up to date isn't affected. A copy synced to before a dropped change can't skip it safely: 
+            applying the later changes in a different order can, for example, give two books the same title and author for a 
+            while. So changes_since raises ChangesCompactedError for a seq before the last dropped change, and copies that far 
+            behind must be reloaded. 
+            :param before_seq if given, every change with a seq up to and including this is dropped as well, and 
+            changes_since raises ChangesCompactedError for a seq before before_seq 
+            :returns the number of changes dropped """
+
+            superseded_sql = 'FROM book_changes WHERE seq < (SELECT MAX(seq) FROM book_changes AS later WHERE later.book = book_changes.book)'
+
+            def compact(con):
+                last_dropped_seq = self._execute(con, f'SELECT MAX(seq) {superseded_sql}').fetchone()[0] or 0
+                dropped = self._execute(con, f'DELETE {superseded_sql}').rowcount
+                if before_seq is not None:
+                    dropped += self._execute(con, 'DELETE FROM book_changes WHERE seq <= ?', (before_seq, ) ).rowcount
+                    last_dropped_seq = max(last_dropped_seq, before_seq)
+                self._execute(con, 'UPDATE book_changes_compacted SET seq = MAX(seq, ?)', (last_dropped_seq, ) )
+                return dropped
+
+            return self._write_maintenance(compact)
+
+
+        def _write_maintenance(self, operation):
+            """ Runs operation(con) with _write, for maintenance that changes more than the books, like rebuild_stats. 
+            In memory mode, flush only saves changes to books, so operation is run on the database file as well, after 
+            saving the writes waiting to be flushed, so both copies start the same. 
+            Raises BookError in memory mode inside a transaction() block, which couldn't roll back the file's changes. 
+            :returns what operation returns for this thread's connection """
+
+            memory = self._memory
+            if memory is None:
+                return self._write(operation)
+            if getattr(self._local, 'transaction_depth', 0):
+                raise BookError('Can\'t run maintenance inside a transaction in memory mode')
+
+            self.flush()
+            with memory.lock:
+                disk = memory.disk
+                disk.execute('BEGIN IMMEDIATE')
+                try:
+                    operation(disk)
+                    disk.commit()
+                except:
+                    disk.rollback()
+                    raise
+            return self._write(operation)
+
+
+        def add_books(self, books, batch_size=None):
+            """ Adds many books to the store in one transaction. Much faster than calling save() on each book.
+            Books are sent to the database in batches with executemany. Books already in the store (same title and author, 
+            not case sensitive), or repeated earlier in the same import, are not added and don't stop the import, 
+            they are reported in the result's duplicates list.
+            :param books any iterable of Book objects or (title, author) or (title, author, read) tuples. Can be a generator.
+            :param batch_size how many books to insert per batch, defaults to bulk_batch_size
+            :returns an ImportResult. Books that were added have their id set. """
+
+            batch_size = batch_size or bulk_batch_size
+            result = ImportResult()
+
+            self._connection().execute('CREATE TEMP TABLE IF NOT EXISTS import_staging '
+                                       '(seq INTEGER PRIMARY KEY, title TEXT, author TEXT, read BOOLEAN, title_key TEXT, author_key TEXT)')
+
+            def import_books(con):
+                batch = []
+                for book in books:
+                    if not isinstance(book, Book):
+                        book = Book(*book)
+                    batch.append(book)
+                    if len(batch) >= batch_size:
+                        self._add_book_batch(con, batch, result)
+                        batch = []
+
+                if batch:
+                    self._add_book_batch(con, batch, result)
+
+            self._write(import_books, retry=False)   # books may be a generator, so it can't be read twice 
+            self._data_changed()
+
+            return result
+
+
+        def _add_book_batch(self, con, batch, result):
+            """ Inserts one batch of books for add_books, inside add_books' transaction. 
+            The batch is copied into a temporary staging table, then inserted into books with INSERT OR IGNORE so duplicates 
+            are skipped. New rows are joined back to the staging rows to find each book's id. Any staging row without a 
+            new book is a duplicate. """
+
+            self._execute(con, 'DELETE FROM import_staging')
+            self._execute(con, 'INSERT INTO import_staging (seq, title, author, read, title_key, author_key) VALUES (?, ?, ?, ?, ?, ?)', 
+                ( (seq, book.title, book.author, book.read, *_book_keys(book.title, book.author)) for seq, book in enumerate(batch) ), many=True)
+
+            # New rows are always given a rowid larger than every existing rowid, so rows above this are from this batch 
+            max_rowid = self._execute(con, 'SELECT IFNULL(MAX(rowid), 0) FROM books').fetchone()[0]
+
+            self._execute(con, 'INSERT OR IGNORE INTO books (title, author, read, title_key, author_key) '
+                               'SELECT title, author, read, title_key, author_key FROM import_staging ORDER BY seq')
+
+            new_rows_sql = ('SELECT s.seq, b.rowid FROM import_staging s JOIN books b '
+                            'ON b.title_key = s.title_key AND b.author_key = s.author_key '
+                            'WHERE b.rowid > ? ORDER BY s.seq')
+
+            ids = {}   # seq -> rowid. If a book is in the batch twice, the first one is the one that was inserted
+            claimed = set()
+            for seq, rowid in self._execute(con, new_rows_sql, (max_rowid, ) ):
+                if rowid not in claimed:
+                    ids[seq] = rowid
+                    claimed.add(rowid)
+
+            for seq, book in enumerate(batch):
+                if seq in ids:
+                    book.id = ids[seq]
+                    result.added += 1
+                else:
+                    result.duplicates.append(book)
+
+            self._index_words(con, [ book for seq, book in enumerate(batch) if seq in ids ])
+
+
+        def _index_words(self, con, books):
+            """ Adds any new words in the books' titles and authors to the fuzzy search vocabulary. 
+            Call inside the write transaction that added or updated the books. 
+            :param books list of Books """
+            _index_words(con, [ f'{book.title} {book.author}' for book in books ], 
+                lambda sql, params, many=False: self._execute(con, sql, params, many))
+
+
     def __new__(cls):
         """ The __new__ magic method handles object creation. (Compare to __init__ which initializes an object.) 
         If there's already a Bookstore instance, return that. If not, then create a new one
@@ -302,6 +1528,1011 @@ class BookStore:
 
 
 
+def _migrate(con):
+    """ Runs each migration the database is missing, in order, each in its own transaction. 
+    BEGIN IMMEDIATE stops two processes running the same migration at the same time. 
+    :param con connection to the database to upgrade """
+
+    for version, migration in enumerate(_migrations, start=1):
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            current_version = con.execute('PRAGMA user_version').fetchone()[0]
+            if current_version < version:
+                migration(con)
+                con.execute(f'PRAGMA user_version = {version}')
+            con.commit()
+        except:
+            con.rollback()
+            raise
+
+
+def _migration_create_books_table(con):
+    # Databases from before schema versioning already have this table
+    con.execute('CREATE TABLE IF NOT EXISTS books (title TEXT, author TEXT, read BOOLEAN, UNIQUE( title COLLATE NOCASE, author COLLATE NOCASE))')
+
+
+def _migration_full_text_search(con):
+    """ Creates the books_fts full text index over book titles and authors, and the triggers that keep it in step 
+    with the books table, then adds any existing books to it. Does nothing if this SQLite library was built without FTS5. """
+
+    # books_fts is an external content table - it indexes the text in books without storing a second copy of it
+    create_index_sql = "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(title, author, content='books')"
+
+    create_triggers_sql = [
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author);
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.rowid, new.title, new.author);
+        END''' 
+    ]
+
+    try:
+        con.execute(create_index_sql)
+    except sqlite3.OperationalError:
+        return   # no such module: fts5
+
+    for sql in create_triggers_sql:
+        con.execute(sql)
+
+    con.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+
+def _migration_read_index(con):
+    # For get_books_by_read_value. exact_match uses the index SQLite made for the UNIQUE constraint 
+    con.execute('CREATE INDEX IF NOT EXISTS books_read ON books (read)')
+
+
+def _migration_fuzzy_search_index(con):
+    """ Creates the trigram index for fuzzy search, and adds the words in the existing books to it. 
+    fuzzy_words is every word that has been in a title or author, and fuzzy_trigrams has the trigrams of each word. 
+    Trigrams are stored once for each word, not for each book, so the index stays small, and adding a book whose words 
+    are already in the store doesn't change it. The full text index is used to find books with a word. 
+    Words are only added, never removed. A word that is no longer in any book doesn't match any books, so it doesn't 
+    change search results. """
+
+    # WITHOUT ROWID tables are stored in their primary key's index, so looking up a trigram reads one index 
+    con.execute('CREATE TABLE IF NOT EXISTS fuzzy_words (word TEXT PRIMARY KEY, trigram_count INTEGER) WITHOUT ROWID')
+    con.execute('CREATE TABLE IF NOT EXISTS fuzzy_trigrams (trigram TEXT, word TEXT, PRIMARY KEY (trigram, word)) WITHOUT ROWID')
+
+    books = con.execute("SELECT title || ' ' || author FROM books")
+    while True:
+        batch = books.fetchmany(bulk_batch_size)
+        if not batch:
+            break
+        _index_words(con, [ text for text, in batch ], 
+            lambda sql, params, many=False: con.executemany(sql, params) if many else con.execute(sql, params))
+
+
+def _migration_author_index(con):
+    # For autocompleting authors. Titles are autocompleted with the UNIQUE constraint's index, which starts with title 
+    con.execute('CREATE INDEX IF NOT EXISTS books_author ON books (author COLLATE NOCASE)')
+
+
+def _migration_stats_tables(con):
+    """ Creates the summary tables used by BookStore.stats, and the triggers that keep them up to date as books are added, 
+    changed and deleted, then counts the existing books. 
+    book_totals has one row, with the number of books, read books and authors. author_stats has a row for each author. 
+    Authors are compared without case, the same as in the UNIQUE constraint. """
+
+    con.execute('CREATE TABLE IF NOT EXISTS book_totals (id INTEGER PRIMARY KEY CHECK (id = 1), books INTEGER, read INTEGER, authors INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS author_stats (author TEXT PRIMARY KEY COLLATE NOCASE, books INTEGER, read INTEGER) WITHOUT ROWID')
+    con.execute('CREATE INDEX IF NOT EXISTS author_stats_books ON author_stats (books DESC, author)')   # For the top authors, in order 
+
+    # 'read IS 1' is 1 for read books and 0 for anything else, even NULL 
+    create_triggers_sql = [
+        '''CREATE TRIGGER IF NOT EXISTS book_stats_insert AFTER INSERT ON books BEGIN
+            UPDATE book_totals SET books = books + 1, read = read + (new.read IS 1);
+            INSERT OR IGNORE INTO author_stats (author, books, read) VALUES (new.author, 0, 0);
+            UPDATE author_stats SET books = books + 1, read = read + (new.read IS 1) WHERE author = new.author;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS book_stats_delete AFTER DELETE ON books BEGIN
+            UPDATE book_totals SET books = books - 1, read = read - (old.read IS 1);
+            UPDATE author_stats SET books = books - 1, read = read - (old.read IS 1) WHERE author = old.author;
+            DELETE FROM author_stats WHERE author = old.author AND books = 0;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS book_stats_update AFTER UPDATE OF author, read ON books BEGIN
+            UPDATE book_totals SET read = read - (old.read IS 1) + (new.read IS 1);
+            UPDATE author_stats SET books = books - 1, read = read - (old.read IS 1) WHERE author = old.author;
+            DELETE FROM author_stats WHERE author = old.author AND books = 0;
+            INSERT OR IGNORE INTO author_stats (author, books, read) VALUES (new.author, 0, 0);
+            UPDATE author_stats SET books = books + 1, read = read + (new.read IS 1) WHERE author = new.author;
+        END''',
+        # Triggers on author_stats count the authors, since the triggers on books can't tell if they added or removed an author
+        '''CREATE TRIGGER IF NOT EXISTS author_stats_insert AFTER INSERT ON author_stats BEGIN
+            UPDATE book_totals SET authors = authors + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS author_stats_delete AFTER DELETE ON author_stats BEGIN
+            UPDATE book_totals SET authors = authors - 1;
+        END''',
+    ]
+
+    for sql in create_triggers_sql:
+        con.execute(sql)
+
+    _rebuild_stats(con)
+
+
+def _rebuild_stats(con):
+    """ Counts the books, read books and each author's books, and replaces everything in the summary tables. 
+    :param con connection, in a write transaction """
+    con.execute('DELETE FROM author_stats')
+    con.execute('INSERT INTO author_stats (author, books, read) SELECT author, COUNT(*), SUM(read IS 1) FROM books GROUP BY author COLLATE NOCASE')
+    # The author_stats triggers changed the author count, so every total is set here, after author_stats is filled 
+    con.execute('INSERT OR REPLACE INTO book_totals (id, books, read, authors) '
+                'SELECT 1, COUNT(*), IFNULL(SUM(read IS 1), 0), (SELECT COUNT(*) FROM author_stats) FROM books')
+
+
+def _migration_change_journal(con):
+    """ Creates the book_changes journal, and the triggers that record every insert, update and delete of a book in it. 
+    Existing books are recorded as inserts, so the journal starts with the whole store. 
+    AUTOINCREMENT means a seq is never used twice, even after the latest changes are compacted. 
+    book_changes_compacted has the largest seq dropped by BookStore.compact_changes with before_seq. """
+
+    con.execute('CREATE TABLE IF NOT EXISTS book_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT, '
+                'book INTEGER, title TEXT, author TEXT, read BOOLEAN, time REAL)')
+    con.execute('CREATE INDEX IF NOT EXISTS book_changes_book ON book_changes (book, seq)')   # For compact_changes 
+    con.execute('CREATE TABLE IF NOT EXISTS book_changes_compacted (seq INTEGER)')
+    con.execute('INSERT INTO book_changes_compacted (seq) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM book_changes_compacted)')
+
+    # time is seconds since 1970, like time.time() 
+    now = "(julianday('now') - 2440587.5) * 86400.0"
+    create_triggers_sql = [
+        f'''CREATE TRIGGER IF NOT EXISTS book_changes_insert AFTER INSERT ON books BEGIN
+            INSERT INTO book_changes (operation, book, title, author, read, time) VALUES ('insert', new.rowid, new.title, new.author, new.read, {now});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS book_changes_update AFTER UPDATE OF title, author, read ON books BEGIN
+            INSERT INTO book_changes (operation, book, title, author, read, time) VALUES ('update', new.rowid, new.title, new.author, new.read, {now});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS book_changes_delete AFTER DELETE ON books BEGIN
+            INSERT INTO book_changes (operation, book, title, author, read, time) VALUES ('delete', old.rowid, old.title, old.author, old.read, {now});
+        END''',
+    ]
+    for sql in create_triggers_sql:
+        con.execute(sql)
+
+    con.execute(f"INSERT INTO book_changes (operation, book, title, author, read, time) "
+                f"SELECT 'insert', rowid, title, author, read, {now} FROM books ORDER BY rowid")
+
+
+def _migration_dedupe_keys(con):
+    """ Adds the title_key and author_key columns used to find duplicate books, see _book_keys, and fills them in. 
+    The UNIQUE constraint on title and author, which only ignores the case of ASCII letters, is still in the table 
+    definition, since SQLite can't drop it without copying the table. """
+
+    columns = [ row[1] for row in con.execute('PRAGMA table_info(books)') ]
+    for column in ['title_key', 'author_key']:
+        if column not in columns:
+            con.execute(f'ALTER TABLE books ADD COLUMN {column} TEXT')
+
+    duplicates = _backfill_keys(con)
+    if duplicates:
+        logger.warning('%d books are duplicates of earlier books, with different case, accents or spaces. They have been '
+                       'left without duplicate checking keys. IDs: %s', len(duplicates), duplicates)
+
+
+def _backfill_keys(con, batch_size=10000):
+    """ Sets title_key and author_key for every book, and creates the books_key unique index on them. 
+    When several books have the same keys, the first one keeps them and the others' keys are set to NULL, 
+    which the unique index allows. 
+    :returns the ids of the books left without keys """
+
+    con.execute('DROP INDEX IF EXISTS books_key')
+
+    last_rowid = 0
+    while True:
+        rows = con.execute('SELECT rowid, title, author FROM books WHERE rowid > ? ORDER BY rowid LIMIT ?', (last_rowid, batch_size) ).fetchall()
+        if not rows:
+            break
+        con.executemany('UPDATE books SET title_key = ?, author_key = ? WHERE rowid = ?', 
+                        [ (*_book_keys(title, author), rowid) for rowid, title, author in rows ] )
+        last_rowid = rows[-1][0]
+
+    con.execute('CREATE INDEX books_key ON books (title_key, author_key)')
+    duplicates = [ rowid for rowid, in con.execute('SELECT later.rowid FROM books AS later WHERE EXISTS ('
+        'SELECT 1 FROM books AS earlier WHERE earlier.title_key = later.title_key AND earlier.author_key = later.author_key '
+        'AND earlier.rowid < later.rowid) ORDER BY later.rowid') ]
+    con.executemany('UPDATE books SET title_key = NULL, author_key = NULL WHERE rowid = ?', [ (rowid, ) for rowid in duplicates ])
+
+    con.execute('DROP INDEX books_key')
+    con.execute('CREATE UNIQUE INDEX books_key ON books (title_key, author_key)')
+    return duplicates
+
+
+# Schema migrations, in order. A database's user_version is the number of these that have been run on it. 
+# Add new migrations to the end of the list, and never change one that has been released. 
+_migrations = [
+    _migration_create_books_table,
+    _migration_full_text_search,
+    _migration_read_index,
+    _migration_fuzzy_search_index,
+    _migration_author_index,
+    _migration_stats_tables,
+    _migration_change_journal,
+    _migration_dedupe_keys,
+]
+
+
+def _change_seq(con):
+    """ :returns the seq of the latest change in the change journal, or 0 """
+    row = con.execute("SELECT seq FROM sqlite_sequence WHERE name = 'book_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def _apply_changes(con, changes):
+    """ Makes changes from another copy of the store's change journal to the books in con, in order. 
+    An update to a book that isn't there adds it, in case compaction dropped the insert. 
+    :param con connection, in a write transaction 
+    :param changes list of (seq, operation, book id, title, author, read) rows from book_changes """
+
+    insert_sql = 'INSERT INTO books (rowid, title, author, read, title_key, author_key) VALUES (?, ?, ?, ?, ?, ?)'
+
+    texts = []
+    for seq, operation, id, title, author, read in changes:
+        if operation == 'delete':
+            con.execute('DELETE FROM books WHERE rowid = ?', (id, ) )
+            continue
+        keys = _book_keys(title, author)
+        if operation == 'insert' or not con.execute(_update_book_sql, (title, author, read, *keys, id) ).rowcount:
+            con.execute(insert_sql, (id, title, author, read, *keys) )
+        texts.append(f'{title} {author}')
+
+    _index_words(con, texts, lambda sql, params, many=False: con.executemany(sql, params) if many else con.execute(sql, params))
+
+
+def _restart_change_journal(con, last_seq):
+    """ After a restore, makes the next change's seq larger than any seq used before the restore, and marks every 
+    earlier change as compacted, so changes_since tells anyone syncing to reload instead of missing changes. """
+    current_seq = _change_seq(con)
+    seq = max(last_seq, current_seq) + 1
+    if current_seq:
+        con.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'book_changes'", (seq, ) )
+    else:
+        con.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('book_changes', ?)", (seq, ) )
+    con.execute('UPDATE book_changes_compacted SET seq = ?', (seq, ) )
+
+
+def _file_uri_path(path):
+    """ path quoted for a SQLite file: URI """
+    return os.path.abspath(path).replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+
+
+def _is_busy_error(error):
+    """ :returns True if a sqlite3.OperationalError is SQLITE_BUSY or SQLITE_LOCKED, meaning another connection has a lock """
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message or 'database table is locked' in message
+
+
+def _pause_before_retry(attempt, error):
+    """ Waits before retrying a write that found the database locked. Each attempt waits twice as long as the one before. """
+    pause = storage_profile.busy_backoff * 2 ** attempt
+    logger.debug('Database busy, retrying in %.3f s: %s', pause, error)
+    time.sleep(pause * random.uniform(0.5, 1.5))   # Randomness so retrying processes don't keep colliding 
+
+
+def _calling_method(default=None):
+    """ :returns the name of the outermost public function in this module in the current call stack. If there isn't one, 
+    default, or the name of the function that called BookStore._execute. For QueryEvent.method """
+
+    frame = sys._getframe(2)   # 0 is this function, 1 is _execute
+    name = default or frame.f_code.co_name
+    while frame is not None and frame.f_globals is globals():
+        if not frame.f_code.co_name.startswith('_'):
+            name = frame.f_code.co_name
+        frame = frame.f_back
+    return name
+
+
+def _words(text):
+    """ :returns the words in text for fuzzy search, in lower case with accents and punctuation removed """
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join( c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c) )
+    return re.findall(r'[^\W_]+', text)
+
+
+# Updates a book from (title, author, read, title_key, author_key, id). The keys are only changed if the title or author 
+# is, so a book left without keys by _backfill_keys, as a duplicate, can still be marked as read 
+_update_book_sql = ('UPDATE books SET title_key = CASE WHEN title IS ?1 AND author IS ?2 THEN title_key ELSE ?4 END, '
+                    'author_key = CASE WHEN title IS ?1 AND author IS ?2 THEN author_key ELSE ?5 END, '
+                    'title = ?1, author = ?2, read = ?3 WHERE rowid = ?6')
+
+
+def _book_keys(title, author):
+    """ The keys used to find duplicate books. Two books with the same keys are the same book. 
+    Keys are Unicode NFKC normalized and case folded, so 'Émile' written with a combining accent, 'ÉMILE' and 'émile' 
+    have the same key, with runs of spaces collapsed to one. Words in dedupe_articles are removed from the start of titles. 
+    :returns (title_key, author_key) """
+    title_words = _key(title).split(' ')
+    if len(title_words) > 1 and title_words[0] in dedupe_articles:
+        title_words = title_words[1:]
+    return ' '.join(title_words), _key(author)
+
+
+def _key(text):
+    text = str(text)
+    if text.isascii():
+        return ' '.join(text.lower().split())   # Same as below, but quicker for the most common case 
+    return ' '.join(unicodedata.normalize('NFKC', unicodedata.normalize('NFKC', text).casefold()).split())
+
+
+def _trigrams(word):
+    """ The set of three letter sequences in a word, with two spaces added to the start and one to the end, 
+    so 'tolkien' gives '  t', ' to', 'tol', 'olk', 'lki', 'kie', 'ien', 'en '. 
+    A word with a typing mistake still has most of the trigrams of the correct word. """
+    padded = f'  {word} '
+    return { padded[n:n + 3] for n in range(len(padded) - 2) }
+
+
+def _index_words(con, texts, execute):
+    """ Adds the words in texts that aren't already in the fuzzy search vocabulary, with their trigrams. 
+    :param con connection, in a write transaction 
+    :param texts list of strings, the titles and authors of books 
+    :param execute function to run a statement, taking sql, params and many, like BookStore._execute """
+
+    # Numbers are left out, a search for a number has to match it exactly 
+    words = { word for text in texts for word in _words(text) if not word.isdigit() }
+    if not words:
+        return
+
+    known_sql = 'SELECT word FROM fuzzy_words WHERE word IN (SELECT value FROM json_each(?))'
+    new_words = words.difference( word for word, in execute(known_sql, (json.dumps(sorted(words)), )) )
+    if not new_words:
+        return
+
+    trigrams = { word: _trigrams(word) for word in new_words }
+    execute('INSERT INTO fuzzy_words (word, trigram_count) VALUES (?, ?)', [ (word, len(trigrams[word])) for word in new_words ], many=True)
+    execute('INSERT INTO fuzzy_trigrams (trigram, word) VALUES (?, ?)', 
+        sorted( (trigram, word) for word in new_words for trigram in trigrams[word] ), many=True)
+
+
+def _fts_query(term, prefix=False):
+    """ Turns a search term into an FTS5 query that matches books containing all of the words in the term. 
+    Each word is quoted, so punctuation and FTS5 keywords like OR and NEAR in the term are searched for as text. 
+    :param term the search term 
+    :param prefix if True, match words that start with each word in the term 
+    :returns the query, or an empty string if the term has no words in """
+    words = re.findall(r'\w+', term)
+    return ' '.join( f'"{word}"*' if prefix else f'"{word}"' for word in words )
+
+
+
+class QueryEvent:
+
+    """ One SQL statement run by the BookStore, passed to query hooks when instrumentation is on. 
+    method is the BookStore or Book method that ran it, seconds is how long it took to run and fetch its results, 
+    rows is the number of rows it returned, or for INSERT, UPDATE and DELETE the number of rows it changed. """
+
+    __slots__ = ('sql', 'params', 'method', 'seconds', 'rows')
+
+    def __init__(self, sql, params, method, seconds, rows):
+        self.sql = sql
+        self.params = params
+        self.method = method
+        self.seconds = seconds
+        self.rows = rows
+
+
+    def __repr__(self):
+        return f'QueryEvent method: {self.method} seconds: {self.seconds:.6f} rows: {self.rows} sql: {self.sql}'
+
+
+
+class _Instrumentation:
+
+    """ Timing, counters and hooks for BookStore statements. Only exists while instrumentation is on, 
+    so when it's off the only cost is checking whether BookStore._instrumentation is None. """
+
+    # Upper bounds, in seconds, of the latency histogram buckets. The last bucket holds everything slower. 
+    histogram_bounds = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1]
+
+    def __init__(self, slow_query_seconds=None, trace=False, progress=None, progress_steps=1000):
+        self.slow_query_seconds = slow_query_seconds
+        self.trace = trace
+        self.progress = progress
+        self.progress_steps = progress_steps
+        self.hooks = []
+        self.stats = {}   # method name -> dictionary of counters 
+        self.lock = threading.Lock()
+
+
+    def execute(self, con, sql, params, many, method):
+        start = time.perf_counter()
+        if many:
+            cursor = con.executemany(sql, params)
+        else:
+            cursor = con.execute(sql, params)
+        seconds = time.perf_counter() - start
+
+        if cursor.description is None:
+            self.finish(con, QueryEvent(sql, None if many else params, method, seconds, cursor.rowcount))
+            return cursor 
+
+        # Rows are counted and timed as they're fetched, so results still stream. The event is recorded when they've all been read 
+        return _CountedCursor(self, con, cursor, QueryEvent(sql, params, method, seconds, 0))
+
+
+    def finish(self, con, event):
+        """ Records a statement that has finished, logs it if it was slow, and calls the hooks """
+        self.record(event)
+
+        if self.slow_query_seconds is not None and event.seconds >= self.slow_query_seconds and event.params is not None:
+            try:
+                plan = ' / '.join( row[-1] for row in con.execute(f'EXPLAIN QUERY PLAN {event.sql}', event.params) )
+            except sqlite3.Error as e:   # For example if the connection was closed before the cursor was finished with 
+                plan = f'not available, {e}'
+            logger.warning('Slow query in %s took %.3f s, %d rows: %s %r\nQuery plan: %s', 
+                event.method, event.seconds, event.rows, event.sql, event.params, plan)
+
+        for hook in self.hooks:
+            hook(event)
+
+
+    def record(self, event):
+        bucket = bisect.bisect_left(self.histogram_bounds, event.seconds)
+        with self.lock:
+            stats = self.stats.get(event.method)
+            if stats is None:
+                stats = self.stats[event.method] = { 'statements': 0, 'rows': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 
+                                                     'histogram': [0] * (len(self.histogram_bounds) + 1) }
+            stats['statements'] += 1
+            stats['rows'] += max(event.rows, 0)
+            stats['total_seconds'] += event.seconds
+            stats['max_seconds'] = max(stats['max_seconds'], event.seconds)
+            stats['histogram'][bucket] += 1
+
+
+    def apply_callbacks(self, con):
+        """ Sets or removes SQLite's trace and progress callbacks on a connection """
+        con.set_trace_callback(logger.debug if self.trace else None)
+        con.set_progress_handler(self.progress, self.progress_steps if self.progress else 0)
+
+
+    def report(self):
+        """ :returns a copy of the per method counters, with the histogram as a dictionary of bucket label to count """
+        labels = [ f'<= {bound * 1000:g} ms' for bound in self.histogram_bounds ] + [ f'> {self.histogram_bounds[-1] * 1000:g} ms' ]
+        with self.lock:
+            return { method: dict(stats, histogram=dict(zip(labels, stats['histogram']))) for method, stats in self.stats.items() }
+
+
+
+class _CountedCursor:
+
+    """ Wraps the sqlite3 Cursor of a query run while instrumentation is on. Counts the rows as they are fetched and adds 
+    the time spent fetching them to the event, which is recorded when every row has been fetched, or when the cursor is 
+    closed or thrown away, for example after fetchone. """
+
+    def __init__(self, instrumentation, con, cursor, event):
+        self.instrumentation = instrumentation
+        self.con = con
+        self.cursor = cursor
+        self.event = event
+        self.finished = False
+
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)   # description, lastrowid, rowcount 
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row 
+
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self._fetched(start, 0 if row is None else 1, row is None)
+        return row 
+
+
+    def fetchmany(self, size=None):
+        size = self.cursor.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(size)
+        self._fetched(start, len(rows), len(rows) < size)
+        return rows 
+
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self._fetched(start, len(rows), True)
+        return rows 
+
+
+    def close(self):
+        self.cursor.close()
+        self._finish()
+
+
+    def __del__(self):
+        self._finish()
+
+
+    def _fetched(self, start, rows, exhausted):
+        self.event.seconds += time.perf_counter() - start
+        self.event.rows += rows
+        if exhausted:
+            self._finish()
+
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self.instrumentation.finish(self.con, self.event)
+
+
+
+class _QueryCache:
+
+    """ Least recently used cache of query results for BookStore, with an optional time to live. 
+    Safe to use from many threads. Counts hits and misses. 
+    generation goes up every time the cache is cleared. A result is only stored if the cache hasn't been cleared 
+    since the query started, so a query that raced with a write can't put out of date data in the cache. """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (value, time stored). Most recently used at the end 
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        """ :returns (True, value) if key is cached and hasn't expired, (False, None) otherwise """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+
+            if entry is not None:
+                del self.entries[key]   # Expired 
+            self.misses += 1
+            return False, None
+
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return 
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+
+class BookChange:
+
+    """ One change in the change journal, from BookStore.changes_since. operation is 'insert', 'update' or 'delete'. 
+    book is the book after the change, or for a delete, the book that was deleted. time is when the change was made, 
+    in seconds since 1970. """
+
+    __slots__ = ('seq', 'operation', 'book', 'time')
+
+    def __init__(self, seq, operation, book, time):
+        self.seq = seq
+        self.operation = operation
+        self.book = book
+        self.time = time
+
+
+    def __repr__(self):
+        return f'BookChange seq: {self.seq} operation: {self.operation} book: {self.book!r}'
+
+
+
+class _RepeatingTask(threading.Thread):
+
+    """ Background thread that calls task every interval seconds until stop() is called. 
+    If task raises an exception it's logged, and task is called again next time. """
+
+    def __init__(self, task, interval, name):
+        super().__init__(name=name, daemon=True)
+        self.task = task
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.result = None   # What task returned last time 
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.result = self.task()
+            except Exception:
+                logger.exception('%s failed', self.name)
+
+
+    def stop(self):
+        """ Stops calling task, and waits for a call in progress to finish """
+        self.stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+
+class SnapshotSchedule(_RepeatingTask):
+
+    """ Background thread started by BookStore.schedule_snapshots. Call stop() to stop taking snapshots. """
+
+    def __init__(self, take_snapshot, interval):
+        super().__init__(take_snapshot, interval, 'bookstore-snapshots')
+
+
+    @property
+    def last_snapshot(self):
+        """ Path of the most recent snapshot """
+        return self.result
+
+
+
+class _WriteQueue:
+
+    """ The queue of saves and deletes used by BookStore.enable_write_queue, and the thread that commits them. """
+
+    def __init__(self, store, max_batch, max_delay):
+        self.store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()   # (function, book, Future), or None to stop the writer 
+        self.stopped = False
+        self.writer = threading.Thread(target=self.run, name='bookstore-write-queue', daemon=True)
+        self.writer.start()
+
+
+    def submit(self, function, book):
+        """ Queues function(book), where function is Book.save or Book.delete 
+        :returns a Future that gives book.id when the write is committed """
+        if self.stopped:
+            raise BookError('The write queue has been stopped')
+        future = Future()
+        self.requests.put( (function, book, future) )
+        return future
+
+
+    def wait(self):
+        """ Waits until every write queued so far has been committed, or has failed """
+        self.requests.join()
+
+
+    def stop(self):
+        """ Commits the writes already queued, then stops the writer thread """
+        self.stopped = True
+        self.requests.put(None)
+        if self.writer is not threading.current_thread():
+            self.writer.join()
+
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                return
+
+            batch = [request]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)   # Stop after committing this batch 
+                    self.requests.task_done()
+                    break
+                batch.append(request)
+
+            try:
+                self.commit(batch)
+            finally:
+                for request in batch:
+                    self.requests.task_done()
+
+
+    def commit(self, batch):
+        """ Runs a batch of writes in one transaction, then sets each one's Future """
+        results = []
+        try:
+            with self.store.transaction():
+                for function, book, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    id = book.id
+                    try:
+                        function(book)
+                        results.append( (future, book, id, None) )
+                    except Exception as error:
+                        results.append( (future, book, id, error) )
+        except Exception as error:
+            # Nothing was committed. Books added in the batch don't have the ids they were given 
+            for future, book, id, _ in results:
+                book.id = id
+            for function, book, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for future, book, id, error in results:
+            if error is None:
+                future.set_result(book.id)
+            else:
+                future.set_exception(error)
+
+
+
+class _MemoryMode:
+
+    """ The in-memory copy of the database used by BookStore.enable_memory_mode. 
+    The copy is a SQLite memdb database, which every thread's connection can open by its URI. con keeps it open, 
+    and is used by flush to read the changes to save. disk is flush's connection to the database file. """
+
+    _count = 0
+
+    def __init__(self, durability):
+        _MemoryMode._count += 1
+        self.uri = f'file:/bookstore-{os.getpid()}-{_MemoryMode._count}?vfs=memdb'
+        self.con = sqlite3.connect(self.uri, uri=True, timeout=storage_profile.busy_timeout, check_same_thread=False)
+        self.disk = None
+        self.durability = durability
+        self.flushed_seq = 0   # The seq of the last change saved to the file 
+        self.flusher = None   # The _RepeatingTask calling flush, with buffered durability 
+        self.lock = threading.Lock()   # Held while flushing, so changes are saved once, in order 
+
+
+    def close(self):
+        self.con.close()
+        if self.disk is not None:
+            self.disk.close()
+
+
+
+class BookQuery:
+
+    """ A query for books from BookStore.query(). Each method returns a new query with one more filter or setting, 
+    so a query can be built up a step at a time, and a partly built query can be reused. The whole query runs as one 
+    SQL statement, so filtering, sorting and paging happen in the database, using indexes where they can: 
+    full text search, read, id ranges, exact and prefix matches on title and author, and ordering by title or author. 
+    Get the books with all() for a list, iterate over the query to read them from the database as they are needed, 
+    or use first() or count(). """
+
+    _order_columns = { 'id': 'books.rowid', 'title': 'books.title COLLATE NOCASE', 'author': 'books.author COLLATE NOCASE', 'read': 'books.read' }
+
+    def __init__(self, store):
+        self._store = store
+        self._conditions = []   # (SQL, params) conditions that every book found must match 
+        self._match = None   # FTS5 query, if searching with the full text index 
+        self._order = []   # (field, descending) 
+        self._limit = None
+        self._offset = 0
+        self._nothing = False   # True if no book can match, for example after searching for a term without any words 
+
+
+    def _copy(self):
+        query = copy.copy(self)
+        query._conditions = list(self._conditions)
+        return query
+
+
+    def _where(self, sql, *params):
+        query = self._copy()
+        query._conditions.append( (sql, params) )
+        return query
+
+
+    def search(self, term, mode='words'):
+        """ Only books with a title or author that matches term. 
+        :param mode 'words', 'prefix' or 'substring', as for BookStore.book_search. With 'words' and 'prefix' the best 
+        matches come first, unless order_by is used. Fuzzy search ranks books in Python, so it isn't available here """
+
+        if mode not in ['substring', 'words', 'prefix']:
+            raise ValueError(f'Unknown search mode {mode}' if mode != 'fuzzy' else 'Use book_search for fuzzy searches')
+
+        if mode == 'substring' or not self._store.full_text_search:
+            search = f'%{term}%'
+            return self._where('(books.title LIKE ? OR books.author LIKE ?)', search, search)
+
+        query = self._copy()
+        match = _fts_query(term, prefix=(mode == 'prefix'))
+        if not match:
+            query._nothing = True
+        else:
+            query._match = f'({query._match}) AND ({match})' if query._match else match
+        return query
+
+
+    def title(self, text, match='contains'):
+        """ Only books with a title containing text, not case sensitive. 
+        :param match 'contains', or 'exact' for the whole title, or 'prefix' for titles that start with text """
+        return self._text_filter('title', text, match)
+
+
+    def author(self, text, match='contains'):
+        """ Only books with an author containing text, not case sensitive. 
+        :param match 'contains', or 'exact' for the whole author, or 'prefix' for authors that start with text """
+        return self._text_filter('author', text, match)
+
+
+    def _text_filter(self, column, text, match):
+        if match == 'contains':
+            return self._where(f'books.{column} LIKE ?', f'%{text}%')
+        if match == 'exact':
+            return self._where(f'books.{column} = ? COLLATE NOCASE', text)
+        if match == 'prefix':
+            # The same range as autocomplete, so the NOCASE index on the column can be used 
+            return self._where(f'books.{column} >= ? COLLATE NOCASE AND books.{column} < ? COLLATE NOCASE', text, text + '\U0010ffff')
+        raise ValueError(f'Unknown match {match}')
+
+
+    def read(self, read):
+        """ Only books that have been read, if read is True, or only unread books if it's False """
+        return self._where('books.read = ?', bool(read))
+
+
+    def ids(self, first=None, last=None):
+        """ Only books with ids from first to last, including first and last. Either can be None for no limit. """
+        query = self
+        if first is not None:
+            query = query._where('books.rowid >= ?', first)
+        if last is not None:
+            query = query._where('books.rowid <= ?', last)
+        return query
+
+
+    def order_by(self, *fields):
+        """ Sets the order of the books, replacing any order set before. 
+        :param fields 'id', 'title', 'author', 'read', or 'rank' for best search matches first. Start a field with - 
+        to sort in descending order, like '-id'. Books that are the same in every field are in id order. """
+        order = []
+        for field in fields:
+            name = field.lstrip('-')
+            if name not in self._order_columns and name != 'rank':
+                raise ValueError(f'Can\'t order by {field}')
+            order.append( (name, field.startswith('-')) )
+
+        query = self._copy()
+        query._order = order
+        return query
+
+
+    def limit(self, limit):
+        """ Returns at most limit books. None for no limit """
+        query = self._copy()
+        query._limit = limit
+        return query
+
+
+    def offset(self, offset):
+        """ Skips the first offset books. For long lists BookStore.page is quicker, see ids() """
+        query = self._copy()
+        query._offset = offset
+        return query
+
+
+    def _from_where(self):
+        """ :returns the FROM and WHERE clauses, and their params """
+        params = []
+        if self._match:
+            sql = 'FROM books_fts JOIN books ON books.rowid = books_fts.rowid'
+            conditions = ['books_fts MATCH ?']
+            params.append(self._match)
+        else:
+            sql = 'FROM books'
+            conditions = []
+
+        for condition, condition_params in self._conditions:
+            conditions.append(condition)
+            params.extend(condition_params)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return sql, params
+
+
+    def sql(self):
+        """ :returns (SQL, params) for the query, for example to see its query plan """
+        from_where, params = self._from_where()
+
+        order = self._order or ([ ('rank', False) ] if self._match else [])
+        columns = []
+        for name, descending in order:
+            if name == 'rank':
+                if not self._match:
+                    continue   # Books found with LIKE aren't ranked 
+                column = 'bm25(books_fts)'
+            else:
+                column = self._order_columns[name]
+            columns.append(column + (' DESC' if descending else ''))
+        if not any(name == 'id' for name, descending in order):
+            columns.append('books.rowid')
+
+        sql = f'SELECT books.rowid, books.title, books.author, books.read {from_where} ORDER BY {", ".join(columns)} LIMIT ? OFFSET ?'
+        return sql, params + [ -1 if self._limit is None else self._limit, self._offset ]
+
+
+    def __iter__(self):
+        """ Reads the books from the database as they are needed, like the BookStore iter_ methods """
+        if self._nothing:
+            return iter([])
+        sql, params = self.sql()
+        return self._store._iter_books(sql, params, 'query')
+
+
+    def all(self):
+        """ :returns a list of the books """
+        return list(self)
+
+
+    def first(self):
+        """ :returns the first book, or None if no books match """
+        return next(iter(self.limit(1)), None)
+
+
+    def count(self):
+        """ :returns the number of books that match, ignoring limit and offset """
+        if self._nothing:
+            return 0
+        from_where, params = self._from_where()
+        return self._store._execute(self._store._connection(), f'SELECT COUNT(*) {from_where}', params, method='query').fetchone()[0]
+
+
+
+class ImportResult:
+
+    """ What happened in a BookStore.add_books import. added is the number of books added, 
+    duplicates is a list of the Books that were not added because they were already in the store. """
+
+    def __init__(self):
+        self.added = 0
+        self.duplicates = []
+
+
+    def __repr__(self):
+        return f'ImportResult added: {self.added} duplicates: {len(self.duplicates)}'
+
+
+
+class BatchResult:
+
+    """ What happened in a BookStore.set_read or delete_books call. affected is a sorted list of the ids of the books
+    that were changed or deleted, missing is a sorted list of requested ids that aren't in the store. """
+
+    def __init__(self, affected, missing):
+        self.affected = affected
+        self.missing = missing
+
+
+    def __repr__(self):
+        return f'BatchResult affected: {len(self.affected)} missing: {self.missing}'
+
+
+
 class BookError(Exception):
     """ For BookStore errors. """
     pass
+
+
+
+class ChangesCompactedError(BookError):
+    """ Raised by BookStore.changes_since when the changes asked for have been dropped by compact_changes. """
+    pass
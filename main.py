@@ -1,13 +1,117 @@
 """ Program to create and manage a list of books that the user wishes to read, and books that the user has read. """
 
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import os
+import sys
+
 from bookstore import Book, BookStore, BookError
 from menu import Menu
+import batch
+import server
 import ui
 
 store = BookStore()
 
-def main():
+def main(argv=None):
+    """ Runs the interactive menu, or a command given on the command line. 
+    python main.py import books.csv more_books.jsonl   adds all the books in the files to the store 
+    python main.py export books.csv.gz --unread   saves the unread books to a compressed CSV file 
+    python main.py batch commands.txt   runs the commands in the file, see batch.py, and prints the results as JSON lines 
+    python main.py stats --check   shows reading statistics, and checks they match the books 
+    python main.py snapshot backups --keep 7   backs up the database to a new file in backups, keeping the newest 7 
+    python main.py serve --port 8000   runs the HTTP/JSON API, see server.py 
+    python main.py --memory batch commands.txt   loads the books into memory first, see BookStore.enable_memory_mode 
+    :returns the exit status, 1 if any batch commands failed """
+
+    args = parse_args(argv)
+
+    if args.memory:
+        store.enable_memory_mode()
+    try:
+        return run_command(args)
+    finally:
+        store.disable_memory_mode()   # Saves every write to the database file 
+
+
+def run_command(args):
+    if args.command == 'import':
+        import_books(args.files)
+    elif args.command == 'export':
+        export_books(args.file, args.format, args.gzip, args.read, args.search)
+    elif args.command == 'batch':
+        return run_batch(args.script, args.group_size)
+    elif args.command == 'stats':
+        return stats_command(args.check, args.rebuild)
+    elif args.command == 'backup':
+        backup_database(args.file)
+    elif args.command == 'snapshot':
+        snapshot_database(args.directory, args.keep)
+    elif args.command == 'restore':
+        return restore_database(args.file)
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.workers)
+    else:
+        run_menu()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Manage a list of books to read, and books that have been read.')
+    parser.add_argument('--memory', action='store_true', help='load the books into memory and serve every query from there, saving changes to the database file every few seconds and at the end')
+    commands = parser.add_subparsers(dest='command')
+
+    import_parser = commands.add_parser('import', help='Add books from CSV or JSONL files')
+    import_parser.add_argument('files', nargs='+', help='CSV files with title, author and optional read columns, or .jsonl files with one book object per line. Files ending .gz are decompressed.')
+
+    export_parser = commands.add_parser('export', help='Save books to a CSV, JSONL or SQL file')
+    export_parser.add_argument('file', help='file to write, or - for standard output. The format and compression are worked out from the name, for example books.jsonl.gz')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl', 'sql'], help='file format, if not the file extension')
+    export_parser.add_argument('--gzip', action='store_true', default=None, help='compress the file, if the name does not end .gz')
+    read_filter = export_parser.add_mutually_exclusive_group()
+    read_filter.add_argument('--read', dest='read', action='store_true', default=None, help='only export books that have been read')
+    read_filter.add_argument('--unread', dest='read', action='store_false', help='only export books that have not been read')
+    export_parser.add_argument('--search', help='only export books with titles or authors containing this text')
+
+    batch_parser = commands.add_parser('batch', help='Run add, search, read, unread, delete and list commands from a script')
+    batch_parser.add_argument('script', nargs='?', default='-', help='file of commands, one per line as text or JSON. Reads standard input if not given, or -')
+    batch_parser.add_argument('--group-size', type=positive_int, default=1000, help='how many commands to run in each transaction')
+
+    stats_parser = commands.add_parser('stats', help='Show reading statistics')
+    stats_parser.add_argument('--check', action='store_true', help='count the books again, and check the statistics are right')
+    stats_parser.add_argument('--rebuild', action='store_true', help='count the books again, and replace the statistics')
+
+    backup_parser = commands.add_parser('backup', help='Copy the database to a file, while it is in use')
+    backup_parser.add_argument('file', help='file to write the backup to')
+
+    snapshot_parser = commands.add_parser('snapshot', help='Back up the database to a new file named after the time, for example from cron')
+    snapshot_parser.add_argument('directory', help='directory to save snapshots in')
+    snapshot_parser.add_argument('--keep', type=int, help='delete the oldest snapshots in the directory, leaving this many')
+
+    restore_parser = commands.add_parser('restore', help='Replace all the books with the books in a backup or snapshot')
+    restore_parser.add_argument('file', help='the backup to restore')
+
+    serve_parser = commands.add_parser('serve', help='Run the HTTP/JSON API until interrupted')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on, 0.0.0.0 for every network interface')
+    serve_parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    serve_parser.add_argument('--workers', type=int, default=8, help='how many connections to handle at the same time')
 
+    return parser.parse_args(argv)
+
+
+def positive_int(text):
+    """ argparse type for whole numbers of at least 1 """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {text}')
+    return value
+
+
+def run_menu():
+
+    store.enable_cache()   # The menu repeats lookups a lot, for example change_read and delete_book both get the book by id first
     menu = create_menu()
 
     while True:
@@ -25,8 +129,10 @@ def create_menu():
     menu.add_option('3', 'Show Unread Books', show_unread_books)
     menu.add_option('4', 'Show Read Books', show_read_books)
     menu.add_option('5', 'Show All Books', show_all_books)
-    menu.add_option('6', 'Change Book Read Status', change_read)
-    menu.add_option('7', 'Delete Book From Store', delete_book)
+    menu.add_option('6', 'Change Read Status of Books', change_read)
+    menu.add_option('7', 'Delete Books From Store', delete_book)
+    menu.add_option('8', 'Export Books To File', export_books_menu)
+    menu.add_option('9', 'Reading Statistics', show_stats)
     menu.add_option('Q', 'Quit', quit_program)
 
     return menu
@@ -41,50 +147,187 @@ def add_book():
     
 
 def show_read_books():
-    read_books = store.get_books_by_read_value(True)
-    ui.show_books(read_books)
+    ui.page_books(lambda after_id, limit: store.page(after_id, limit, read=True))
 
 
 def show_unread_books():
-    unread_books = store.get_books_by_read_value(False)
-    ui.show_books(unread_books)
+    ui.page_books(lambda after_id, limit: store.page(after_id, limit, read=False))
 
 def delete_book():
-    try:
-        Id = ui.get_book_id()
-        book = store.get_book_by_id(Id)
-        Book.delete(book)
-        ui.message('Book deleted successfully')
-    except:
-        ui.message("Error!!! Book Not Found in Store")    
+    book_ids = ui.get_book_ids()
+    result = store.delete_books(book_ids)
+    if result.affected:
+        ui.message(f'{len(result.affected)} book(s) deleted successfully')
+    if result.missing:
+        ui.message(f'Error!!! Book(s) Not Found in Store: {format_ids(result.missing)}')
 
 def show_all_books():
-    books = store.get_all_books()
-    ui.show_books(books)
+    ui.page_books(store.page)
 
 
 def search_book():
-    search_term = ui.ask_question('Enter search term, will match partial authors or titles.')
-    matches = store.book_search(search_term)
-    ui.show_books(matches)
+    search_term = ui.ask_question('Enter search term, will match the start of words in authors or titles.')
+    matches = iter(store.query().search(search_term, mode='prefix'))
+    first_match = next(matches, None)
+
+    if first_match is None:
+        # Nothing starts with the term, perhaps it's misspelled 
+        close_matches = store.book_search(search_term, mode='fuzzy', limit=10)
+        if close_matches:
+            ui.message('No exact matches. Did you mean one of these?')
+        ui.show_books(close_matches)
+    else:
+        ui.show_books(itertools.chain([first_match], matches))
 
 
 def change_read():
-    try:
-        book_id = ui.get_book_id()
-        book = store.get_book_by_id(book_id)
-        new_read = ui.get_read_value()
-        book.read = new_read
-        ui.message(f"You have {'read' if book.read else 'not read' } \"{book.title}\" by {book.author}")
-        book.save()
-    except:
-        ui.message("A book with that ID does not exist in the database")    
+    book_ids = ui.get_book_ids()
+    new_read = ui.get_read_value()
+    result = store.set_read(new_read, book_ids)
+    if result.affected:
+        ui.message(f"You have {'read' if new_read else 'not read' } {len(result.affected)} book(s)")
+    if result.missing:
+        ui.message(f'No books with these IDs exist in the database: {format_ids(result.missing)}')
+
+
+def format_ids(ids):
+    """ Shows a sorted list of IDs with runs written as ranges, so [1, 2, 3, 7] is shown as 1-3, 7 """
+    ranges = []
+    for id in ids:
+        if ranges and id == ranges[-1][1] + 1:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return ', '.join( str(start) if start == end else f'{start}-{end}' for start, end in ranges )
 
      
 
+def import_books(paths):
+    for path in paths:
+        result = store.add_books(read_books_file(path))
+        for duplicate in result.duplicates:
+            ui.message(f'Skipped, already in store: {duplicate.title} by {duplicate.author}')
+        ui.message(f'{path}: added {result.added} books, skipped {len(result.duplicates)} duplicates')
+
+
+def read_books_file(path):
+    """ Generator of Books read from a file, one at a time so large files don't have to fit in memory.
+    Files ending .jsonl have one JSON object per line, with title, author and optional read keys.
+    Any other file is read as CSV with a header row naming title, author and optional read columns. 
+    :param path the file to read 
+    :returns a generator of unsaved Books """
+
+    opener = gzip.open if path.lower().endswith('.gz') else open
+
+    with opener(path, 'rt', newline='', encoding='utf-8') as f:
+        if path.lower().endswith(('.jsonl', '.jsonl.gz')):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = csv.DictReader(f)
+
+        for record in records:
+            yield Book(record['title'], record['author'], ui.parse_read(record.get('read')))
+
+
+def export_books(path, format=None, compress=None, read=None, term=None):
+    """ Saves books to a file. Format and compression default to what the file name suggests, 
+    so books.jsonl.gz is compressed JSON lines. Other names are saved as CSV. A path of - writes to standard output. """
+
+    name = path.lower()
+    if compress is None:
+        compress = name.endswith('.gz')
+    if format is None:
+        extension = os.path.splitext(name[:-3] if name.endswith('.gz') else name)[1]
+        format = extension[1:] if extension in ['.jsonl', '.sql'] else 'csv'
+
+    destination = (sys.stdout.buffer if compress else sys.stdout) if path == '-' else path
+    progress = None if path == '-' else lambda count: ui.message(f'{count} books exported...')
+    count = store.export(destination, format, compress, read, term, progress=progress, progress_every=100000)
+
+    if path != '-':
+        ui.message(f'Exported {count} books to {path}')
+
+
+def export_books_menu():
+    path = ui.ask_question('Enter file name to export to, ending .csv, .jsonl or .sql, with .gz to compress: ')
+    try:
+        export_books(path)
+    except OSError as error:
+        ui.message(f'Could not export books: {error}')
+
+
+def show_stats():
+    ui.show_stats(store.stats())
+
+
+def stats_command(check=False, rebuild=False):
+    """ Shows reading statistics. Checking reads every book, so it's slow for a large store. 
+    :returns the exit status, 1 if the check found problems that weren't fixed by rebuilding """
+
+    if rebuild:
+        store.rebuild_stats()
+        ui.message('Statistics rebuilt')
+
+    if check:
+        problems = store.check_stats()
+        for problem in problems:
+            ui.message(problem)
+        ui.message(f'{len(problems)} problems found, run with --rebuild to fix them' if problems else 'Statistics are correct')
+
+    show_stats()
+    return 1 if check and problems else 0
+
+
+def backup_database(path):
+    progress = lambda copied, total: ui.message(f'Copied {copied} of {total} pages...') if copied < total else None
+    store.backup(path, progress=progress)
+    ui.message(f'Backed up to {path}')
+
+
+def snapshot_database(directory, keep=None):
+    path = store.snapshot(directory, keep)
+    ui.message(f'Saved snapshot {path}')
+
+
+def restore_database(path):
+    """ :returns the exit status, 1 if the file couldn't be restored """
+    try:
+        store.restore(path)
+    except BookError as error:
+        ui.message(error)
+        return 1
+    ui.message(f'Restored {store.book_count()} books from {path}')
+    return 0
+
+
+def serve(host, port, workers):
+    http_server = server.BookServer((host, port), workers)
+    ui.message(f'Serving the reading list on http://{host}:{http_server.server_port}/books, press Ctrl+C to stop')
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+
+
+def run_batch(path, group_size):
+    """ Runs a batch script, writing the results to standard output and a summary to standard error 
+    :returns the exit status, 1 if any commands failed """
+    if path == '-':
+        commands, errors = batch.run_batch(sys.stdin, sys.stdout, group_size)
+    else:
+        with open(path, encoding='utf-8') as f:
+            commands, errors = batch.run_batch(f, sys.stdout, group_size)
+
+    print(f'{commands} commands run, {errors} failed', file=sys.stderr)
+    return 1 if errors else 0
+
+
 def quit_program():
+    store.close()
     ui.message('Thanks and bye!')
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
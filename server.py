@@ -0,0 +1,363 @@
+""" HTTP/JSON API for the reading list, so other programs can use it without the menu or opening the database file.
+
+    GET    /books                    every book, or ?read=true / ?read=false. ?after_id=0&limit=20 gets one page
+    GET    /books/search?q=tolkien   books matching q, with optional mode (substring, words, prefix, fuzzy) and limit
+    GET    /books/count              how many books, or ?read=true / ?read=false
+    GET    /books/<id>               one book
+    POST   /books                    add a book, from a JSON object with title, author and optional read
+    PUT    /books/<id>               change a book's title, author or read. Keys that aren't given are left as they are
+    PATCH  /books/<id>               the same as PUT
+    DELETE /books/<id>               delete a book
+
+Books are JSON objects with id, title, author and read. Errors are JSON objects with an error message.
+Lists are streamed with chunked transfer encoding as they are read from the database, so a long list doesn't have to
+fit in memory. List responses have an ETag from the store's change journal, so a client that sends it back in
+If-None-Match gets 304 Not Modified until a book is added, changed or deleted.
+
+Connections are kept open between requests. Each connection is handled by one of a fixed number of worker threads, and
+each worker uses its own database connection. When every worker is busy, new connections wait until one is free. """
+
+import json
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from bookstore import Book, BookStore, BookError
+import ui
+
+logger = logging.getLogger(__name__)
+
+# Books are sent in chunks of about this many bytes
+chunk_size = 64 * 1024
+
+# The largest integer SQLite can store, so the largest possible book id 
+max_integer = 2**63 - 1
+
+
+class BookServer(HTTPServer):
+
+    """ Serves the API on a pool of worker threads. Call serve_forever() to start, and shutdown() then server_close() to stop. """
+
+    def __init__(self, address, workers=8, idle_timeout=5.0):
+        """ :param address (host, port) to listen on. Port 0 picks a free port, see server_port
+        :param workers how many connections are handled at the same time
+        :param idle_timeout seconds a kept-alive connection can wait for its next request before it's closed,
+        so idle clients don't keep workers from new connections """
+        super().__init__(address, BookRequestHandler)
+        self.store = BookStore()
+        self.idle_timeout = idle_timeout
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bookstore-http')
+        self._free_workers = threading.BoundedSemaphore(workers)
+
+
+    def process_request(self, request, client_address):
+        # Waiting here stops the server accepting more connections, which queue in the listen backlog, until a worker is free
+        self._free_workers.acquire()
+        self._workers.submit(self._process_request_in_worker, request, client_address)
+
+
+    def _process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_workers.release()
+
+
+    def handle_error(self, request, client_address):
+        logger.exception('Error handling request from %s', client_address)
+
+
+    def server_close(self):
+        super().server_close()
+        self._workers.shutdown(wait=True)
+
+
+
+class BookRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # Keeps connections open between requests
+    disable_nagle_algorithm = True   # Headers and body are written separately, don't wait to send the body
+    server_version = 'ReadingList/1.0'
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        super().setup()
+
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+
+    def do_GET(self):
+        self.route('GET')
+
+
+    def do_POST(self):
+        self.route('POST')
+
+
+    def do_PUT(self):
+        self.route('PUT')
+
+
+    def do_PATCH(self):
+        self.route('PUT')
+
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+    def route(self, method):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/') or '/'
+        self.query = { key: values[-1] for key, values in parse_qs(url.query).items() }
+
+        allowed = []
+        for route_method, pattern, handler in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match:
+                if route_method == method:
+                    break
+                allowed.append(route_method)
+        else:
+            if self.headers.get('Content-Length', '0') != '0':
+                self.close_connection = True   # The body hasn't been read, so the connection can't be used again
+            if allowed:
+                return self.send_json(405, { 'error': f'{method} not allowed for {path}' }, { 'Allow': ', '.join(allowed) })
+            return self.send_json(404, { 'error': f'Nothing at {path}' })
+
+        try:
+            handler(self, self.server.store, *match.groups())
+        except ValueError as error:
+            self.send_json(400, { 'error': str(error) })
+
+
+    def read_json(self):
+        """ :returns the request body as a dictionary
+        :raises ValueError if it isn't a JSON object """
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            data = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as error:
+            raise ValueError(f'Body is not JSON: {error}')
+        if not isinstance(data, dict):
+            raise ValueError('Body must be a JSON object')
+        return data
+
+
+    def read_filter(self):
+        """ :returns True, False or None from the read query parameter """
+        read = self.query.get('read')
+        if read is None:
+            return None
+        if read.lower() not in ['true', 'false']:
+            raise ValueError('read must be true or false')
+        return read.lower() == 'true'
+
+
+    def int_parameter(self, name, default=None, minimum=0):
+        value = self.query.get(name)
+        if value is None:
+            return default
+        if not value.isdigit() or not minimum <= int(value) <= max_integer:
+            raise ValueError(f'{name} must be a whole number, at least {minimum}')
+        return int(value)
+
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        if status not in [204, 304]:   # These never have a body 
+            self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+
+    def not_modified(self, etag):
+        """ Sends 304 Not Modified if the client already has the response with this ETag
+        :returns True if it was sent """
+        if_none_match = self.headers.get('If-None-Match', '')
+        if if_none_match.strip() == '*' or etag in [ tag.strip() for tag in if_none_match.split(',') ]:
+            self.send_empty(304, { 'ETag': etag })
+            return True
+        return False
+
+
+    def send_books(self, books, etag):
+        """ Sends a JSON array of books, as they are read from the books generator.
+        HTTP/1.1 responses are chunked. For HTTP/1.0 clients, the end of the response is shown by closing the connection. """
+
+        chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        def write(text):
+            data = text.encode('utf-8')
+            if chunked:
+                self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        parts = ['[']
+        size = 1
+        for n, book in enumerate(books):
+            part = (', ' if n else '') + json.dumps(book_json(book))
+            parts.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                write(''.join(parts))
+                parts = []
+                size = 0
+        parts.append(']')
+        write(''.join(parts))
+
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+
+
+def book_json(book):
+    return { 'id': book.id, 'title': book.title, 'author': book.author, 'read': bool(book.read) }
+
+
+def wait(future):
+    """ Waits for a save or delete to be committed, if the store's write queue is on and it returned a Future """
+    if future is not None:
+        future.result()
+
+
+def list_etag(store):
+    """ The ETag for list responses. It changes whenever a book is added, changed or deleted.
+    Read before the books, so if a book changes while they're read, the next request gets a different ETag. """
+    return f'"{store.change_seq()}"'
+
+
+def list_books(handler, store):
+    read = handler.read_filter()
+    after_id = handler.int_parameter('after_id')
+    limit = handler.int_parameter('limit', minimum=1)
+
+    etag = list_etag(store)
+    if handler.not_modified(etag):
+        return
+
+    if after_id is not None or limit is not None:
+        books = store.page(after_id or 0, limit, read)
+    elif read is None:
+        books = store.iter_all_books()
+    else:
+        books = store.iter_books_by_read_value(read)
+    handler.send_books(books, etag)
+
+
+def search_books(handler, store):
+    term = handler.query.get('q', '')
+    mode = handler.query.get('mode', 'substring')
+    limit = handler.int_parameter('limit', minimum=1)
+
+    etag = list_etag(store)
+    if handler.not_modified(etag):
+        return
+    handler.send_books(store.iter_book_search(term, mode, limit), etag)
+
+
+def count_books(handler, store):
+    read = handler.read_filter()
+    if read is None:
+        count = store.book_count()
+    else:
+        count = store.stats(top_authors=0)['read' if read else 'unread']
+    handler.send_json(200, { 'count': count })
+
+
+def find_book(store, id):
+    """ :returns the book with id, from the URL, or None if there isn't one """
+    if int(id) > max_integer:
+        return None   # Too large for SQLite, so there can't be a book with this id 
+    return store.get_book_by_id(int(id))
+
+
+def get_book(handler, store, id):
+    book = find_book(store, id)
+    if book is None:
+        return handler.send_json(404, { 'error': f'No book with id {id}' })
+    handler.send_json(200, book_json(book))
+
+
+def add_book(handler, store):
+    data = handler.read_json()
+    if not isinstance(data.get('title'), str) or not isinstance(data.get('author'), str):
+        raise ValueError('title and author are required')
+
+    book = Book(data['title'], data['author'], ui.parse_read(data.get('read')))
+    try:
+        wait(book.save())
+    except BookError as error:
+        return handler.send_json(409, { 'error': str(error) })
+    handler.send_json(201, book_json(book), { 'Location': f'/books/{book.id}' })
+
+
+def update_book(handler, store, id):
+    data = handler.read_json()
+    book = find_book(store, id)
+    if book is None:
+        return handler.send_json(404, { 'error': f'No book with id {id}' })
+
+    for field in ['title', 'author']:
+        if field in data:
+            if not isinstance(data[field], str):
+                raise ValueError(f'{field} must be text')
+            setattr(book, field, data[field])
+    if 'read' in data:
+        book.read = ui.parse_read(data['read'])
+
+    try:
+        wait(book.save())
+    except BookError as error:
+        return handler.send_json(409, { 'error': str(error) })
+    handler.send_json(200, book_json(book))
+
+
+def delete_book(handler, store, id):
+    try:
+        if int(id) > max_integer:
+            raise BookError(f'No book with id {id}')
+        wait(Book(None, None, id=int(id)).delete())
+    except BookError:
+        return handler.send_json(404, { 'error': f'No book with id {id}' })
+    handler.send_empty(204)
+
+
+ROUTES = [
+    ('GET', r'/books', list_books),
+    ('POST', r'/books', add_book),
+    ('GET', r'/books/search', search_books),
+    ('GET', r'/books/count', count_books),
+    ('GET', r'/books/(\d+)', get_book),
+    ('PUT', r'/books/(\d+)', update_book),
+    ('DELETE', r'/books/(\d+)', delete_book),
+]
@@ -0,0 +1,128 @@
+from unittest import TestCase
+from unittest.mock import patch
+import asyncio
+import os
+import threading
+
+import bookstore
+from bookstore import Book, BookStore, BookError
+from async_bookstore import AsyncBookStore
+
+
+class TestAsyncBookstore(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+
+
+    def run_with_store(self, test, max_workers=4):
+        """ Runs the coroutine function test with a new AsyncBookStore """
+        async def run():
+            async with AsyncBookStore(max_workers) as store:
+                return await test(store)
+        return asyncio.run(run())
+
+
+    def test_add_and_get(self):
+        async def test(store):
+            book = await store.add(Book('Title', 'Author'))
+            self.assertIsNotNone(book.id)
+            self.assertEqual(book, await store.get_book_by_id(book.id))
+            self.assertEqual(1, await store.book_count())
+            self.assertTrue(await store.exact_match(Book('TITLE', 'author')))
+            self.assertEqual(['Title'], await store.autocomplete('tit'))
+
+        self.run_with_store(test)
+
+
+    def test_add_duplicate_errors(self):
+        async def test(store):
+            await store.add(Book('Title', 'Author'))
+            with self.assertRaises(BookError):
+                await store.add(Book('Title', 'Author'))
+
+        self.run_with_store(test)
+
+
+    def test_update_delete_and_queries(self):
+        async def test(store):
+            bk1 = await store.add(Book('An Interesting Book', 'Ann Author'))
+            bk2 = await store.add(Book('Collection of words', 'Creative Creator'))
+
+            bk1.read = True
+            await store.update(bk1)
+            self.assertEqual([bk1], await store.get_books_by_read_value(True))
+            self.assertEqual([bk2], await store.book_search('words'))
+            self.assertCountEqual([bk1, bk2], await store.get_all_books())
+
+            await store.delete(bk2)
+            self.assertEqual([bk1], await store.get_all_books())
+
+            await store.delete_all_books()
+            self.assertEqual(0, await store.book_count())
+
+        self.run_with_store(test)
+
+
+    def test_writes_happen_in_order(self):
+        async def test(store):
+            book = await store.add(Book('Title', 'Author'))
+            updates = []
+            for n in range(50):
+                changed = Book(f'Title {n}', 'Author', n % 2 == 0, book.id)
+                updates.append(store.update(changed))
+            await asyncio.gather(*updates)
+            self.assertEqual(Book('Title 49', 'Author', False, book.id), await store.get_book_by_id(book.id))
+
+        self.run_with_store(test)
+
+
+    def test_async_iteration(self):
+        self.BS.add_books( (f'Title {n}', 'Author', n % 2 == 0) for n in range(25) )
+
+        async def test(store):
+            all_books = [ book async for book in store.iter_all_books(page_size=4) ]
+            read_books = [ book async for book in store.iter_books_by_read_value(True, page_size=4) ]
+            return all_books, read_books
+
+        all_books, read_books = self.run_with_store(test)
+        self.assertEqual(self.BS.get_all_books(), all_books)
+        self.assertEqual(self.BS.get_books_by_read_value(True), read_books)
+
+
+    def test_concurrent_readers_do_not_wait_for_each_other(self):
+        book = Book('Title', 'Author')
+        book.save()
+
+        # Each read waits inside a SQLite query until three queries are running at once, on the store's connections. 
+        # If reads queued behind each other, or shared one connection, the barrier would time out and the reads would fail. 
+        barrier = threading.Barrier(3, timeout=5)
+        reader_threads = set()
+        connections = []
+        get_book_by_id = self.BS.get_book_by_id
+
+        def slow_get_book_by_id(book_id):
+            reader_threads.add(threading.get_ident())
+            con = self.BS._connection()
+            if con not in connections:
+                connections.append(con)
+                con.create_function('wait_for_readers', 0, barrier.wait)
+            con.execute('SELECT title FROM books WHERE rowid = ? AND wait_for_readers() IS NOT NULL', (book_id, )).fetchall()
+            return get_book_by_id(book_id)
+
+        async def test(store):
+            return await asyncio.gather(*[ store.get_book_by_id(book.id) for n in range(3) ])
+
+        with patch.object(self.BS, 'get_book_by_id', slow_get_book_by_id):
+            results = self.run_with_store(test, max_workers=3)
+
+        self.assertEqual([book, book, book], results)
+        self.assertEqual(3, len(reader_threads))
+        self.assertEqual(3, len(connections))   # Each reader used its own connection 
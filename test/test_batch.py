@@ -0,0 +1,171 @@
+from unittest import TestCase
+import io
+import json
+import os 
+import sqlite3
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import bookstore 
+from bookstore import Book, BookStore
+
+import batch
+
+
+class TestBatch(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+
+
+    def run_script(self, script, group_size=1000):
+        out = io.StringIO()
+        counts = batch.run_batch(io.StringIO(script), out, group_size)
+        return counts, [ json.loads(line) for line in out.getvalue().splitlines() ]
+
+
+    def test_text_commands(self):
+        counts, results = self.run_script('add "The Hobbit" "J.R.R. Tolkien" read\n'
+                                          'add Dune "Frank Herbert"\n'
+                                          '\n'
+                                          '# comments and blank lines are skipped\n'
+                                          'search hobbit\n'
+                                          'unread 1-1000\n'
+                                          'list unread\n')
+        self.assertEqual((5, 0), counts)
+        hobbit_id, dune_id = results[0]['id'], results[1]['id']
+        self.assertEqual({'line': 1, 'command': 'add', 'ok': True, 'id': hobbit_id}, results[0])
+        self.assertEqual([{'id': hobbit_id, 'title': 'The Hobbit', 'author': 'J.R.R. Tolkien', 'read': True}], results[2]['books'])
+        self.assertEqual(5, results[2]['line'])
+        self.assertEqual([hobbit_id, dune_id], results[3]['affected'])
+        self.assertEqual(['The Hobbit', 'Dune'], [ book['title'] for book in results[4]['books'] ])
+
+
+    def test_json_commands(self):
+        self.BS.add_books([ Book('The Hobbit', 'J.R.R. Tolkien'), Book('Dune', 'Frank Herbert') ])
+        counts, results = self.run_script('{"command": "read", "term": "tolkien"}\n'
+                                          '{"command": "search", "term": "dune", "limit": 1}\n'
+                                          '{"command": "delete", "term": "dune"}\n'
+                                          '{"command": "add", "title": "Emma", "author": "Jane Austen", "read": "yes"}\n')
+        self.assertEqual((4, 0), counts)
+        self.assertEqual(1, len(results[0]['affected']))
+        self.assertEqual('Dune', results[1]['books'][0]['title'])
+        self.assertEqual(['The Hobbit', 'Emma'], [ book.title for book in self.BS.get_books_by_read_value(True) ])
+
+
+    def test_failed_commands_reported_and_others_run(self):
+        counts, results = self.run_script('add Dune "Frank Herbert"\n'
+                                          'add DUNE "frank herbert"\n'
+                                          'delete 1000000\n'
+                                          'fly away\n'
+                                          'add "Missing author"\n'
+                                          '{"command": "search", "term": "x", "mode": "regex"}\n'
+                                          '{"command": "add", "title": "No author"}\n'
+                                          '{not json\n'
+                                          'add Emma "Jane Austen"\n', group_size=3)
+        self.assertEqual((9, 6), counts)
+        self.assertEqual([True, False, True, False, False, False, False, False, True], [ result['ok'] for result in results ])
+        self.assertEqual('Unknown command fly', results[3]['error'])
+        self.assertEqual('add needs a title and an author', results[4]['error'])
+        self.assertEqual([1000000], results[2]['missing'])
+        self.assertEqual(['Dune', 'Emma'], [ book.title for book in self.BS.get_all_books() ])
+
+
+    def test_json_arguments_of_the_wrong_type_fail_alone(self):
+        counts, results = self.run_script('add Dune "Frank Herbert"\n'
+                                          '{"command": "read", "ids": "abc"}\n'
+                                          '{"command": "read", "ids": [1, "2"]}\n'
+                                          '{"command": "add", "title": ["x"], "author": "Someone"}\n'
+                                          '{"command": "search", "term": "dune", "limit": "x"}\n'
+                                          '{"command": "search", "term": "dune", "limit": 1}\n'
+                                          '{"command": "delete", "term": ""}\n')
+        self.assertEqual((7, 5), counts)
+        self.assertEqual([True, False, False, False, False, True, False], [ result['ok'] for result in results ])
+        self.assertEqual('ids must be a list of whole numbers', results[1]['error'])
+        self.assertEqual('title must be text', results[3]['error'])
+        self.assertEqual('limit must be a whole number', results[4]['error'])
+        self.assertEqual(['Dune'], [ book.title for book in self.BS.get_all_books() ])
+
+
+    def test_database_errors_fail_alone(self):
+        self.BS.add_books([ Book('Dune', 'Frank Herbert') ])
+        locked = Mock(side_effect=sqlite3.OperationalError('database is locked'))
+        with patch.dict(batch.COMMANDS, { 'list': locked }):
+            counts, results = self.run_script('add Emma "Jane Austen"\n'
+                                              '{"command": "delete", "ids": [99999999999999999999]}\n'
+                                              'list\n'
+                                              'search dune\n')
+        self.assertEqual((4, 2), counts)
+        self.assertEqual([True, False, False, True], [ result['ok'] for result in results ])
+        self.assertEqual('database is locked', results[2]['error'])
+        self.assertEqual(['Dune', 'Emma'], [ book.title for book in self.BS.get_all_books() ])
+
+
+    def test_query_that_fails_writes_only_the_error(self):
+        def failing_books():
+            raise sqlite3.OperationalError('database is locked')
+            yield
+
+        with patch.object(BookStore.instance, 'iter_all_books', Mock(return_value=failing_books())):
+            counts, results = self.run_script('list\nlist read\n')
+        self.assertEqual((2, 1), counts)
+        self.assertEqual({ 'line': 1, 'command': 'list', 'ok': False, 'error': 'database is locked' }, results[0])
+        self.assertEqual([], results[1]['books'])
+
+
+    def test_commands_grouped_into_transactions(self):
+        script = ''.join( f'add "Title {n}" Author\n' for n in range(10) )
+        commits = []
+        con = self.BS._connection()
+        con.set_trace_callback(lambda sql: commits.append(sql) if sql == 'COMMIT' else None)
+        try:
+            counts, results = self.run_script(script, group_size=4)
+        finally:
+            con.set_trace_callback(None)
+        self.assertEqual((10, 0), counts)
+        self.assertEqual(3, len(commits))
+        self.assertEqual(10, self.BS.book_count())
+
+
+    def test_group_size_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            self.run_script('add a b\n', group_size=0)
+
+
+    def test_no_transaction_while_waiting_for_input(self):
+        read_end, write_end = os.pipe()
+        other_writes = []
+
+        def write_script():
+            with open(write_end, 'w') as script:
+                script.write('add First Author\n')
+                script.flush()
+                time.sleep(0.3)   # The first command is run while the script waits here 
+                con = sqlite3.connect(bookstore.db, timeout=0)
+                try:
+                    con.execute('BEGIN IMMEDIATE')
+                    con.rollback()
+                    other_writes.append('ok')
+                except sqlite3.OperationalError as error:
+                    other_writes.append(str(error))
+                con.close()
+                script.write('add Second Author\n')
+
+        writer = threading.Thread(target=write_script)
+        writer.start()
+        with open(read_end) as script:
+            out = io.StringIO()
+            counts = batch.run_batch(script, out, group_size=10)
+        writer.join()
+
+        self.assertEqual(['ok'], other_writes)
+        self.assertEqual((2, 0), counts)
+        self.assertEqual(['First', 'Second'], [ book.title for book in self.BS.get_all_books() ])
@@ -51,5 +51,25 @@ class TestBook(TestCase):
         # Check DB has same data as bk Book object 
         self.assertEqual(bk, store.get_book_by_id(bk.id))
         self.assertTrue(bk, store.exact_match(bk))
-        
 
+
+    def test_book_has_no_dict(self):
+        bk = Book('Title', 'Author')
+        self.assertFalse(hasattr(bk, '__dict__'))
+        with self.assertRaises(AttributeError):
+            bk.not_a_book_attribute = 'anything'
+
+
+    def test_create_book_does_not_create_store(self):
+        store = BookStore.instance
+        try:
+            BookStore.instance = None
+            Book('Title', 'Author')
+            self.assertIsNone(BookStore.instance)
+        finally:
+            BookStore.instance = store
+
+
+    def test_equal_books_have_same_hash(self):
+        self.assertEqual(hash(Book('A', 'B', True, 1)), hash(Book('A', 'B', True, 1)))
+        self.assertNotEqual(Book('A', 'B', True, 1), Book('A', 'B', False, 1))
@@ -1,5 +1,13 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
+import csv
+import gzip
+import io
+import json
 import os 
+import sqlite3
+import tempfile
+import threading
+import time
 
 import bookstore 
 from bookstore import Book, BookStore, BookError
@@ -259,4 +267,1513 @@ class TestBookstore(TestCase):
         self.assertCountEqual([self.bk2, self.bk3], read_books)
 
 
+    def test_connection_reused_by_thread(self):
+        self.assertIs(self.BS._connection(), self.BS._connection())
 
+
+    def test_each_thread_has_own_connection(self):
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(self.BS._connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], self.BS._connection())
+
+
+    def test_close_then_use_store_again(self):
+        self.add_test_data()
+        self.BS.close()
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def test_rebind_when_db_changes(self):
+        self.add_test_data()
+        original_db = bookstore.db
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                bookstore.db = os.path.join(tmp, 'other_books.db')
+                self.assertEqual(0, self.BS.book_count())
+                Book('Other', 'Other').save()
+                self.assertEqual(1, self.BS.book_count())
+            finally:
+                self.BS.close()
+                bookstore.db = original_db
+
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def test_add_books_bulk(self):
+        books = [Book('Bulk 1', 'Author'), Book('Bulk 2', 'Author', True)]
+        result = self.BS.add_books(books)
+        self.assertEqual(2, result.added)
+        self.assertEqual([], result.duplicates)
+        self.assertEqual(2, self.BS.book_count())
+        for book in books:
+            self.assertEqual(book, self.BS.get_book_by_id(book.id))
+
+
+    def test_add_books_from_tuples_generator(self):
+        result = self.BS.add_books( (f'Title {n}', 'Author', n % 2 == 0) for n in range(25) )
+        self.assertEqual(25, result.added)
+        self.assertEqual(13, len(self.BS.get_books_by_read_value(True)))
+
+
+    def test_add_books_reports_duplicates_without_aborting(self):
+        self.add_test_data()
+        in_store = Book('an interesting book', 'ANN AUTHOR')
+        new_book = Book('New', 'New')
+        repeated = Book('NEW', 'new')
+        result = self.BS.add_books([in_store, new_book, repeated])
+
+        self.assertEqual(1, result.added)
+        self.assertEqual([in_store, repeated], result.duplicates)
+        self.assertIsNone(in_store.id)
+        self.assertIsNone(repeated.id)
+        self.assertEqual(new_book, self.BS.get_book_by_id(new_book.id))
+        self.assertEqual(4, self.BS.book_count())
+
+
+    def test_add_books_many_batches(self):
+        books = [ Book(f'Title {n}', f'Author {n % 3}') for n in range(10) ]
+        result = self.BS.add_books(books + [Book('Title 4', 'Author 1')], batch_size=3)
+        self.assertEqual(10, result.added)
+        self.assertEqual(1, len(result.duplicates))
+        self.assertEqual(10, len({ book.id for book in books }))
+        self.assertCountEqual(books, self.BS.get_all_books())
+
+
+    def test_search_substring_limit(self):
+        self.add_test_data()
+        self.assertEqual(1, len(self.BS.book_search('Book', limit=1)))
+
+
+    def test_transaction_commits_together(self):
+        with self.BS.transaction():
+            Book('First', 'Author').save()
+            Book('Second', 'Author').save()
+            self.assertEqual(2, self.BS.book_count())   # Visible inside the block before commit 
+            self.assertTrue(self.BS._connection().in_transaction)
+        self.assertFalse(self.BS._connection().in_transaction)
+        self.assertEqual(2, self.BS.book_count())
+
+
+    def test_transaction_rolled_back_on_exception(self):
+        self.add_test_data()
+        with self.assertRaises(RuntimeError):
+            with self.BS.transaction():
+                Book('New', 'Book').save()
+                self.bk1.delete()
+                raise RuntimeError('Stop')
+        self.assertCountEqual([self.bk1, self.bk2, self.bk3], self.BS.get_all_books())
+
+
+    def test_failed_write_in_transaction_only_undoes_itself(self):
+        self.add_test_data()
+        with self.BS.transaction():
+            Book('New', 'Book').save()
+            with self.assertRaises(BookError):
+                Book('an interesting book', 'ann author').save()
+            with self.assertRaises(BookError):
+                Book('Missing', 'Book', id=1000000).save()
+            self.bk2.delete()
+        self.assertEqual(3, self.BS.book_count())
+        self.assertTrue(self.BS.exact_match(Book('New', 'Book')))
+        self.assertIsNone(self.BS.get_book_by_id(self.bk2.id))
+
+
+    def test_nested_transactions_join_outer(self):
+        with self.assertRaises(RuntimeError):
+            with self.BS.transaction():
+                with self.BS.transaction():
+                    Book('Inner', 'Book').save()
+                self.assertTrue(self.BS._connection().in_transaction)
+                raise RuntimeError('Stop')
+        self.assertEqual(0, self.BS.book_count())
+
+
+    def test_nested_transaction_rolled_back_alone(self):
+        with self.BS.transaction():
+            Book('Outer', 'Book').save()
+            try:
+                with self.BS.transaction():
+                    Book('Inner', 'Book').save()
+                    raise RuntimeError('Stop')
+            except RuntimeError:
+                pass
+            Book('After', 'Book').save()
+        self.assertEqual(['Outer', 'After'], [ book.title for book in self.BS.get_all_books() ])
+
+
+    def test_transaction_results_not_cached(self):
+        self.add_test_data()
+        self.BS.enable_cache()
+        try:
+            with self.assertRaises(RuntimeError):
+                with self.BS.transaction():
+                    self.bk1.title = 'Changed'
+                    self.bk1.save()
+                    self.assertEqual('Changed', self.BS.get_book_by_id(self.bk1.id).title)
+                    raise RuntimeError('Stop')
+            self.assertEqual('An Interesting Book', self.BS.get_book_by_id(self.bk1.id).title)
+        finally:
+            self.BS.disable_cache()
+
+
+    def test_stats(self):
+        self.add_test_data()
+        self.BS.add_books([ Book('Another', 'ann author', True), Book('Third', 'Ann Author') ])
+        stats = self.BS.stats(top_authors=2)
+        self.assertEqual({'books': 5, 'read': 2, 'unread': 3, 'authors': 3}, { key: stats[key] for key in ['books', 'read', 'unread', 'authors'] })
+        self.assertEqual([ {'author': 'Ann Author', 'books': 3, 'read': 2}, {'author': 'B. Bookwriter', 'books': 1, 'read': 0} ], stats['top_authors'])
+
+
+    def test_stats_follow_changes(self):
+        self.add_test_data()
+        self.bk2.author = 'Ann Author'
+        self.bk2.read = True
+        self.bk2.save()
+        self.BS.set_read(False, [self.bk1.id])
+        self.bk3.delete()
+        stats = self.BS.stats()
+        self.assertEqual((2, 1, 1), (stats['books'], stats['read'], stats['authors']))
+        self.assertEqual([ {'author': 'Ann Author', 'books': 2, 'read': 1} ], stats['top_authors'])
+        self.assertEqual(2, self.BS.book_count())
+
+        self.BS.delete_all_books()
+        self.assertEqual({'books': 0, 'read': 0, 'unread': 0, 'authors': 0, 'top_authors': []}, self.BS.stats())
+        self.assertEqual([], self.BS.check_stats())
+
+
+    def test_check_and_rebuild_stats(self):
+        self.add_test_data()
+        self.assertEqual([], self.BS.check_stats())
+
+        con = self.BS._connection()
+        con.execute('UPDATE book_totals SET books = 10')
+        con.execute("UPDATE author_stats SET read = 5 WHERE author = 'Ann Author'")
+        con.commit()
+        self.assertEqual(['Total books is 10, should be 3', 'Ann Author has 1 books, 5 read, should be 1 books, 1 read'], self.BS.check_stats())
+
+        self.BS.rebuild_stats()
+        self.assertEqual([], self.BS.check_stats())
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def test_duplicates_ignore_case_accents_and_spaces(self):
+        Book('\u00c9mile', 'Jean-Jacques Rousseau').save()
+        for title, author in [ ('\u00e9MILE', 'jean-jacques  rousseau'), ('E\u0301mile', ' Jean-Jacques Rousseau'), ('\u00c9mile', '\uff2aEAN-JACQUES ROUSSEAU') ]:
+            self.assertTrue(self.BS.exact_match(Book(title, author)))
+            with self.assertRaises(BookError):
+                Book(title, author).save()
+        self.assertFalse(self.BS.exact_match(Book('Emile', 'Jean-Jacques Rousseau')))
+
+        result = self.BS.add_books([ ('\u00c9MILE', 'Jean-Jacques Rousseau'), ('Stra\u00dfe', 'Author'), ('STRASSE', 'author') ])
+        self.assertEqual(1, result.added)
+        self.assertEqual(['\u00c9MILE', 'STRASSE'], [ book.title for book in result.duplicates ])
+
+
+    def test_update_to_duplicate(self):
+        self.add_test_data()
+        self.bk2.title = 'AN  INTERESTING BOOK'
+        self.bk2.author = 'ann author'
+        with self.assertRaises(BookError):
+            self.bk2.save()
+        self.assertEqual('Booky Book Book', self.BS.get_book_by_id(self.bk2.id).title)
+
+
+    def test_book_without_keys_can_be_saved(self):
+        Book('\u00c9mile', 'Rousseau').save()
+        duplicate = Book('\u00e9mile', 'Rousseau')
+        self.BS._write(lambda con: con.execute("INSERT INTO books (title, author, read) VALUES (?, ?, 0)", (duplicate.title, duplicate.author) ))
+        duplicate.id = self.BS._connection().execute('SELECT MAX(rowid) FROM books').fetchone()[0]
+        self.assertEqual([duplicate.id], self.BS.rebuild_keys())
+
+        duplicate.read = True
+        duplicate.save()
+        self.assertTrue(self.BS.get_book_by_id(duplicate.id).read)
+        duplicate.title = '\u00c9MILE'
+        with self.assertRaises(BookError):
+            duplicate.save()
+        duplicate.title = 'Emile, or On Education'
+        duplicate.save()
+        self.assertEqual([], self.BS.rebuild_keys())
+
+
+    def test_dedupe_articles(self):
+        Book('Hobbit', 'Tolkien').save()
+        the_hobbit = Book('The Hobbit', 'Tolkien')
+        the_hobbit.save()
+        try:
+            bookstore.dedupe_articles = ('the', 'a', 'an')
+            self.assertEqual([the_hobbit.id], self.BS.rebuild_keys())
+            self.assertTrue(self.BS.exact_match(Book('A Hobbit', 'Tolkien')))
+            with self.assertRaises(BookError):
+                Book('An Hobbit', 'Tolkien').save()
+            Book('The', 'Tolkien').save()   # A title that is only an article is kept 
+        finally:
+            bookstore.dedupe_articles = ()
+            self.BS.rebuild_keys()
+
+
+    def test_changes_since(self):
+        start = self.BS.change_seq()
+        self.add_test_data()
+        self.bk1.title = 'Changed'
+        self.bk1.save()
+        self.BS.set_read(True, [self.bk2.id])
+        self.bk3.delete()
+
+        changes = list(self.BS.changes_since(start))
+        self.assertEqual(['insert', 'insert', 'insert', 'update', 'update', 'delete'], [ change.operation for change in changes ])
+        self.assertEqual(changes[-1].seq, self.BS.change_seq())
+        self.assertEqual(('Changed', self.bk1.id), (changes[3].book.title, changes[3].book.id))
+        self.assertTrue(changes[4].book.read)
+        self.assertEqual(('Collection of words', self.bk3.id), (changes[5].book.title, changes[5].book.id))
+        self.assertAlmostEqual(time.time(), changes[0].time, delta=60)
+
+        seqs = [ change.seq for change in changes ]
+        self.assertEqual(sorted(seqs), seqs)
+        self.assertEqual(seqs[4:], [ change.seq for change in self.BS.changes_since(seqs[3]) ])
+        self.assertEqual(seqs[:2], [ change.seq for change in self.BS.changes_since(start, limit=2) ])
+        self.assertEqual([], list(self.BS.changes_since(self.BS.change_seq())))
+
+
+    def test_changes_since_records_bulk_writes(self):
+        start = self.BS.change_seq()
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(5) )
+        self.BS.delete_books(term='Title 1')
+        self.BS.delete_all_books()
+        operations = [ change.operation for change in self.BS.changes_since(start) ]
+        self.assertEqual(['insert'] * 5 + ['delete'] * 5, operations)
+
+
+    def test_changes_not_recorded_for_rolled_back_writes(self):
+        start = self.BS.change_seq()
+        with self.assertRaises(RuntimeError):
+            with self.BS.transaction():
+                Book('Rolled back', 'Author').save()
+                raise RuntimeError('Stop')
+        self.assertEqual([], list(self.BS.changes_since(start)))
+
+
+    def test_compact_changes_keeps_latest_change_to_each_book(self):
+        start = self.BS.change_seq()
+        self.add_test_data()
+        for title in ['One', 'Two', 'Three']:
+            self.bk1.title = title
+            self.bk1.save()
+        self.bk2.delete()
+        seq = self.BS.change_seq()
+
+        self.assertGreaterEqual(self.BS.compact_changes(), 3)
+        journal = self.BS._connection().execute('SELECT operation, book, title FROM book_changes WHERE seq > ? ORDER BY seq', (start, )).fetchall()
+        self.assertEqual([ ('insert', self.bk3.id, self.bk3.title), ('update', self.bk1.id, 'Three'), ('delete', self.bk2.id, self.bk2.title) ], journal)
+        with self.assertRaises(bookstore.ChangesCompactedError):
+            self.BS.changes_since(start)
+        self.assertEqual([], list(self.BS.changes_since(seq)))   # Copies that are up to date aren't affected 
+
+
+    def test_compact_changes_makes_copies_behind_reload(self):
+        dune = Book('Dune', 'Frank Herbert')
+        dune.save()
+        behind = self.BS.change_seq()
+        dune.title = 'Dune 2'
+        dune.save()
+        Book('Dune', 'Frank Herbert').save()
+        dune.title = 'Dune 3'
+        dune.save()
+
+        self.BS.compact_changes()
+        # Replaying only the changes left, the new Dune then the rename, would clash with the copy's old Dune 
+        with self.assertRaises(bookstore.ChangesCompactedError):
+            self.BS.changes_since(behind)
+
+
+    def test_compact_changes_before_seq(self):
+        start = self.BS.change_seq()
+        self.add_test_data()
+        middle = self.BS.change_seq()
+        Book('Later', 'Author').save()
+
+        self.BS.compact_changes(before_seq=middle)
+        with self.assertRaises(bookstore.ChangesCompactedError):
+            self.BS.changes_since(start)
+        self.assertEqual(['Later'], [ change.book.title for change in self.BS.changes_since(middle) ])
+
+        self.BS.compact_changes(before_seq=start)   # Doesn't go back 
+        with self.assertRaises(bookstore.ChangesCompactedError):
+            self.BS.changes_since(middle - 1)
+        self.assertEqual(middle + 1, self.BS.change_seq())
+
+
+    def test_backup_while_in_use(self):
+        self.add_test_data()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'backup.db')
+            progress = []
+            def step(copied, total):
+                progress.append( (copied, total) )
+                if len(progress) == 1:
+                    Book('Saved during backup', 'Author').save()   # Writes can be made between steps 
+
+            self.assertEqual(path, self.BS.backup(path, pages_per_step=1, progress=step))
+            self.assertGreater(len(progress), 1)
+            self.assertEqual(progress[-1][0], progress[-1][1])
+            self.assertEqual(['backup.db'], os.listdir(directory))
+
+            con = sqlite3.connect(path)
+            titles = [ row[0] for row in con.execute('SELECT title FROM books') ]
+            con.close()
+            self.assertIn('An Interesting Book', titles)
+            self.assertIn('Saved during backup', titles)   # The backup started again after the write
+
+
+    def test_backup_to_itself(self):
+        with self.assertRaises(BookError):
+            self.BS.backup(bookstore.db)
+
+
+    def test_snapshots_keep_newest(self):
+        self.add_test_data()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [ self.BS.snapshot(directory, keep=2) for n in range(4) ]
+            self.assertEqual(paths[2:], self.BS.snapshots(directory))
+            self.assertRegex(os.path.basename(paths[0]), r'^test_books-\d{8}-\d{6}-\d{6}\.db$')
+
+
+    def test_schedule_snapshots(self):
+        with tempfile.TemporaryDirectory() as directory:
+            schedule = self.BS.schedule_snapshots(directory, 0.01, keep=3)
+            try:
+                deadline = time.time() + 5
+                while len(self.BS.snapshots(directory)) < 3 and time.time() < deadline:
+                    time.sleep(0.01)
+            finally:
+                schedule.stop()
+            self.assertEqual(3, len(self.BS.snapshots(directory)))
+            self.assertFalse(schedule.is_alive())
+
+
+    def test_restore(self):
+        self.add_test_data()
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.BS.backup(os.path.join(directory, 'backup.db'))
+            self.BS.enable_cache()
+            try:
+                self.assertEqual(3, self.BS.book_count())
+                self.bk1.delete()
+                Book('Added after backup', 'Author').save()
+                seq = self.BS.change_seq()
+
+                self.BS.restore(path)
+                self.assertEqual(3, self.BS.book_count())
+                self.assertEqual('An Interesting Book', self.BS.get_book_by_id(self.bk1.id).title)
+                self.assertEqual([], self.BS.book_search('Added after backup'))
+                self.assertEqual([], self.BS.check_stats())
+            finally:
+                self.BS.disable_cache()
+
+            with self.assertRaises(bookstore.ChangesCompactedError):
+                self.BS.changes_since(seq)
+            self.assertGreater(self.BS.change_seq(), seq)
+
+
+    def test_restore_while_another_thread_reads(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(3 * bookstore.fetch_batch_size) )
+        started = threading.Event()
+        restored = threading.Event()
+        results = []
+
+        def reader():
+            try:
+                books = self.BS.iter_all_books()
+                count = 1 if next(books) else 0
+                started.set()
+                restored.wait(5)
+                results.append(count + sum(1 for book in books))
+                results.append(self.BS.book_count())
+            except Exception as error:
+                results.append(error)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.BS.backup(os.path.join(directory, 'backup.db'))
+            self.BS.add_books([ ('Added after backup', 'Author') ])
+            thread = threading.Thread(target=reader)
+            thread.start()
+            started.wait(5)
+            try:
+                self.BS.restore(path)
+            finally:
+                restored.set()
+                thread.join()
+
+        total = 3 * bookstore.fetch_batch_size
+        self.assertEqual([total + 1, total], results)
+
+
+    def test_restore_rejects_other_files(self):
+        self.add_test_data()
+        with tempfile.TemporaryDirectory() as directory:
+            not_a_database = os.path.join(directory, 'books.csv')
+            with open(not_a_database, 'w') as f:
+                f.write('title,author\n' * 100)
+            other_database = os.path.join(directory, 'other.db')
+            sqlite3.connect(other_database).execute('CREATE TABLE other (x)').connection.close()
+
+            for path in [not_a_database, other_database, os.path.join(directory, 'missing.db')]:
+                with self.assertRaises(BookError):
+                    self.BS.restore(path)
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def test_restore_in_transaction(self):
+        with self.assertRaises(BookError):
+            with self.BS.transaction():
+                self.BS.restore(bookstore.db)
+
+
+    def test_autocomplete_titles(self):
+        self.add_test_data()
+        Book('Book of Days', 'Someone').save()
+        Book('book of days', 'Someone Else').save()
+        self.assertEqual(['Book of Days', 'Booky Book Book'], self.BS.autocomplete('bOOk'))
+        self.assertEqual(['Booky Book Book'], self.BS.autocomplete('  booky'))
+        self.assertEqual(['Book of Days'], self.BS.autocomplete('book', limit=1))
+        self.assertEqual([], self.BS.autocomplete('xyz'))
+        self.assertEqual([], self.BS.autocomplete(''))
+
+
+    def test_autocomplete_authors_once_each(self):
+        self.add_test_data()
+        self.BS.add_books( (f'Title {n}', 'Ann Author') for n in range(5) )
+        self.assertEqual(['Ann Author'], self.BS.autocomplete('ann', 'author'))
+        self.assertEqual(['Ann Author', 'B. Bookwriter'], self.BS.autocomplete('a', 'author') + self.BS.autocomplete('b', 'author'))
+
+
+    def test_autocomplete_follows_changes(self):
+        self.add_test_data()
+        self.bk3.title = 'Anthology'
+        self.bk3.save()
+        self.assertEqual(['An Interesting Book', 'Anthology'], self.BS.autocomplete('an'))
+        self.bk1.delete()
+        self.assertEqual(['Anthology'], self.BS.autocomplete('an'))
+
+
+    def test_autocomplete_unknown_field_errors(self):
+        with self.assertRaises(ValueError):
+            self.BS.autocomplete('a', 'read')
+
+
+    def test_search_unknown_mode_errors(self):
+        with self.assertRaises(ValueError):
+            self.BS.book_search('Book', mode='regex')
+
+
+    def test_search_words_falls_back_to_substring_without_full_text_search(self):
+        self.add_test_data()
+        full_text_search = self.BS.full_text_search
+        try:
+            self.BS.full_text_search = False
+            self.assertCountEqual([self.bk1, self.bk2], self.BS.book_search('ook', mode='words'))
+            self.assertCountEqual([self.bk1, self.bk2], self.BS.book_search('ook', mode='fuzzy'))
+        finally:
+            self.BS.full_text_search = full_text_search
+
+
+
+    def test_iter_all_books(self):
+        self.add_test_data()
+        books = self.BS.iter_all_books()
+        self.assertEqual(self.bk1, next(books))
+        self.assertEqual([self.bk2, self.bk3], list(books))
+
+
+    def test_iter_all_books_many_fetches(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(25) )
+        original_batch_size = bookstore.fetch_batch_size
+        try:
+            bookstore.fetch_batch_size = 7
+            self.assertEqual(self.BS.get_all_books(), list(self.BS.iter_all_books()))
+            self.assertEqual(25, len(list(self.BS.iter_all_books())))
+        finally:
+            bookstore.fetch_batch_size = original_batch_size
+
+
+    def test_iter_books_stopped_early_then_write(self):
+        self.add_test_data()
+        books = self.BS.iter_all_books()
+        next(books)
+        books.close()
+        Book('After', 'Iterating').save()
+        self.assertEqual(4, self.BS.book_count())
+
+
+    def test_iter_books_by_read_value(self):
+        self.add_test_data()
+        self.assertCountEqual([self.bk2, self.bk3], self.BS.iter_books_by_read_value(False))
+
+
+    def test_iter_book_search(self):
+        self.add_test_data()
+        self.assertCountEqual([self.bk1, self.bk2], self.BS.iter_book_search('book'))
+
+
+    def test_iter_book_search_unknown_mode_errors_straight_away(self):
+        with self.assertRaises(ValueError):
+            self.BS.iter_book_search('book', mode='regex')
+
+
+    def test_page(self):
+        books = [ Book(f'Title {n}', 'Author', n % 2 == 0) for n in range(5) ]
+        self.BS.add_books(books)
+        first_page = self.BS.page(limit=2)
+        self.assertEqual(books[:2], first_page)
+        second_page = self.BS.page(after_id=first_page[-1].id, limit=2)
+        self.assertEqual(books[2:4], second_page)
+        self.assertEqual(books[4:], self.BS.page(after_id=second_page[-1].id, limit=2))
+        self.assertEqual([], self.BS.page(after_id=books[-1].id, limit=2))
+
+
+    def test_page_by_read_value(self):
+        books = [ Book(f'Title {n}', 'Author', n % 2 == 0) for n in range(5) ]
+        self.BS.add_books(books)
+        self.assertEqual([books[0], books[2]], self.BS.page(limit=2, read=True))
+        self.assertEqual([books[4]], self.BS.page(after_id=books[2].id, limit=2, read=True))
+        self.assertEqual([books[1], books[3]], self.BS.page(read=False))
+
+
+    def test_query_combines_filters(self):
+        self.BS.add_books([ ('The Hobbit', 'J.R.R. Tolkien', True), ('The Silmarillion', 'J.R.R. Tolkien'),
+                            ('Unfinished Tales', 'j.r.r. tolkien'), ('The Tolkien Reader', 'Someone Else'), ('Dune', 'Frank Herbert') ])
+        query = self.BS.query()
+        self.assertEqual(['The Silmarillion', 'Unfinished Tales'],
+                         [ book.title for book in query.read(False).author('tolkien').order_by('title').limit(20) ])
+        self.assertEqual(['The Hobbit', 'The Silmarillion', 'Unfinished Tales'],
+                         [ book.title for book in query.author('J.R.R. TOLKIEN', match='exact').all() ])
+        self.assertEqual(['The Hobbit', 'The Silmarillion', 'The Tolkien Reader'],
+                         [ book.title for book in query.title('the', match='prefix').all() ])
+        self.assertEqual(['The Tolkien Reader'], [ book.title for book in query.title('tolkien').all() ])
+        self.assertEqual(5, query.count())
+        self.assertEqual(5, len(query.all()))   # Adding filters doesn't change the query they were added to 
+
+
+    def test_query_ids_order_limit_and_offset(self):
+        books = [ Book(f'Title {n}', f'Author {4 - n}', n % 2 == 0) for n in range(5) ]
+        self.BS.add_books(books)
+        query = self.BS.query()
+        self.assertEqual(books[1:4], query.ids(books[1].id, books[3].id).all())
+        self.assertEqual(books[3:], query.ids(first=books[3].id).all())
+        self.assertEqual(list(reversed(books)), query.order_by('author').all())
+        self.assertEqual([books[3], books[2]], query.order_by('-id').offset(1).limit(2).all())
+        self.assertEqual([books[3], books[1], books[4]], query.order_by('read', '-id').limit(3).all())
+        self.assertEqual(5, query.limit(2).count())
+        self.assertEqual(books[4], query.order_by('-title').first())
+        self.assertIsNone(query.ids(first=books[4].id + 1).first())
+
+
+    def test_query_is_streamed(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(3) )
+        books = iter(self.BS.query().read(False))
+        self.assertEqual('Title 0', next(books).title)
+        self.assertEqual(['Title 1', 'Title 2'], [ book.title for book in books ])
+
+
+    def test_query_search_substring(self):
+        self.add_test_data()
+        query = self.BS.query().search('book', mode='substring')
+        self.assertEqual([self.bk1, self.bk2], query.all())
+        self.assertEqual([self.bk2], query.read(False).all())
+        self.assertEqual(2, query.count())
+
+
+    def test_query_errors(self):
+        with self.assertRaises(ValueError):
+            self.BS.query().search('book', mode='fuzzy')
+        with self.assertRaises(ValueError):
+            self.BS.query().order_by('isbn')
+        with self.assertRaises(ValueError):
+            self.BS.query().title('book', match='sounds like')
+
+
+    def test_set_read_many_ids(self):
+        self.add_test_data()
+        result = self.BS.set_read(True, [self.bk2.id, self.bk3.id, -1, self.bk2.id])
+        self.assertEqual(sorted([self.bk2.id, self.bk3.id]), result.affected)
+        self.assertEqual([-1], result.missing)
+        self.assertEqual(3, len(self.BS.get_books_by_read_value(True)))
+
+
+    def test_set_read_range(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(10) )
+        ids = [ book.id for book in self.BS.get_all_books() ]
+        result = self.BS.set_read(True, range(ids[2], ids[5] + 1))
+        self.assertEqual(ids[2:6], result.affected)
+        self.assertEqual(ids[2:6], [ book.id for book in self.BS.get_books_by_read_value(True) ])
+
+
+    def test_set_read_matching_term(self):
+        self.add_test_data()
+        result = self.BS.set_read(False, term='book')
+        self.assertEqual(sorted([self.bk1.id, self.bk2.id]), result.affected)
+        self.assertEqual([], result.missing)
+        self.assertEqual(0, len(self.BS.get_books_by_read_value(True)))
+
+
+    def test_set_read_needs_ids_or_term(self):
+        with self.assertRaises(ValueError):
+            self.BS.set_read(True)
+        with self.assertRaises(ValueError):
+            self.BS.set_read(True, [1], 'term')
+
+
+    def test_delete_books_many_ids(self):
+        self.add_test_data()
+        result = self.BS.delete_books([self.bk1.id, self.bk3.id, 1000000])
+        self.assertEqual(sorted([self.bk1.id, self.bk3.id]), result.affected)
+        self.assertEqual([1000000], result.missing)
+        self.assertEqual([self.bk2], self.BS.get_all_books())
+
+
+    def test_delete_books_matching_term(self):
+        self.add_test_data()
+        result = self.BS.delete_books(term='CREAT')
+        self.assertEqual([self.bk3.id], result.affected)
+        self.assertCountEqual([self.bk1, self.bk2], self.BS.get_all_books())
+
+
+    def test_blank_term_rejected(self):
+        self.add_test_data()
+        for term in ['', '   ']:
+            with self.assertRaises(ValueError):
+                self.BS.delete_books(term=term)
+            with self.assertRaises(ValueError):
+                self.BS.set_read(True, term=term)
+        self.assertEqual(3, self.BS.book_count())
+        self.assertEqual(1, len(self.BS.get_books_by_read_value(True)))
+
+
+    def test_delete_books_none_found(self):
+        self.add_test_data()
+        result = self.BS.delete_books([])
+        self.assertEqual([], result.affected)
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def export_to_text(self, format, **kwargs):
+        out = io.StringIO()
+        count = self.BS.export(out, format, **kwargs)
+        return count, out.getvalue()
+
+
+    def test_export_csv(self):
+        self.add_test_data()
+        self.bk2.title = 'Booky, "Book" Book'
+        self.bk2.save()
+        count, text = self.export_to_text('csv')
+        self.assertEqual(3, count)
+        rows = list(csv.DictReader(io.StringIO(text)))
+        self.assertEqual(['id', 'title', 'author', 'read'], list(rows[0].keys()))
+        self.assertEqual([str(self.bk1.id), 'An Interesting Book', 'Ann Author', 'true'], list(rows[0].values()))
+        self.assertEqual('Booky, "Book" Book', rows[1]['title'])
+        self.assertEqual('false', rows[2]['read'])
+
+
+    def test_export_jsonl(self):
+        self.add_test_data()
+        count, text = self.export_to_text('jsonl')
+        records = [ json.loads(line) for line in text.splitlines() ]
+        self.assertEqual(3, count)
+        self.assertEqual({'id': self.bk1.id, 'title': 'An Interesting Book', 'author': 'Ann Author', 'read': True}, records[0])
+        self.assertEqual([self.bk1.id, self.bk2.id, self.bk3.id], [ record['id'] for record in records ])
+
+
+    def test_export_sql_dump_loads_into_new_database(self):
+        self.add_test_data()
+        self.bk3.author = "O'Brien"
+        self.bk3.save()
+        count, text = self.export_to_text('sql')
+        self.assertEqual(3, count)
+
+        con = sqlite3.connect(':memory:')
+        con.executescript(text)
+        rows = con.execute('SELECT rowid, title, author, read FROM books ORDER BY rowid').fetchall()
+        self.assertEqual([ (book.id, book.title, book.author, book.read) for book in [self.bk1, self.bk2, self.bk3] ], rows)
+        con.close()
+
+
+    def test_export_filters(self):
+        self.add_test_data()
+        count, text = self.export_to_text('jsonl', read=False)
+        self.assertEqual(2, count)
+        self.assertEqual([self.bk2.id, self.bk3.id], [ json.loads(line)['id'] for line in text.splitlines() ])
+
+        count, text = self.export_to_text('jsonl', read=False, term='book')
+        self.assertEqual(1, count)
+        self.assertEqual(self.bk2.id, json.loads(text)['id'])
+
+
+    def test_export_gzip_file(self):
+        self.add_test_data()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'books.jsonl.gz')
+            self.assertEqual(3, self.BS.export(path, 'jsonl', compress=True))
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                self.assertEqual(3, len(f.readlines()))
+
+
+    def test_export_streams_in_batches_and_reports_progress(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(25) )
+        original_batch_size = bookstore.fetch_batch_size
+        bookstore.fetch_batch_size = 4
+        try:
+            reports = []
+            count, text = self.export_to_text('csv', progress=reports.append, progress_every=10)
+        finally:
+            bookstore.fetch_batch_size = original_batch_size
+        self.assertEqual(25, count)
+        self.assertEqual(26, len(text.splitlines()))
+        self.assertEqual([12, 20, 25], reports)   # Checked after each batch of 4
+
+
+    def test_export_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.BS.export(io.StringIO(), 'xml')
+
+
+
+class TestBookstoreCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+        self.bk1 = Book('An Interesting Book', 'Ann Author', True)
+        self.bk2 = Book('Booky Book Book', 'B. Bookwriter', False)
+        self.bk1.save()
+        self.bk2.save()
+        self.BS.enable_cache()
+
+
+    def tearDown(self):
+        self.BS.disable_cache()
+
+
+    def test_cache_off_by_default(self):
+        self.BS.disable_cache()
+        self.assertIsNone(self.BS.cache_stats())
+
+
+    def test_cache_hits_and_misses(self):
+        self.assertEqual(self.bk1, self.BS.get_book_by_id(self.bk1.id))
+        self.assertEqual(self.bk1, self.BS.get_book_by_id(self.bk1.id))
+        self.assertEqual(2, self.BS.book_count())
+        self.assertEqual(2, self.BS.book_count())
+        self.assertCountEqual([self.bk1, self.bk2], self.BS.book_search('book'))
+        self.assertCountEqual([self.bk1, self.bk2], self.BS.book_search('book'))
+        self.assertIsNone(self.BS.get_book_by_id(-1))
+        self.assertIsNone(self.BS.get_book_by_id(-1))
+
+        stats = self.BS.cache_stats()
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(4, stats['size'])
+
+
+    def test_changing_returned_book_does_not_change_cache(self):
+        book = self.BS.get_book_by_id(self.bk1.id)
+        book.title = 'Changed but not saved'
+        self.assertEqual(self.bk1, self.BS.get_book_by_id(self.bk1.id))
+
+
+    def test_cache_cleared_by_writes(self):
+        self.assertEqual(2, self.BS.book_count())
+        bk3 = Book('Another Book', 'Another Author')
+        bk3.save()
+        self.assertEqual(3, self.BS.book_count())
+
+        bk3.read = True 
+        bk3.save()
+        self.assertTrue(self.BS.get_book_by_id(bk3.id).read)
+
+        bk3.delete()
+        self.assertIsNone(self.BS.get_book_by_id(bk3.id))
+
+        self.BS.add_books([('Bulk', 'Bulk')])
+        self.assertEqual(3, len(self.BS.book_search('b')))
+
+        self.BS.delete_all_books()
+        self.assertEqual(0, self.BS.book_count())
+
+
+    def test_cache_cleared_by_other_connection(self):
+        self.assertEqual(2, self.BS.book_count())
+        con = sqlite3.connect(bookstore.db)
+        with con:
+            con.execute("INSERT INTO books (title, author, read) VALUES ('Other', 'Process', 0)")
+        con.close()
+        self.assertEqual(3, self.BS.book_count())
+
+
+    def test_cache_evicts_least_recently_used(self):
+        self.BS.enable_cache(max_size=2)
+        self.BS.get_book_by_id(self.bk1.id)
+        self.BS.get_book_by_id(self.bk2.id)
+        self.BS.get_book_by_id(self.bk1.id)   # bk1 is now most recently used
+        self.BS.book_count()   # evicts bk2 
+        self.BS.get_book_by_id(self.bk1.id)
+        self.BS.get_book_by_id(self.bk2.id)
+
+        stats = self.BS.cache_stats()
+        self.assertEqual(2, stats['size'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+
+
+    def test_cache_ttl(self):
+        self.BS.enable_cache(ttl=0.05)
+        self.BS.book_count()
+        self.BS.book_count()
+        time.sleep(0.1)
+        self.BS.book_count()
+        self.assertEqual(1, self.BS.cache_stats()['hits'])
+        self.assertEqual(2, self.BS.cache_stats()['misses'])
+
+
+
+@skipUnless(sqlite3.sqlite_version_info >= (3, 36, 0), 'Memory mode needs SQLite 3.36')
+class TestBookstoreMemoryMode(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+        self.bk1 = Book('An Interesting Book', 'Ann Author', True)
+        self.bk2 = Book('Booky Book Book', 'B. Bookwriter', False)
+        self.bk1.save()
+        self.bk2.save()
+
+
+    def tearDown(self):
+        self.BS.disable_memory_mode()
+
+
+    def file_titles(self):
+        """ The titles in the database file, read without the store """
+        con = sqlite3.connect(bookstore.db)
+        titles = [ title for title, in con.execute('SELECT title FROM books ORDER BY rowid') ]
+        con.close()
+        return titles
+
+
+    def test_reads_from_memory_and_writes_on_flush(self):
+        self.BS.enable_memory_mode(flush_interval=None)
+        con = sqlite3.connect(bookstore.db)
+        con.execute("UPDATE books SET title = 'Changed In File' WHERE rowid = ?", (self.bk1.id, ))   # Not seen by the store 
+        con.commit()
+        con.close()
+        self.assertEqual(self.bk1.title, self.BS.get_book_by_id(self.bk1.id).title)
+
+        new_book = Book('Memory Book', 'Ann Author')
+        new_book.save()
+        self.bk2.title = 'Changed'
+        self.bk2.save()
+        self.BS.set_read(True, [new_book.id])
+        self.bk1.delete()
+        self.assertEqual(['Changed', 'Memory Book'], [ book.title for book in self.BS.get_all_books() ])
+        self.assertEqual(['Changed In File', 'Booky Book Book'], self.file_titles())
+
+        self.assertEqual(4, self.BS.flush())
+        self.assertEqual(0, self.BS.flush())
+        self.assertEqual(['Changed', 'Memory Book'], self.file_titles())
+
+        self.BS.disable_memory_mode()
+        self.assertTrue(self.BS.get_book_by_id(new_book.id).read)
+        self.assertEqual([], self.BS.check_stats())
+        self.assertEqual(['Memory Book'], [ book.title for book in self.BS.book_search('memry', mode='fuzzy') ])
+
+
+    def test_switching_while_another_thread_reads(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(3 * bookstore.fetch_batch_size) )
+        started = threading.Semaphore(0)
+        switched = threading.Semaphore(0)
+        results = []
+
+        def reader():
+            try:
+                for n in range(2):   # From the file while memory mode is turned on, then from memory while it's turned off 
+                    books = self.BS.iter_all_books()
+                    next(books)
+                    started.release()
+                    switched.acquire(timeout=5)
+                    results.append(1 + sum(1 for book in books))
+            except Exception as error:
+                results.append(error)
+            started.release()
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            started.acquire(timeout=5)
+            self.BS.enable_memory_mode(flush_interval=None)
+            switched.release()
+            started.acquire(timeout=5)
+            self.BS.disable_memory_mode()
+        finally:
+            switched.release()
+            thread.join()
+
+        total = 3 * bookstore.fetch_batch_size + 2
+        self.assertEqual([total, total], results)
+
+
+    def test_maintenance_changes_file(self):
+        con = sqlite3.connect(bookstore.db)
+        con.execute('UPDATE book_totals SET books = 99')
+        con.execute('UPDATE books SET title_key = NULL, author_key = NULL')
+        con.commit()
+
+        self.BS.enable_memory_mode(flush_interval=None)
+        self.bk2.read = True
+        self.bk2.save()
+        self.BS.rebuild_stats()
+        self.BS.rebuild_keys()
+        seq = self.BS.change_seq()
+        self.BS.compact_changes(before_seq=seq)
+        self.BS.disable_memory_mode()
+
+        self.assertEqual((2, 2), con.execute('SELECT books, read FROM book_totals').fetchone())
+        self.assertEqual(0, con.execute('SELECT COUNT(*) FROM books WHERE title_key IS NULL').fetchone()[0])
+        self.assertEqual((seq, ), con.execute('SELECT seq FROM book_changes_compacted').fetchone())
+        con.close()
+        self.assertEqual([], self.BS.check_stats())
+        with self.assertRaises(bookstore.ChangesCompactedError):
+            self.BS.changes_since(0)
+
+
+    def test_maintenance_refused_in_transaction(self):
+        self.BS.enable_memory_mode(flush_interval=None)
+        with self.assertRaises(BookError):
+            with self.BS.transaction():
+                self.BS.rebuild_stats()
+
+
+    def test_other_threads_read_from_memory(self):
+        self.BS.enable_memory_mode(flush_interval=None)
+        Book('Memory Book', 'Ann Author').save()
+        counts = []
+        thread = threading.Thread(target=lambda: counts.append(self.BS.book_count()))
+        thread.start()
+        thread.join()
+        self.assertEqual([3], counts)
+
+
+    def test_immediate_durability(self):
+        self.BS.enable_memory_mode(durability='immediate')
+        Book('Saved Now', 'Author').save()
+        self.assertIn('Saved Now', self.file_titles())
+
+        with self.BS.transaction():
+            Book('Saved At End', 'Author').save()
+            self.assertNotIn('Saved At End', self.file_titles())
+        self.assertIn('Saved At End', self.file_titles())
+
+        with self.assertRaises(RuntimeError):
+            with self.BS.transaction():
+                Book('Rolled Back', 'Author').save()
+                raise RuntimeError('Stop')
+        self.assertNotIn('Rolled Back', self.file_titles())
+        self.assertEqual(0, self.BS.flush())
+
+
+    def test_background_flush(self):
+        self.BS.enable_memory_mode(flush_interval=0.01)
+        Book('Saved Later', 'Author').save()
+        deadline = time.time() + 5
+        while 'Saved Later' not in self.file_titles() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn('Saved Later', self.file_titles())
+
+
+    def test_close_and_compact_flush(self):
+        self.BS.enable_memory_mode(flush_interval=None)
+        Book('Saved On Close', 'Author').save()
+        self.BS.close()
+        self.assertIn('Saved On Close', self.file_titles())
+
+        self.bk2.title = 'Changed Once'
+        self.bk2.save()
+        self.bk2.title = 'Changed Twice'
+        self.bk2.save()
+        self.BS.compact_changes()
+        self.assertIn('Changed Twice', self.file_titles())
+
+
+    def test_restore_not_allowed(self):
+        self.BS.enable_memory_mode(flush_interval=None)
+        with self.assertRaises(BookError):
+            self.BS.restore(bookstore.db)
+
+
+    def test_unknown_durability(self):
+        with self.assertRaises(ValueError):
+            self.BS.enable_memory_mode(durability='sometimes')
+
+
+
+class TestBookstoreWriteQueue(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+        self.BS.enable_write_queue(max_delay=0.05)
+
+
+    def tearDown(self):
+        self.BS.disable_write_queue()
+        self.BS.disable_instrumentation()
+
+
+    def test_save_returns_future_with_id(self):
+        book = Book('Queued', 'Author')
+        id = book.save().result(timeout=5)
+        self.assertEqual(id, book.id)
+        self.assertEqual(book, self.BS.get_book_by_id(book.id))
+
+        book.read = True
+        self.assertEqual(book.id, book.save().result(timeout=5))
+        self.assertTrue(self.BS.get_book_by_id(book.id).read)
+
+        book.delete().result(timeout=5)
+        self.assertIsNone(self.BS.get_book_by_id(book.id))
+
+
+    def test_duplicate_only_fails_its_own_future(self):
+        futures = [ Book('Same', 'Author').save(), Book('same', 'author').save(), Book('Different', 'Author').save() ]
+        self.assertIsInstance(futures[0].result(timeout=5), int)
+        with self.assertRaises(BookError):
+            futures[1].result(timeout=5)
+        self.assertIsInstance(futures[2].result(timeout=5), int)
+        self.assertEqual(2, self.BS.book_count())
+
+
+    def test_writes_from_many_threads_share_transactions(self):
+        transactions = []
+        self.BS.add_query_hook(lambda event: transactions.append(1) if event.sql == 'BEGIN IMMEDIATE' else None)
+        futures = []
+
+        def save_books(thread):
+            for n in range(50):
+                futures.append(Book(f'Title {thread} {n}', 'Author').save())
+
+        threads = [ threading.Thread(target=save_books, args=(thread, )) for thread in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [ future.result(timeout=5) for future in futures ]
+        self.assertEqual(200, len(set(ids)))
+        self.assertEqual(200, self.BS.book_count())
+        self.assertLess(len(transactions), 50)
+
+
+    def test_saves_in_transaction_are_not_queued(self):
+        with self.BS.transaction():
+            book = Book('In Transaction', 'Author')
+            self.assertIsNone(book.save())
+            self.assertIsNotNone(book.id)
+
+
+    def test_disable_and_close_wait_for_queued_writes(self):
+        futures = [ Book(f'Title {n}', 'Author').save() for n in range(10) ]
+        self.BS.close()
+        self.assertTrue(all(future.done() for future in futures))
+
+        futures = [ Book(f'More {n}', 'Author').save() for n in range(10) ]
+        self.BS.disable_write_queue()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(20, self.BS.book_count())
+        self.assertIsNone(Book('Not Queued', 'Author').save())
+
+
+
+class TestBookstoreInstrumentation(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+        self.bk1 = Book('An Interesting Book', 'Ann Author', True)
+        self.bk2 = Book('Booky Book Book', 'B. Bookwriter', False)
+        self.bk1.save()
+        self.bk2.save()
+
+
+    def tearDown(self):
+        self.BS.disable_instrumentation()
+
+
+    def test_off_by_default(self):
+        self.assertIsNone(self.BS.query_stats())
+
+
+    def test_query_stats_per_method(self):
+        events = []
+        self.BS.add_query_hook(events.append)
+        Book('Third', 'Book').save()
+        self.BS.get_all_books()
+        self.BS.book_search('book')
+
+        stats = self.BS.query_stats()
+        # BEGIN IMMEDIATE, INSERT, then the statements adding the book to the fuzzy search index 
+        save_events = [ event for event in events if event.method == 'save' ]
+        self.assertEqual(len(save_events), stats['save']['statements'])
+        self.assertEqual('BEGIN IMMEDIATE', save_events[0].sql)
+        self.assertEqual(1, save_events[1].rows)
+        self.assertEqual(3, stats['get_all_books']['rows'])
+        self.assertEqual(3, stats['book_search']['rows'])
+        self.assertEqual(1, sum(stats['book_search']['histogram'].values()))
+        self.assertGreater(stats['get_all_books']['total_seconds'], 0)
+
+
+    def test_hooks_get_each_statement(self):
+        events = []
+        self.BS.add_query_hook(events.append)
+        self.assertEqual(self.bk1, self.BS.get_book_by_id(self.bk1.id))
+        books = list(self.BS.iter_all_books())
+
+        self.assertEqual(['get_book_by_id', 'iter_all_books'], [ event.method for event in events ])
+        self.assertEqual([1, 2], [ event.rows for event in events ])
+        self.assertIn('FROM books WHERE rowid = ?', events[0].sql)
+        self.assertEqual((self.bk1.id, ), events[0].params)
+        self.assertEqual([self.bk1, self.bk2], books)
+
+        self.BS.remove_query_hook(events.append)
+        self.BS.book_count()
+        self.assertEqual(2, len(events))
+
+
+    def test_results_still_stream(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(3 * bookstore.fetch_batch_size) )
+        events = []
+        self.BS.add_query_hook(events.append)
+
+        books = self.BS.iter_all_books()
+        next(books)
+        self.assertEqual([], events)   # Not recorded until every row has been read 
+        self.assertEqual(3 * bookstore.fetch_batch_size + 2, 1 + sum(1 for book in books))
+        self.assertEqual(['iter_all_books'], [ event.method for event in events ])
+        self.assertEqual(3 * bookstore.fetch_batch_size + 2, events[0].rows)
+
+        books = self.BS.iter_all_books()
+        next(books)
+        books.close()
+        self.assertEqual(bookstore.fetch_batch_size, events[1].rows)
+
+
+    def test_slow_queries_logged_with_query_plan(self):
+        self.BS.enable_instrumentation(slow_query_seconds=0)
+        with self.assertLogs('bookstore', 'WARNING') as logs:
+            self.BS.exact_match(self.bk1)
+        self.assertIn('exact_match', logs.output[0])
+        self.assertIn('Query plan: SEARCH books', logs.output[0])
+
+
+    def test_trace_logs_trigger_statements(self):
+        self.BS.enable_instrumentation(trace=True)
+        with self.assertLogs('bookstore', 'DEBUG') as logs:
+            Book('Traced', 'Book').save()
+        self.assertTrue(any('INSERT INTO books' in line for line in logs.output))
+
+
+    def test_progress_handler_can_interrupt(self):
+        self.BS.enable_instrumentation(progress=lambda: 1, progress_steps=1)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.BS.get_all_books()
+        self.BS.disable_instrumentation()
+        self.assertEqual(2, len(self.BS.get_all_books()))
+
+
+class TestBookstoreSchema(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+
+
+    def query_plans(self, method, *args):
+        """ Calls a BookStore method and returns the EXPLAIN QUERY PLAN output for every statement it runs """
+        con = self.BS._connection()
+        statements = []
+        con.set_trace_callback(statements.append)
+        try:
+            method(*args)
+        finally:
+            con.set_trace_callback(None)
+
+        plans = []
+        for sql in statements:
+            if sql.split()[0].upper() not in ['SELECT', 'INSERT', 'UPDATE', 'DELETE']:
+                continue   # BEGIN, COMMIT, CREATE
+            plan_rows = con.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            plans.append(' / '.join(row[-1] for row in plan_rows))
+        return plans
+
+
+    def assert_uses_index(self, plans):
+        self.assertTrue(plans)
+        for plan in plans:
+            self.assertIn('USING', plan)
+            self.assertNotRegex(plan, r'SCAN books( |$)')
+
+
+    def test_book_count_and_stats_do_not_read_books(self):
+        for plan in self.query_plans(self.BS.book_count) + self.query_plans(self.BS.stats):
+            self.assertNotRegex(plan, r'\bbooks\b')
+
+
+    def test_autocomplete_uses_index(self):
+        self.assert_uses_index(self.query_plans(self.BS.autocomplete, 'Tit', 'title'))
+        self.assert_uses_index(self.query_plans(self.BS.autocomplete, 'Aut', 'author'))
+
+
+    def test_exact_match_uses_index(self):
+        self.assert_uses_index(self.query_plans(self.BS.exact_match, Book('Title', 'Author')))
+
+
+    def test_get_books_by_read_value_uses_index(self):
+        self.assert_uses_index(self.query_plans(self.BS.get_books_by_read_value, True))
+        self.assert_uses_index(self.query_plans(self.BS.get_books_by_read_value, False))
+
+
+    def test_batch_operations_use_rowid(self):
+        plans = self.query_plans(self.BS.set_read, True, [1, 2, 3]) + self.query_plans(self.BS.delete_books, [1000000])
+        for plan in plans:
+            self.assertNotRegex(plan, r'SCAN books( |$)')
+
+
+    def test_page_uses_index(self):
+        self.assert_uses_index(self.query_plans(self.BS.page, 10, 20))
+        self.assert_uses_index(self.query_plans(self.BS.page, 10, 20, True))
+
+
+    def test_query_uses_index(self):
+        query = self.BS.query()
+        for filtered in [ query.read(False).author('Tolkien', match='exact').order_by('title'), query.author('Tol', match='prefix'),
+                          query.title('The', match='prefix').order_by('title').limit(20), query.ids(10, 20).read(True) ]:
+            self.assert_uses_index(self.query_plans(filtered.all))
+            self.assert_uses_index(self.query_plans(filtered.count))
+
+
+    def test_get_book_by_id_uses_rowid(self):
+        self.assert_uses_index(self.query_plans(self.BS.get_book_by_id, 1))
+
+
+    def test_schema_version_is_current(self):
+        version = self.BS._connection().execute('PRAGMA user_version').fetchone()[0]
+        self.assertEqual(len(bookstore._migrations), version)
+
+
+    def test_upgrade_unversioned_database_in_place(self):
+        original_db = bookstore.db
+        with tempfile.TemporaryDirectory() as tmp:
+            old_db = os.path.join(tmp, 'old_books.db')
+            con = sqlite3.connect(old_db)
+            with con:
+                con.execute('CREATE TABLE books (title TEXT, author TEXT, read BOOLEAN, UNIQUE( title COLLATE NOCASE, author COLLATE NOCASE))')
+                con.execute("INSERT INTO books VALUES ('Old Book', 'Old Author', 1)")
+            con.close()
+
+            try:
+                bookstore.db = old_db
+                self.assertEqual(len(bookstore._migrations), self.BS._connection().execute('PRAGMA user_version').fetchone()[0])
+                self.assertEqual([Book('Old Book', 'Old Author', True, 1)], self.BS.get_books_by_read_value(True))
+                self.assertTrue(self.BS.exact_match(Book('OLD BOOK', 'old author')))
+                self.assert_uses_index(self.query_plans(self.BS.exact_match, Book('Old Book', 'Old Author')))
+                if self.BS.full_text_search:
+                    self.assertEqual(1, len(self.BS.book_search('old', mode='words')))
+                    self.assertEqual(1, len(self.BS.book_search('auther', mode='fuzzy')))
+            finally:
+                self.BS.close()
+                bookstore.db = original_db
+
+
+
+    def test_upgrade_gives_duplicates_no_keys(self):
+        original_db = bookstore.db
+        with tempfile.TemporaryDirectory() as tmp:
+            old_db = os.path.join(tmp, 'old_books.db')
+            con = sqlite3.connect(old_db)
+            with con:
+                con.execute('CREATE TABLE books (title TEXT, author TEXT, read BOOLEAN, UNIQUE( title COLLATE NOCASE, author COLLATE NOCASE))')
+                con.executemany('INSERT INTO books VALUES (?, ?, 0)', [ ('\u00c9mile', 'Rousseau'), ('\u00e9mile', 'Rousseau'), ('Other', 'Author') ])
+            con.close()
+
+            try:
+                bookstore.db = old_db
+                with self.assertLogs('bookstore', 'WARNING'):
+                    self.BS._connection()
+                keys = self.BS._connection().execute('SELECT rowid, title_key, author_key FROM books ORDER BY rowid').fetchall()
+                self.assertEqual([ (1, '\u00e9mile', 'rousseau'), (2, None, None), (3, 'other', 'author') ], keys)
+                self.assertTrue(self.BS.exact_match(Book('\u00c9MILE', 'rousseau')))
+            finally:
+                self.BS.close()
+                bookstore.db = original_db
+
+
+def fts5_available():
+    con = sqlite3.connect(':memory:')
+    try:
+        con.execute('CREATE VIRTUAL TABLE test_fts USING fts5(text)')
+        return True 
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        con.close()
+
+
+@skipUnless(fts5_available(), 'SQLite built without FTS5')
+class TestBookstoreFullTextSearch(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+
+        self.bk1 = Book('Harry Potter and the Philosopher\'s Stone', 'J.K. Rowling')
+        self.bk2 = Book('Rowing for Dummies', 'Ann Author')
+        self.bk3 = Book('The Hobbit', 'J.R.R. Tolkien', True)
+        self.bk4 = Book('Potter Potter Potter', 'Someone Else')
+        for book in [self.bk1, self.bk2, self.bk3, self.bk4]:
+            book.save()
+
+
+    def test_search_words(self):
+        self.assertCountEqual([self.bk1], self.BS.book_search('rowling', mode='words'))
+        self.assertEqual([], self.BS.book_search('row', mode='words'))
+
+
+    def test_search_words_must_all_match(self):
+        self.assertEqual([self.bk1], self.BS.book_search('potter ROWLING', mode='words'))
+
+
+    def test_search_prefix(self):
+        self.assertCountEqual([self.bk1, self.bk2], self.BS.book_search('row', mode='prefix'))
+
+
+    def test_search_ranked_best_match_first(self):
+        self.assertEqual([self.bk4, self.bk1], self.BS.book_search('potter', mode='words'))
+
+
+    def test_search_limit(self):
+        self.assertEqual([self.bk4], self.BS.book_search('potter', mode='words', limit=1))
+
+
+    def test_search_quotes_keywords_and_punctuation(self):
+        self.assertEqual([], self.BS.book_search('OR "', mode='words'))
+        self.assertEqual([self.bk1], self.BS.book_search('philosopher\'s', mode='prefix'))
+
+
+    def test_search_index_follows_updates_and_deletes(self):
+        self.bk2.title = 'Sailing for Dummies'
+        self.bk2.save()
+        self.assertEqual([], self.BS.book_search('rowing', mode='words'))
+        self.assertEqual([self.bk2], self.BS.book_search('sailing', mode='words'))
+
+        self.bk2.delete()
+        self.assertEqual([], self.BS.book_search('sailing', mode='words'))
+
+
+    def test_search_index_includes_bulk_added_books(self):
+        self.BS.add_books([('Silmarillion', 'J.R.R. Tolkien')])
+        self.assertEqual(2, len(self.BS.book_search('tolkien', mode='words')))
+
+
+    def test_query_search_with_filters(self):
+        query = self.BS.query().search('potter')
+        self.assertEqual([self.bk4, self.bk1], query.all())
+        self.assertEqual([self.bk1], query.author('rowling').all())
+        self.assertEqual([self.bk1, self.bk4], query.order_by('title').all())
+        self.assertEqual([self.bk1], query.search('row', mode='prefix').all())
+        self.assertEqual([self.bk1], query.offset(1).all())
+        self.assertEqual(2, query.count())
+        self.assertEqual([self.bk3], self.BS.query().search('the').read(True).all())
+        self.assertEqual([], self.BS.query().search('" OR').all())
+        self.assertEqual(0, self.BS.query().search('" OR').count())
+
+
+    def test_search_fuzzy_finds_misspellings(self):
+        self.assertEqual(self.bk1, self.BS.book_search('Rowlng', mode='fuzzy')[0])
+        self.assertEqual([self.bk3], self.BS.book_search('tolkein', mode='fuzzy'))
+        self.assertEqual([], self.BS.book_search('xyzzy', mode='fuzzy'))
+
+
+    def test_search_fuzzy_ranks_closest_first(self):
+        self.assertEqual([self.bk1, self.bk2], self.BS.book_search('rowling', mode='fuzzy'))
+        # Books with a word like every word in the term come before books matching only some of them 
+        self.assertEqual(self.bk1, self.BS.book_search('poter rowlin', mode='fuzzy')[0])
+        self.assertEqual([self.bk1], self.BS.book_search('rowling', mode='fuzzy', limit=1))
+
+
+    def test_search_fuzzy_ignores_case_accents_and_punctuation(self):
+        book = Book('Cien años de soledad', 'Gabriel García Márquez')
+        book.save()
+        self.assertEqual([book], self.BS.book_search('GARCIA MARQES', mode='fuzzy'))
+        self.assertEqual([self.bk1], self.BS.book_search('philosophers', mode='fuzzy'))
+
+
+    def test_search_fuzzy_numbers_match_exactly(self):
+        book = Book('Nineteen Eighty-Four 1984', 'George Orwell')
+        book.save()
+        self.assertEqual([book], self.BS.book_search('1984', mode='fuzzy'))
+        self.assertEqual([], self.BS.book_search('1948', mode='fuzzy'))
+
+
+    def test_search_fuzzy_index_follows_updates_and_bulk_adds(self):
+        self.bk2.title = 'Sailing for Dummies'
+        self.bk2.save()
+        self.assertEqual([self.bk2], self.BS.book_search('saling', mode='fuzzy'))
+
+        self.BS.add_books([('Silmarillion', 'J.R.R. Tolkien')])
+        self.assertEqual('Silmarillion', self.BS.book_search('silmarilion', mode='fuzzy')[0].title)
+
+
+    def test_search_fuzzy_only_reads_candidates_for_rarest_word(self):
+        self.BS.add_books( (f'The Common Title {n}', 'Author') for n in range(50) )
+        original_max_candidates = bookstore.fuzzy_max_candidates
+        bookstore.fuzzy_max_candidates = 10
+        try:
+            self.assertEqual([self.bk3], self.BS.book_search('the hobit', mode='fuzzy', limit=1))
+            self.assertEqual(10, len(self.BS.book_search('commn', mode='fuzzy')))
+        finally:
+            bookstore.fuzzy_max_candidates = original_max_candidates
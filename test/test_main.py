@@ -0,0 +1,175 @@
+from unittest import TestCase
+from unittest.mock import patch
+import io
+import os 
+import tempfile
+
+import bookstore 
+from bookstore import Book, BookStore
+
+bookstore.db = os.path.join('database', 'test_books.db')
+
+import main
+
+
+class TestMain(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None 
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        main.store = self.BS
+        self.BS.delete_all_books()
+        self.tmp = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def write_file(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+
+    def test_read_books_file_csv(self):
+        path = self.write_file('books.csv', 'title,author,read\nAAA,BBB,true\nCCC,DDD,\n')
+        books = list(main.read_books_file(path))
+        self.assertEqual([Book('AAA', 'BBB', True), Book('CCC', 'DDD', False)], books)
+
+
+    def test_read_books_file_jsonl(self):
+        path = self.write_file('books.jsonl', '{"title": "AAA", "author": "BBB", "read": true}\n\n{"title": "CCC", "author": "DDD"}\n')
+        books = list(main.read_books_file(path))
+        self.assertEqual([Book('AAA', 'BBB', True), Book('CCC', 'DDD', False)], books)
+
+
+    @patch('builtins.print')
+    def test_import_command(self, mock_print):
+        csv_path = self.write_file('books.csv', 'title,author\nAAA,BBB\nCCC,DDD\n')
+        jsonl_path = self.write_file('books.jsonl', '{"title": "aaa", "author": "bbb"}\n{"title": "EEE", "author": "FFF"}\n')
+        main.main(['import', csv_path, jsonl_path])
+        self.assertEqual(3, self.BS.book_count())
+        mock_print.assert_any_call(f'{jsonl_path}: added 1 books, skipped 1 duplicates')
+
+
+    @patch('builtins.print')
+    def test_export_command_round_trip(self, mock_print):
+        self.BS.add_books([ Book('AAA', 'BBB', True), Book('CCC', 'DDD'), Book('EEE', 'FFF') ])
+        path = os.path.join(self.tmp.name, 'books.jsonl.gz')
+        main.main(['export', path, '--unread'])
+        mock_print.assert_any_call(f'Exported 2 books to {path}')
+
+        self.BS.delete_all_books()
+        main.main(['import', path])
+        self.assertEqual([ ('CCC', 'DDD'), ('EEE', 'FFF') ], [ (book.title, book.author) for book in self.BS.get_all_books() ])
+
+
+    @patch('builtins.print')
+    def test_export_command_format_from_extension(self, mock_print):
+        book = Book('AAA', 'BBB')
+        book.save()
+        path = os.path.join(self.tmp.name, 'books.sql')
+        main.main(['export', path])
+        with open(path, encoding='utf-8') as f:
+            self.assertIn(f"VALUES ({book.id}, 'AAA', 'BBB', 0);", f.read())
+
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    @patch('sys.stderr', new_callable=io.StringIO)
+    def test_batch_command(self, mock_stderr, mock_stdout):
+        path = self.write_file('script.txt', 'add Dune "Frank Herbert"\nadd dune "frank herbert"\n')
+        self.assertEqual(1, main.main(['batch', path]))
+        self.assertEqual(2, len(mock_stdout.getvalue().splitlines()))
+        self.assertEqual('2 commands run, 1 failed\n', mock_stderr.getvalue())
+        self.assertEqual(1, self.BS.book_count())
+
+        with self.assertRaises(SystemExit):
+            main.main(['batch', path, '--group-size', '0'])
+        self.assertIn('must be at least 1', mock_stderr.getvalue())
+
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    @patch('sys.stderr', new_callable=io.StringIO)
+    def test_batch_command_in_memory(self, mock_stderr, mock_stdout):
+        path = self.write_file('script.txt', 'add Dune "Frank Herbert"\nsearch dune\n')
+        self.assertEqual(0, main.main(['--memory', 'batch', path]))
+        self.assertIn('Dune', mock_stdout.getvalue().splitlines()[1])
+        self.assertEqual(1, self.BS.book_count())
+        self.assertIsNone(self.BS._memory)
+
+
+    @patch('builtins.print')
+    def test_stats_command_check_and_rebuild(self, mock_print):
+        self.BS.add_books([ Book('AAA', 'BBB', True), Book('CCC', 'BBB') ])
+        self.assertEqual(0, main.main(['stats', '--check']))
+        mock_print.assert_any_call('Statistics are correct')
+        mock_print.assert_any_call('\nBooks: 2  Read: 1  Unread: 1  Authors: 1')
+
+        con = self.BS._connection()
+        con.execute('UPDATE book_totals SET read = 0')
+        con.commit()
+        self.assertEqual(1, main.main(['stats', '--check']))
+        mock_print.assert_any_call('1 problems found, run with --rebuild to fix them')
+        self.assertEqual(0, main.main(['stats', '--rebuild', '--check']))
+        self.assertEqual(1, self.BS.stats()['read'])
+
+
+    @patch('builtins.print')
+    def test_snapshot_and_restore_commands(self, mock_print):
+        self.BS.add_books([ Book('AAA', 'BBB'), Book('CCC', 'DDD') ])
+        directory = os.path.join(self.tmp.name, 'snapshots')
+        self.assertIsNone(main.main(['snapshot', directory, '--keep', '1']))
+        snapshot, = self.BS.snapshots(directory)
+        mock_print.assert_any_call(f'Saved snapshot {snapshot}')
+
+        self.BS.delete_all_books()
+        self.assertEqual(0, main.main(['restore', snapshot]))
+        mock_print.assert_any_call(f'Restored 2 books from {snapshot}')
+        self.assertEqual(1, main.main(['restore', os.path.join(self.tmp.name, 'missing.db')]))
+
+
+    @patch('builtins.input')
+    @patch('builtins.print')
+    def test_search_suggests_close_matches(self, mock_print, mock_input):
+        if not self.BS.full_text_search:
+            self.skipTest('fuzzy search needs SQLite full text search')
+        self.BS.add_books([ Book('The Hobbit', 'J.R.R. Tolkien'), Book('Dune', 'Frank Herbert') ])
+        mock_input.return_value = 'tolkein'
+        main.search_book()
+        mock_print.assert_any_call('No exact matches. Did you mean one of these?')
+        self.assertIn('The Hobbit', mock_print.call_args[0][0])
+
+
+    @patch('builtins.input')
+    @patch('builtins.print')
+    def test_change_read_many_books(self, mock_print, mock_input):
+        books = [ Book(f'Title {n}', 'Author') for n in range(3) ]
+        self.BS.add_books(books)
+        mock_input.side_effect = [f'{books[0].id}-{books[2].id}, 1000000', 'read']
+        main.change_read()
+        self.assertEqual(3, len(self.BS.get_books_by_read_value(True)))
+        mock_print.assert_any_call('You have read 3 book(s)')
+        mock_print.assert_any_call('No books with these IDs exist in the database: 1000000')
+
+
+    @patch('builtins.input')
+    @patch('builtins.print')
+    def test_delete_many_books(self, mock_print, mock_input):
+        books = [ Book(f'Title {n}', 'Author') for n in range(4) ]
+        self.BS.add_books(books)
+        mock_input.side_effect = [f'{books[0].id} {books[2].id}']
+        main.delete_book()
+        self.assertEqual([books[1], books[3]], self.BS.get_all_books())
+        mock_print.assert_any_call('2 book(s) deleted successfully')
+
+
+    def test_format_ids(self):
+        self.assertEqual('1-3, 7, 9-10', main.format_ids([1, 2, 3, 7, 9, 10]))
+        self.assertEqual('', main.format_ids([]))
@@ -0,0 +1,186 @@
+from unittest import TestCase
+import http.client
+import json
+import os
+import threading
+
+import bookstore
+from bookstore import Book, BookStore
+
+import server
+
+
+class TestServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bookstore.db = os.path.join('database', 'test_books.db')
+        BookStore.instance = None
+        cls.server = server.BookServer(('127.0.0.1', 0), workers=2, idle_timeout=1)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+
+    def setUp(self):
+        self.BS = BookStore()
+        self.BS.delete_all_books()
+        self.bk1 = Book('An Interesting Book', 'Ann Author', True)
+        self.bk2 = Book('Booky Book Book', 'B. Bookwriter', False)
+        self.bk1.save()
+        self.bk2.save()
+        self.con = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=5)
+
+
+    def tearDown(self):
+        self.con.close()
+
+
+    def request(self, method, path, body=None, headers=None):
+        """ :returns (response, decoded JSON body or None) """
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.con.request(method, path, body, headers)
+        response = self.con.getresponse()
+        data = response.read()
+        return response, json.loads(data) if data else None
+
+
+    def test_list_books(self):
+        response, books = self.request('GET', '/books')
+        self.assertEqual(200, response.status)
+        self.assertEqual('chunked', response.getheader('Transfer-Encoding'))
+        self.assertEqual([
+            { 'id': self.bk1.id, 'title': 'An Interesting Book', 'author': 'Ann Author', 'read': True },
+            { 'id': self.bk2.id, 'title': 'Booky Book Book', 'author': 'B. Bookwriter', 'read': False } ], books)
+
+        response, books = self.request('GET', '/books?read=false')
+        self.assertEqual([self.bk2.id], [ book['id'] for book in books ])
+        response, books = self.request('GET', f'/books?after_id={self.bk1.id}&limit=5')
+        self.assertEqual([self.bk2.id], [ book['id'] for book in books ])
+        response, error = self.request('GET', '/books?read=maybe')
+        self.assertEqual(400, response.status)
+
+
+    def test_long_list_is_streamed_in_chunks(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(3000) )
+        self.con.request('GET', '/books')
+        response = self.con.getresponse()
+        books = json.loads(response.read())
+        self.assertEqual(3002, len(books))
+
+
+    def test_conditional_get(self):
+        response, books = self.request('GET', '/books')
+        etag = response.getheader('ETag')
+        self.assertTrue(etag)
+
+        response, body = self.request('GET', '/books', headers={ 'If-None-Match': etag })
+        self.assertEqual(304, response.status)
+        self.assertIsNone(body)
+
+        self.bk2.read = True
+        self.bk2.save()
+        response, books = self.request('GET', '/books', headers={ 'If-None-Match': etag })
+        self.assertEqual(200, response.status)
+        self.assertNotEqual(etag, response.getheader('ETag'))
+
+
+    def test_search_and_count(self):
+        response, books = self.request('GET', '/books/search?q=booky')
+        self.assertEqual([self.bk2.id], [ book['id'] for book in books ])
+        response, books = self.request('GET', '/books/search?q=boky&mode=fuzzy&limit=1')
+        self.assertEqual(200, response.status)
+        response, error = self.request('GET', '/books/search?q=x&mode=psychic')
+        self.assertEqual(400, response.status)
+
+        self.assertEqual({ 'count': 2 }, self.request('GET', '/books/count')[1])
+        self.assertEqual({ 'count': 1 }, self.request('GET', '/books/count?read=true')[1])
+
+
+    def test_add_get_update_delete(self):
+        response, book = self.request('POST', '/books', { 'title': 'New Book', 'author': 'New Author' })
+        self.assertEqual(201, response.status)
+        self.assertEqual(f'/books/{book["id"]}', response.getheader('Location'))
+        self.assertFalse(book['read'])
+
+        response, fetched = self.request('GET', f'/books/{book["id"]}')
+        self.assertEqual(book, fetched)
+
+        response, updated = self.request('PATCH', f'/books/{book["id"]}', { 'read': True })
+        self.assertEqual(200, response.status)
+        self.assertEqual(('New Book', True), (updated['title'], updated['read']))
+        self.assertTrue(self.BS.get_book_by_id(book['id']).read)
+
+        response, body = self.request('DELETE', f'/books/{book["id"]}')
+        self.assertEqual(204, response.status)
+        self.assertIsNone(self.BS.get_book_by_id(book['id']))
+
+        for method, body in [ ('GET', None), ('PUT', { 'read': True }), ('DELETE', None) ]:
+            response, error = self.request(method, f'/books/{book["id"]}', body)
+            self.assertEqual(404, response.status)
+
+
+    def test_errors(self):
+        response, error = self.request('POST', '/books', { 'title': 'an interesting book', 'author': 'ann author' })
+        self.assertEqual(409, response.status)
+        self.assertIn('already in the database', error['error'])
+
+        response, error = self.request('PUT', f'/books/{self.bk2.id}', { 'title': 'An Interesting Book', 'author': 'Ann Author' })
+        self.assertEqual(409, response.status)
+
+        response, error = self.request('POST', '/books', { 'title': 'No Author' })
+        self.assertEqual(400, response.status)
+        self.con.request('POST', '/books', 'not json', { 'Content-Type': 'application/json' })
+        response = self.con.getresponse()
+        response.read()
+        self.assertEqual(400, response.status)
+
+        too_large = '/books/99999999999999999999999'
+        for method, body in [ ('GET', None), ('PUT', { 'read': True }), ('DELETE', None) ]:
+            response, error = self.request(method, too_large, body)
+            self.assertEqual(404, response.status)
+
+        for path in ['/books?limit=0', '/books/search?q=book&limit=0', '/books?after_id=99999999999999999999999']:
+            response, error = self.request('GET', path)
+            self.assertEqual(400, response.status)
+
+        response, error = self.request('DELETE', '/books')
+        self.assertEqual(405, response.status)
+        self.assertEqual('GET, POST', response.getheader('Allow'))
+        response, error = self.request('GET', '/authors')
+        self.assertEqual(404, response.status)
+
+
+    def test_keep_alive(self):
+        self.request('GET', '/books/count')
+        sock = self.con.sock
+        self.request('GET', '/books')
+        self.request('GET', f'/books/{self.bk1.id}')
+        self.assertIs(sock, self.con.sock)
+
+
+    def test_more_clients_than_workers(self):
+        results = []
+
+        def client():
+            con = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+            for n in range(5):
+                con.request('GET', '/books/count')
+                results.append(json.loads(con.getresponse().read()))
+            con.close()
+
+        clients = [ threading.Thread(target=client) for n in range(6) ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        self.assertEqual([ { 'count': 2 } ] * 30, results)
@@ -0,0 +1,212 @@
+from unittest import TestCase
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import bookstore
+from bookstore import Book, BookStore, StorageProfile
+
+
+def use_database(path):
+    bookstore.db = path
+    BookStore.instance = None
+    return BookStore()
+
+
+def hold_write_transaction(path, writing, finish):
+    """ Run in another process. Adds a book in a transaction, and keeps the transaction open until finish is set """
+    store = use_database(path)
+    con = store._connection()
+    con.execute('BEGIN IMMEDIATE')
+    con.execute("INSERT INTO books (title, author, read) VALUES ('Uncommitted', 'Writer', 0)")
+    writing.set()
+    finish.wait(10)
+    con.commit()
+
+
+def write_books(path, name, count, errors):
+    """ Run in another process. Saves, updates and deletes books one at a time """
+    try:
+        use_database(path)
+        for n in range(count):
+            book = Book(f'{name} {n}', name)
+            book.save()
+            book.read = True
+            book.save()
+            if n % 10 == 0:
+                deleted = Book(f'{name} {n} deleted', name)
+                deleted.save()
+                deleted.delete()
+    except Exception as e:
+        errors.put(f'{name}: {e!r}')
+
+
+def read_books(path, name, stop, reads, errors):
+    """ Run in another process. Reads the store until stop is set, and counts the reads """
+    try:
+        store = use_database(path)
+        count = 0
+        while not stop.is_set():
+            store.book_count()
+            store.get_books_by_read_value(True)
+            store.book_search(name)
+            count += 1
+        reads.put(count)
+    except Exception as e:
+        errors.put(f'{name}: {e!r}')
+
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        self.original_db = bookstore.db
+        self.original_profile = bookstore.storage_profile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'shared_books.db')
+        self.BS = use_database(self.path)
+
+
+    def tearDown(self):
+        self.BS.close()
+        bookstore.db = self.original_db
+        bookstore.storage_profile = self.original_profile
+        BookStore.instance = None
+        self.tmp.cleanup()
+
+
+    def test_profile_applied_to_connections(self):
+        con = self.BS._connection()
+        self.assertEqual('wal', con.execute('PRAGMA journal_mode').fetchone()[0])
+        self.assertEqual(1, con.execute('PRAGMA synchronous').fetchone()[0])   # NORMAL
+        self.assertEqual(-16000, con.execute('PRAGMA cache_size').fetchone()[0])
+        self.assertEqual(5000, con.execute('PRAGMA busy_timeout').fetchone()[0])
+
+
+    def test_custom_profile(self):
+        bookstore.storage_profile = StorageProfile(journal_mode='delete', synchronous='full', cache_size=500, mmap_size=0, busy_timeout=1)
+        self.BS.close()
+        con = self.BS._connection()
+        self.assertEqual('delete', con.execute('PRAGMA journal_mode').fetchone()[0])
+        self.assertEqual(2, con.execute('PRAGMA synchronous').fetchone()[0])   # FULL
+        self.assertEqual(500, con.execute('PRAGMA cache_size').fetchone()[0])
+        self.assertEqual(1000, con.execute('PRAGMA busy_timeout').fetchone()[0])
+
+
+    def lock_database(self, seconds):
+        """ Holds the write lock from another connection for a while, in a background thread """
+        locked = threading.Event()
+
+        def hold_lock():
+            con = sqlite3.connect(self.path)
+            con.execute('BEGIN IMMEDIATE')
+            locked.set()
+            time.sleep(seconds)
+            con.rollback()
+            con.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        return thread
+
+
+    def test_write_retries_while_database_locked(self):
+        bookstore.storage_profile = StorageProfile(busy_timeout=0.05, busy_retries=10, busy_backoff=0.02)
+        self.BS.close()
+        thread = self.lock_database(0.3)
+        book = Book('Waited', 'For Lock')
+        book.save()
+        thread.join()
+        self.assertEqual(book, self.BS.get_book_by_id(book.id))
+
+
+    def test_write_fails_after_last_retry(self):
+        bookstore.storage_profile = StorageProfile(busy_timeout=0.01, busy_retries=2, busy_backoff=0.01)
+        self.BS.close()
+        thread = self.lock_database(1)
+        with self.assertRaises(sqlite3.OperationalError):
+            Book('Gave', 'Up').save()
+        thread.join()
+        self.assertEqual(0, self.BS.book_count())
+
+
+    def test_readers_not_blocked_by_open_write_transaction(self):
+        context = multiprocessing.get_context('spawn')
+        writing = context.Event()
+        finish = context.Event()
+        Book('Committed', 'Before').save()
+
+        writer = context.Process(target=hold_write_transaction, args=(self.path, writing, finish))
+        writer.start()
+        try:
+            self.assertTrue(writing.wait(30))
+
+            # The writer has an uncommitted insert. Reads don't wait, and see the data from before the write
+            start = time.perf_counter()
+            self.assertEqual(1, self.BS.book_count())
+            self.assertEqual(1, len(self.BS.get_all_books()))
+            self.assertLess(time.perf_counter() - start, 1)
+        finally:
+            finish.set()
+            writer.join(30)
+
+        self.assertEqual(0, writer.exitcode)
+        self.assertEqual(2, self.BS.book_count())
+
+
+    def test_writer_not_blocked_by_open_read(self):
+        self.BS.add_books( (f'Title {n}', 'Author') for n in range(50) )
+        original_batch_size = bookstore.fetch_batch_size
+        bookstore.fetch_batch_size = 1
+        try:
+            books = self.BS.iter_all_books()
+            next(books)   # A read is part way through
+
+            context = multiprocessing.get_context('spawn')
+            errors = context.Queue()
+            writer = context.Process(target=write_books, args=(self.path, 'Writer', 5, errors))
+            writer.start()
+            writer.join(30)
+
+            self.assertEqual(49, len(list(books)))   # Still reading the snapshot from before the writes
+        finally:
+            bookstore.fetch_batch_size = original_batch_size
+
+        self.assertEqual(0, writer.exitcode)
+        self.assertTrue(errors.empty())
+        self.assertEqual(55, self.BS.book_count())
+
+
+    def test_many_processes_read_and_write(self):
+        context = multiprocessing.get_context('spawn')
+        errors = context.Queue()
+        reads = context.Queue()
+        stop = context.Event()
+        books_per_writer = 100
+
+        writers = [ context.Process(target=write_books, args=(self.path, f'Writer{n}', books_per_writer, errors)) for n in range(3) ]
+        readers = [ context.Process(target=read_books, args=(self.path, f'Writer{n}', stop, reads, errors)) for n in range(3) ]
+
+        for process in readers + writers:
+            process.start()
+        for process in writers:
+            process.join(120)
+        stop.set()
+        for process in readers:
+            process.join(30)
+
+        failures = []
+        while not errors.empty():
+            failures.append(errors.get())
+        self.assertEqual([], failures)
+        self.assertEqual([0] * 6, [ process.exitcode for process in writers + readers ])
+
+        read_counts = [ reads.get(timeout=10) for reader in readers ]
+        self.assertTrue(all(count > 0 for count in read_counts))
+
+        self.assertEqual(3 * books_per_writer, self.BS.book_count())
+        self.assertEqual(3 * books_per_writer, len(self.BS.get_books_by_read_value(True)))
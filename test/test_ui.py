@@ -45,13 +45,97 @@ class TestUI(TestCase):
 
     @patch('builtins.print')
     def test_show_books_list(self, mock_print):
-        bk1 = Book('a', 'aaa')
-        bk2 = Book('b', 'bbb')
+        bk1 = Book('a', 'aaa', True, 1)
+        bk2 = Book('b', 'bbb', False, 2)
         books = [bk1, bk2]
         ui.show_books(books)
 
-        mock_print.assert_any_call(bk1)
-        mock_print.assert_any_call(bk2)
+        mock_print.assert_called_once()
+        page = mock_print.call_args[0][0]
+        self.assertIn('1   a      aaa     Yes', page)
+        self.assertIn('2   b      bbb     No', page)
+
+
+    @patch('builtins.print')
+    def test_show_books_generator_one_print_per_page(self, mock_print):
+        books = [ Book(f'Title {n}', 'Author', False, n) for n in range(1, 6) ]
+        ui.show_books((book for book in books), page_size=2)
+
+        self.assertEqual(3, mock_print.call_count)
+        pages = [ call[0][0] for call in mock_print.call_args_list ]
+        self.assertIn('Title 1', pages[0])
+        self.assertIn('Title 2', pages[0])
+        self.assertIn('Title 5', pages[2])
+        self.assertNotIn('Title 3', pages[0])
+
+
+    def test_format_books_aligns_columns(self):
+        books = [ Book('Short', 'A', True, 1), Book('A Longer Title', 'Another Author', False, 100) ]
+        lines = ui.format_books(books).strip().split('\n')
+        self.assertEqual('ID   Title           Author          Read', lines[0])
+        self.assertEqual('1    Short           A               Yes', lines[2])
+        self.assertEqual('100  A Longer Title  Another Author  No', lines[3])
+
+
+    def test_format_books_shortens_long_values(self):
+        lines = ui.format_books([ Book('T' * 100, 'Author', False, 1) ], max_width=10).strip().split('\n')
+        self.assertIn('TTTTTTT...', lines[2])
+        self.assertNotIn('T' * 11, lines[2])
+
+
+    def fake_pages(self, count):
+        """ :returns books with ids 1 to count, and a function to get pages of them like BookStore.page """
+        books = [ Book(f'Title {n}', 'Author', False, n) for n in range(1, count + 1) ]
+        calls = []
+        def get_page(after_id, limit):
+            calls.append( (after_id, limit) )
+            return [ book for book in books if book.id > after_id ][:limit]
+        return get_page, calls
+
+
+    @patch('builtins.input', side_effect=['n', 'x', 'n', 'p', 'q'])
+    @patch('builtins.print')
+    def test_page_books_next_previous_quit(self, mock_print, mock_input):
+        get_page, calls = self.fake_pages(7)
+        ui.page_books(get_page, page_size=3)
+        self.assertEqual([ (0, 4), (3, 4), (6, 4), (3, 4) ], calls)
+        mock_print.assert_any_call('Not a valid choice, try again.')
+        pages = [ call[0][0] for call in mock_print.call_args_list if 'Page' in call[0][0] ]
+        self.assertIn('Title 7', pages[2])
+        self.assertIn('Page 2', pages[3])
+
+
+    @patch('builtins.input')
+    @patch('builtins.print')
+    def test_page_books_one_page_does_not_ask(self, mock_print, mock_input):
+        get_page, calls = self.fake_pages(3)
+        ui.page_books(get_page, page_size=3)
+        mock_input.assert_not_called()
+        self.assertEqual(1, mock_print.call_count)
+
+
+    @patch('builtins.print')
+    def test_page_books_empty(self, mock_print):
+        get_page, calls = self.fake_pages(0)
+        ui.page_books(get_page)
+        mock_print.assert_called_with('No books to display')
+
+
+    @patch('builtins.print')
+    def test_show_stats(self, mock_print):
+        stats = { 'books': 3, 'read': 1, 'unread': 2, 'authors': 2, 
+                  'top_authors': [ {'author': 'Jane Austen', 'books': 2, 'read': 1}, {'author': 'Ann', 'books': 1, 'read': 0} ] }
+        ui.show_stats(stats)
+        mock_print.assert_any_call('\nBooks: 3  Read: 1  Unread: 2  Authors: 2')
+        table = mock_print.call_args[0][0]
+        self.assertIn('Jane Austen  2      1', table)
+        self.assertIn('Ann          1      0', table)
+
+
+    @patch('builtins.print')
+    def test_show_books_empty_generator(self, mock_print):
+        ui.show_books(book for book in [])
+        mock_print.assert_any_call('No books to display')
 
 
     @patch('builtins.input', side_effect=['title', 'author'])
@@ -71,6 +155,32 @@ class TestUI(TestCase):
         self.assertEqual(9, ui.get_book_id())
 
 
+    def test_parse_book_ids(self):
+        self.assertEqual([1, 2, 3, 8, 10, 11], list(ui.parse_book_ids('1-3, 8 10-11')))
+        self.assertEqual([4], list(ui.parse_book_ids('4')))
+        self.assertEqual([], list(ui.parse_book_ids('')))
+
+
+    def test_parse_book_ids_rejects_invalid(self):
+        for text in ['a', '0', '-3', '5-2', '1-b', '1.5']:
+            with self.assertRaises(ValueError):
+                ui.parse_book_ids(text)
+
+
+    def test_parse_book_ids_does_not_expand_ranges(self):
+        ids = ui.parse_book_ids(f'1-{ui.max_book_ids}')
+        self.assertEqual([1, 2], [ next(ids), next(ids) ])
+        for text in [f'1-{ui.max_book_ids + 1}', f'1-{ui.max_book_ids} 5', '1-20000000']:
+            with self.assertRaises(ValueError):
+                ui.parse_book_ids(text)
+
+
+    @patch('builtins.input', side_effect=['', 'pizza', '3-1', '2, 5-6'])
+    @patch('builtins.print')
+    def test_get_book_ids_validates(self, mock_print, mock_input):
+        self.assertEqual([2, 5, 6], list(ui.get_book_ids()))
+
+
     @patch('builtins.input', side_effect=['read'])
     def test_get_read_value_read(self, mock_input):
         self.assertTrue(ui.get_read_value())
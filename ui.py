@@ -1,5 +1,10 @@
+import itertools
+
 from bookstore import Book
 
+# The most IDs that can be entered at once, so a mistyped range like 1-20000000 is rejected instead of using up memory 
+max_book_ids = 1000000
+
 
 def display_menu_get_choice(menu):
     """ Displays all of the menu options, checks that the user enters a valid choice and returns the choice.
@@ -20,18 +25,114 @@ def message(msg):
     print(msg)
 
 
-def show_books(books):
-    """ Display all books in a list of Books, or a 'No books' message
-     :param books: the book list """
+def show_books(books, page_size=50):
+    """ Display all books in a list of Books, or a 'No books' message. 
+    Books are shown in aligned columns, page_size books at a time, and each page is printed with one call to print 
+    instead of one per book. 
+     :param books: the book list, or any iterable of books. Books are read from a generator a page at a time,
+     so the first page appears before the rest have been fetched. 
+     :param page_size: how many books to format and print at once """
+
+    shown_any = False
+    page = []
+    for book in books:
+        page.append(book)
+        if len(page) == page_size:
+            print(format_books(page))
+            shown_any = True
+            page = []
 
-    
-    print()
-    if books:
-        for book in books:
-            print(book)
-    else:
+    if page:
+        print(format_books(page))
+    elif not shown_any:
         print('No books to display')
-    print()
+
+
+def page_books(get_page, page_size=20):
+    """ Shows books one page at a time, asking the user whether to show the next page, go back, or stop. 
+    Only the page being shown is fetched, so the first page appears in the same time however many books there are. 
+     :param get_page: function that takes after_id and limit and returns up to limit books with ids greater than after_id, 
+     in id order, like BookStore.page 
+     :param page_size: how many books to show on each page """
+
+    starts = [0]   # after_id for each page shown so far. The last one is the current page 
+    while True:
+        books = get_page(starts[-1], page_size + 1)   # One extra book tells us if there's another page 
+        if not books:
+            print('No books to display')
+            return 
+
+        more = len(books) > page_size
+        books = books[:page_size]
+        print(format_books(books, f'Page {len(starts)}'))
+
+        choices = (['n'] if more else []) + (['p'] if len(starts) > 1 else []) + ['q']
+        if choices == ['q']:
+            return 
+
+        while True:
+            choice = input(f'Enter {choice_names(choices)}: ').lower()
+            if choice in choices:
+                break
+            print('Not a valid choice, try again.')
+
+        if choice == 'n':
+            starts.append(books[-1].id)
+        elif choice == 'p':
+            starts.pop()
+        else:
+            return
+
+
+def choice_names(choices):
+    names = { 'n': 'n for next page', 'p': 'p for previous page', 'q': 'q to stop' }
+    return ', '.join(names[choice] for choice in choices)
+
+
+def format_books(books, heading=None, max_width=40):
+    """ Formats books into a table with aligned columns, one book per line 
+     :param books: list of Books
+     :param heading: optional line to show above the table 
+     :param max_width: titles and authors longer than this are shortened to fit 
+     :returns: the table as a string, with a blank line before and after it """
+
+    rows = [ (str(book.id), shorten(book.title, max_width), shorten(book.author, max_width), 'Yes' if book.read else 'No') for book in books ]
+    return format_table(('ID', 'Title', 'Author', 'Read'), rows, heading)
+
+
+def format_table(header, rows, heading=None):
+    """ Formats rows of strings into a table with aligned columns 
+     :param header: tuple of column names 
+     :param rows: list of tuples of strings, the same length as header 
+     :param heading: optional line to show above the table 
+     :returns: the table as a string, with a blank line before and after it """
+
+    rows = [ tuple(row) for row in rows ]
+    widths = [ max(len(row[column]) for row in rows + [header]) for column in range(len(header)) ]
+
+    def line(row):
+        return '  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+
+    lines = [heading] if heading else []
+    lines.append(line(header))
+    lines.append(line([ '-' * width for width in widths ]))
+    lines.extend(line(row) for row in rows)
+    return '\n' + '\n'.join(lines) + '\n'
+
+
+def show_stats(stats):
+    """ Display reading statistics from BookStore.stats 
+     :param stats: the dictionary returned by BookStore.stats """
+    print(f"\nBooks: {stats['books']}  Read: {stats['read']}  Unread: {stats['unread']}  Authors: {stats['authors']}")
+    if stats['top_authors']:
+        rows = [ (shorten(author['author'], 40), str(author['books']), str(author['read'])) for author in stats['top_authors'] ]
+        print(format_table(('Author', 'Books', 'Read'), rows, 'Authors with the most books'))
+
+
+def shorten(text, width):
+    text = str(text)
+    return text if len(text) <= width else text[:width - 3] + '...'
+
 
 def get_book_info():
     """ Create a new Book from title and author provided by user
@@ -56,6 +157,51 @@ def get_book_id():
             print('Please enter a number.')
 
 
+def get_book_ids():
+    """ Ask for one or more IDs. Accepts a list of IDs and ranges separated by commas or spaces, for example 1-5, 8, 10-12 
+    :returns an iterator of the IDs, in the order they were entered """
+    while True:
+        try:
+            ids = parse_book_ids(input('Enter book IDs, for example 1-5, 8, 10-12: '))
+            first_id = next(ids, None)
+            if first_id is not None:
+                return itertools.chain([first_id], ids)
+            print('Please enter at least one ID.')
+        except ValueError as error:
+            print(f'{error}. Please enter positive numbers, or ranges like 3-7.')
+
+
+def parse_book_ids(text):
+    """ Turns a list of IDs and ID ranges, like '1-5, 8 10-12', into the IDs. Ranges aren't expanded into lists, 
+    the IDs in them are produced as they are needed. 
+    :param text the IDs and ranges, separated by commas or spaces 
+    :returns iterator of the IDs 
+    :raises ValueError if any part isn't a positive number or range, or there are more than max_book_ids IDs """
+    ranges = []
+    for part in text.replace(',', ' ').split():
+        start, dash, end = part.partition('-')
+        try:
+            start = int(start)
+            end = int(end) if dash else start
+        except ValueError:
+            raise ValueError(f'Not a valid ID or range: {part}')
+        if start < 1 or end < start:
+            raise ValueError(f'Not a valid ID or range: {part}')
+        ranges.append(range(start, end + 1))
+
+    if sum(len(ids) for ids in ranges) > max_book_ids:
+        raise ValueError(f'Too many IDs, the most at once is {max_book_ids:,}')
+    return itertools.chain.from_iterable(ranges)
+
+
+def parse_read(value):
+    """ Converts a read value from a file or script to True or False. 
+    Accepts booleans, or text like 'true', 'yes', '1' or 'read'. Anything else, or a missing value, is False. """
+    if isinstance(value, str):
+        return value.strip().lower() in ['true', 'yes', 'y', '1', 'read']
+    return bool(value)
+
+
 def get_read_value():
     """ Ask user to enter 'read' or 'not read'
      :returns: True if user enters 'read' or False if user enters 'not read' """